@@ -0,0 +1,204 @@
+"""
+Admission control for upstream LLM (Dify) calls.
+
+- ``TokenBuckets``: per-key rate limit (requests per minute with a burst),
+  checked when a request arrives; the caller answers 429 with Retry-After.
+- ``FairAdmission``: at most ``max_concurrency`` Dify calls in flight per
+  worker. Extra calls wait in a bounded queue; waiters are admitted round-robin
+  across keys (one per student), so a burst from one client cannot starve the
+  rest of the class. A full queue or a wait longer than ``max_wait`` raises
+  ``Overloaded``, which the API turns into 503 + Retry-After instead of piling
+  more load onto an upstream that is already answering 429.
+
+Both are per process, like the Dify connection pool: with several uvicorn
+workers the effective limits are multiplied by the worker count.
+"""
+
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Hashable, Optional
+
+import metrics
+
+ADMISSION_WAIT_SECONDS = metrics.histogram(
+    "llm_admission_wait_seconds",
+    "Time an upstream LLM call waited for a slot",
+    ("outcome",),
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60),
+)
+ADMISSION_REJECTED = metrics.counter(
+    "llm_admission_rejected_total", "LLM requests turned away (rate_limited, queue_full, queue_timeout)", ("reason",)
+)
+ADMISSION_ACTIVE = metrics.gauge("llm_admission_active", "Upstream LLM calls holding a slot")
+ADMISSION_QUEUED = metrics.gauge("llm_admission_queued", "Upstream LLM calls waiting for a slot")
+
+
+class Overloaded(Exception):
+    """The call was not admitted; retry after ``retry_after`` seconds."""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(f"{reason}, retry after {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBuckets:
+    """``rate_per_minute`` tokens per key, up to ``burst`` saved; least recently seen keys are dropped first."""
+
+    def __init__(self, rate_per_minute: float, burst: int, max_keys: int = 100_000, clock=time.monotonic):
+        self.rate = rate_per_minute / 60.0
+        self.burst = max(1, burst)
+        self.max_keys = max_keys
+        self.clock = clock
+        self._buckets: "OrderedDict[Hashable, list]" = OrderedDict()  # key -> [tokens, updated]
+        self._lock = threading.Lock()
+
+    def take(self, key: Hashable) -> float:
+        """Spend one token: 0 if allowed, else seconds until the next token"""
+        now = self.clock()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(self.burst), now]
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0.0
+            wait = (1 - bucket[0]) / self.rate if self.rate > 0 else math.inf
+        ADMISSION_REJECTED.inc(reason="rate_limited")
+        return wait
+
+
+class Slot:
+    """One admitted call; release() is idempotent."""
+
+    def __init__(self, admission: "FairAdmission"):
+        self._admission = admission
+        self._generation = admission._generation
+        self._started = time.perf_counter()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            if self._generation == self._admission._generation:
+                self._admission._release(time.perf_counter() - self._started)
+
+    def __enter__(self) -> "Slot":
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class FairAdmission:
+    def __init__(self, max_concurrency: int, max_queue: int, max_wait: float):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        self.queued = 0
+        self._queues: "OrderedDict[Hashable, Deque[asyncio.Future]]" = OrderedDict()
+        self._hold_seconds = 1.0  # moving average of slot hold time, for Retry-After
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._generation = 0  # slots from a previous event loop are not counted
+
+    def retry_after(self) -> int:
+        """Rough seconds until the queue drains"""
+        backlog = (self.queued + 1) * self._hold_seconds / max(1, self.max_concurrency)
+        return max(1, min(60, math.ceil(backlog)))
+
+    def _check_loop(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Futures are bound to the loop that created them
+            self._loop = loop
+            self._generation += 1
+            self.active = self.queued = 0
+            self._queues.clear()
+
+    def _update_gauges(self):
+        ADMISSION_ACTIVE.set(self.active)
+        ADMISSION_QUEUED.set(self.queued)
+
+    async def acquire(self, key: Hashable) -> Slot:
+        """Wait for a slot (fairly across keys); raises Overloaded"""
+        self._check_loop()
+        if self.active < self.max_concurrency and not self.queued:
+            self.active += 1
+            self._update_gauges()
+            ADMISSION_WAIT_SECONDS.observe(0, outcome="admitted")
+            return Slot(self)
+        if self.queued >= self.max_queue:
+            ADMISSION_REJECTED.inc(reason="queue_full")
+            raise Overloaded("queue_full", self.retry_after())
+
+        queued_at = time.perf_counter()
+        waiter = self._loop.create_future()
+        self._queues.setdefault(key, deque()).append(waiter)
+        self.queued += 1
+        self._update_gauges()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.max_wait)
+        except asyncio.TimeoutError:
+            if not self._abandon(key, waiter):
+                ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - queued_at, outcome="admitted")
+                return Slot(self)  # handed over just as the wait ran out
+            ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - queued_at, outcome="timeout")
+            ADMISSION_REJECTED.inc(reason="queue_timeout")
+            raise Overloaded("queue_timeout", self.retry_after())
+        except asyncio.CancelledError:
+            if not self._abandon(key, waiter):
+                Slot(self).release()  # the caller went away after being admitted
+            raise
+        ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - queued_at, outcome="admitted")
+        return Slot(self)
+
+    def _abandon(self, key: Hashable, waiter: asyncio.Future) -> bool:
+        """Leave the queue; False if the waiter was already given a slot"""
+        if waiter.done():
+            return False
+        waiter.cancel()
+        queue = self._queues.get(key)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del self._queues[key]
+            self.queued -= 1
+            self._update_gauges()
+        return True
+
+    def _release(self, held: float):
+        self._hold_seconds = 0.8 * self._hold_seconds + 0.2 * held
+        # Hand the slot to the first waiter of the next key in rotation
+        while self._queues:
+            key, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            self.queued -= 1
+            if queue:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+            if not waiter.done():
+                waiter.set_result(None)
+                self._update_gauges()
+                return
+        self.active -= 1
+        self._update_gauges()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "retry_after": self.retry_after(),
+        }
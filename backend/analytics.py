@@ -0,0 +1,211 @@
+"""
+Cohort analytics maintained incrementally from the submission log.
+
+Aggregates are running counters per group (all / school / school+class):
+top-1 and top-3 RIASEC counts, score sums and exact score histograms
+(scores are small integers, so a histogram is a constant-size sketch that
+gives exact percentiles) and suggested-major counts.
+
+``refresh()`` tails the log from the last byte offset it has seen, so each
+submission is counted once whichever worker appended it. Aggregates and the
+offset are snapshotted to disk, so a restart does not rescan the history.
+"""
+
+import json
+import logging
+import os
+import threading
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from submission_store import SubmissionStore, atomic_write_text, record_class
+
+logger = logging.getLogger(__name__)
+
+RIASEC_TYPES = ["R", "I", "A", "S", "E", "C"]
+PERCENTILES = (25, 50, 75, 90)
+
+
+def _percentile(hist: Counter, total: int, p: float) -> Optional[float]:
+    """Nearest-rank percentile from a value -> count histogram"""
+    if not total:
+        return None
+    rank = max(1, -(-p * total // 100))  # ceil(p/100 * total)
+    seen = 0
+    for value in sorted(hist):
+        seen += hist[value]
+        if seen >= rank:
+            return value
+    return None
+
+
+class CohortStats:
+    def __init__(self):
+        self.count = 0
+        self.top1 = Counter()
+        self.top3 = Counter()
+        self.score_sum = Counter()
+        self.hist = {t: Counter() for t in RIASEC_TYPES}
+        self.majors = Counter()
+
+    def add(self, record: Dict[str, Any]):
+        self.count += 1
+        riasec = record.get("riasec") or []
+        if riasec:
+            self.top1[riasec[0]] += 1
+            self.top3.update(riasec[:3])
+        scores = record.get("scores") or {}
+        for t in RIASEC_TYPES:
+            if t in scores:
+                self.score_sum[t] += scores[t]
+                self.hist[t][scores[t]] += 1
+        majors = record.get("suggestedMajors") or ""
+        self.majors.update(m.strip() for m in majors.split(",") if m.strip())
+
+    def to_dict(self, top_majors: int = 10) -> Dict[str, Any]:
+        scores = {}
+        for t in RIASEC_TYPES:
+            n = sum(self.hist[t].values())
+            scores[t] = {
+                "mean": round(self.score_sum[t] / n, 2) if n else None,
+                **{f"p{p}": _percentile(self.hist[t], n, p) for p in PERCENTILES},
+            }
+        return {
+            "count": self.count,
+            "top1_distribution": {t: self.top1.get(t, 0) for t in RIASEC_TYPES},
+            "top3_distribution": {t: self.top3.get(t, 0) for t in RIASEC_TYPES},
+            "scores": scores,
+            "top_majors": [{"name": name, "count": c} for name, c in self.majors.most_common(top_majors)],
+        }
+
+    # ----- snapshot -----
+    def dump(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "top1": self.top1,
+            "top3": self.top3,
+            "score_sum": self.score_sum,
+            "hist": {t: {str(k): v for k, v in h.items()} for t, h in self.hist.items()},
+            "majors": self.majors,
+        }
+
+    @classmethod
+    def load(cls, data: Dict[str, Any]) -> "CohortStats":
+        stats = cls()
+        stats.count = data["count"]
+        stats.top1 = Counter(data["top1"])
+        stats.top3 = Counter(data["top3"])
+        stats.score_sum = Counter(data["score_sum"])
+        stats.hist = {t: Counter({int(k): v for k, v in data["hist"].get(t, {}).items()}) for t in RIASEC_TYPES}
+        stats.majors = Counter(data["majors"])
+        return stats
+
+
+class CohortAnalytics:
+    # Snapshot to disk every N new records (and on close)
+    SNAPSHOT_EVERY = 500
+
+    def __init__(self, store: SubmissionStore, snapshot_path: Optional[Path] = None):
+        self.store = store
+        self.snapshot_path = Path(snapshot_path) if snapshot_path else None
+        self._lock = threading.Lock()
+        self._reset()
+        self._since_snapshot = 0
+        self._load_snapshot()
+
+    def _reset(self):
+        self.offset = 0
+        self.log_inode = None
+        self.overall = CohortStats()
+        self.schools: Dict[str, CohortStats] = {}
+        self.classes: Dict[str, Dict[str, CohortStats]] = {}
+
+    def _log_inode(self) -> Optional[int]:
+        try:
+            return os.stat(self.store.log_path).st_ino
+        except FileNotFoundError:
+            return None
+
+    def _add(self, record: Dict[str, Any]):
+        school = record.get("school") or "-"
+        class_name = record_class(record)
+        self.overall.add(record)
+        self.schools.setdefault(school, CohortStats()).add(record)
+        self.classes.setdefault(school, {}).setdefault(class_name, CohortStats()).add(record)
+
+    def refresh(self) -> int:
+        """Fold in records appended since the last refresh. Returns how many were added."""
+        with self._lock:
+            inode = self._log_inode()
+            if inode != self.log_inode:
+                # Log was compacted/replaced: offsets moved, rebuild once
+                self._reset()
+                self.log_inode = inode
+            added = 0
+            for next_offset, _, record in self.store.scan(self.offset):
+                self._add(record)
+                self.offset = next_offset
+                added += 1
+            self._since_snapshot += added
+            if self.snapshot_path and self._since_snapshot >= self.SNAPSHOT_EVERY:
+                self._save_snapshot_locked()
+            return added
+
+    def report(self, school: Optional[str] = None, class_name: Optional[str] = None) -> Dict[str, Any]:
+        self.refresh()
+        with self._lock:
+            if school is None:
+                return {
+                    "overall": self.overall.to_dict(),
+                    "schools": {s: stats.to_dict() for s, stats in self.schools.items()},
+                }
+            school_stats = self.schools.get(school, CohortStats())
+            classes = self.classes.get(school, {})
+            if class_name is not None:
+                return {
+                    "school": school,
+                    "class": class_name,
+                    "overall": classes.get(class_name, CohortStats()).to_dict(),
+                }
+            return {
+                "school": school,
+                "overall": school_stats.to_dict(),
+                "classes": {c: stats.to_dict() for c, stats in classes.items()},
+            }
+
+    # ----- snapshot -----
+    def _load_snapshot(self):
+        if not self.snapshot_path or not self.snapshot_path.exists():
+            return
+        try:
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("log_inode") != self._log_inode():
+                return  # different/compacted log: rebuild on first refresh
+            self.offset = data["offset"]
+            self.log_inode = data["log_inode"]
+            self.overall = CohortStats.load(data["overall"])
+            self.schools = {s: CohortStats.load(d) for s, d in data["schools"].items()}
+            self.classes = {
+                s: {c: CohortStats.load(d) for c, d in classes.items()} for s, classes in data["classes"].items()
+            }
+        except Exception as e:
+            logger.error(f"Error reading {self.snapshot_path}, rebuilding analytics: {e}")
+            self._reset()
+
+    def _save_snapshot_locked(self):
+        data = {
+            "offset": self.offset,
+            "log_inode": self.log_inode,
+            "overall": self.overall.dump(),
+            "schools": {s: stats.dump() for s, stats in self.schools.items()},
+            "classes": {s: {c: st.dump() for c, st in classes.items()} for s, classes in self.classes.items()},
+        }
+        atomic_write_text(self.snapshot_path, json.dumps(data, ensure_ascii=False))
+        self._since_snapshot = 0
+
+    def close(self):
+        if self.snapshot_path:
+            with self._lock:
+                self._save_snapshot_locked()
@@ -0,0 +1,300 @@
+"""
+Benchmark suite: API load profiles plus scoring microbenchmarks.
+
+By default the app runs in this process on a throw-away data directory, with
+Dify and the Google Sheet replaced by fake_upstreams (through ASGI transports,
+no network), so runs are reproducible on any machine:
+
+    python benchmark.py                                   # every profile + micro
+    python benchmark.py --profile chat --requests 2000 --concurrency 100
+    python benchmark.py --dify-latency 0.8 --json today.json --baseline last.json
+
+``--url`` targets a running server instead (start fake_upstreams.py and point
+DIFY_CHAT_URL / GOOGLE_SCRIPT_URL at it); this also measures the real network
+path and multiple workers. In-process, ASGITransport buffers whole responses,
+so streaming profiles measure total time, not time-to-first-token.
+
+Each result reports throughput and p50/p95/p99/max latency. With
+``--baseline`` the run fails (exit 1) when p95 grows or throughput drops by
+more than ``--max-regression`` compared with a saved ``--json`` report.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+FAKE_DIFY_URL = "http://fake-upstream/v1/chat-messages"
+FAKE_SHEET_URL = "http://fake-upstream/sheet"
+
+
+def percentile(sorted_values: List[float], p: float) -> Optional[float]:
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-p * len(sorted_values) // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(name: str, latencies: List[float], elapsed: float, errors: int, **extra) -> Dict[str, Any]:
+    latencies = sorted(latencies)
+    ms = lambda v: None if v is None else round(v * 1000, 4)  # noqa: E731
+    return {
+        "name": name,
+        "count": len(latencies),
+        "errors": errors,
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p95_ms": ms(percentile(latencies, 95)),
+        "p99_ms": ms(percentile(latencies, 99)),
+        "max_ms": ms(latencies[-1] if latencies else None),
+        **extra,
+    }
+
+
+# ================== LOAD PROFILES ==================
+def random_answers(rng: random.Random) -> List[int]:
+    return [rng.randint(1, 5) for _ in range(50)]
+
+
+def student(rng: random.Random, i: int) -> Dict[str, Any]:
+    return {
+        "name": f"Học sinh {i}",
+        "class": f"10A{rng.randint(1, 9)}",
+        "school": f"THPT {rng.randint(1, 20)}",
+        "answer": random_answers(rng),
+    }
+
+
+async def setup_conversations(client: httpx.AsyncClient, rng: random.Random, n: int) -> List[str]:
+    ids = []
+    for i in range(n):
+        response = await client.post("/start-conversation", json=student(rng, i))
+        response.raise_for_status()
+        ids.append(response.json()["conversation_id"])
+    return ids
+
+
+async def build_profile(client: httpx.AsyncClient, profile: str, rng: random.Random) -> Callable[[int], Awaitable[httpx.Response]]:
+    """Return ``request(i)`` for a profile, after any setup it needs"""
+    if profile == "start-conversation":
+        return lambda i: client.post("/start-conversation", json=student(rng, i))
+
+    if profile in ("chat", "chat-stream"):
+        conversations = await setup_conversations(client, rng, 20)
+        path = "/chat" if profile == "chat" else "/chat/stream"
+        return lambda i: client.post(
+            path, json={"conversation_id": rng.choice(conversations), "message": f"Câu hỏi số {i} về ngành học?"}
+        )
+
+    if profile == "submissions":
+        # Exam-day mix: mostly writes, some teacher page reads
+        def request(i: int):
+            if i % 10 == 9:
+                return client.get("/api/submissions", params={"limit": 50})
+            s = student(rng, i)
+            return client.post("/api/submissions", json={
+                "name": s["name"], "class": s["class"], "school": s["school"],
+                "riasec": ["R", "I", "A"], "scores": {"R": 30, "I": 25, "A": 20, "S": 10, "E": 10, "C": 10},
+                "answers": s["answer"], "time": "2025-01-05T08:00:00Z",
+            })
+        return request
+
+    if profile == "vr-jobs":
+        etag = (await client.get("/api/vr-jobs")).headers.get("etag")
+        # Half repeat visits revalidating with the ETag (304), half cold loads
+        return lambda i: client.get("/api/vr-jobs", headers={"If-None-Match": etag} if i % 2 and etag else {})
+
+    raise ValueError(f"Unknown profile: {profile}")
+
+
+async def run_profile(client: httpx.AsyncClient, profile: str, requests: int, concurrency: int, seed: int = 0) -> Dict[str, Any]:
+    """Send ``requests`` requests from ``concurrency`` concurrent workers"""
+    rng = random.Random(seed)
+    request = await build_profile(client, profile, rng)
+    latencies: List[float] = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            started = time.perf_counter()
+            try:
+                response = await request(i)
+                await response.aread()
+                if response.status_code >= 400:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(profile, latencies, time.perf_counter() - started, errors, concurrency=concurrency)
+
+
+# ================== MICROBENCHMARKS ==================
+def run_micro(iterations: int = 20000, seed: int = 0) -> List[Dict[str, Any]]:
+    """Per-call timings for the scoring / recommendation hot paths"""
+    from riasec_calculator import RIASEC_TYPES, ScoreCache, calculate_riasec, calculate_riasec_batch, recommend_jobs, recommendation_index
+
+    rng = random.Random(seed)
+    answer_sets = [random_answers(rng) for _ in range(min(iterations, 2000))]
+    tops = [rng.sample(RIASEC_TYPES, 3) for _ in range(min(iterations, 2000))]
+    recommendation_index().warm()
+
+    def timed(name: str, fn: Callable[[int], Any], n: int, **extra) -> Dict[str, Any]:
+        latencies = []
+        perf = time.perf_counter
+        started = perf()
+        for i in range(n):
+            t0 = perf()
+            fn(i)
+            latencies.append(perf() - t0)
+        return summarize(name, latencies, perf() - started, 0, **extra)
+
+    results = [
+        timed("calculate_riasec", lambda i: calculate_riasec(answer_sets[i % len(answer_sets)]), iterations),
+        timed("calculate_riasec(json)", lambda i: calculate_riasec(json.dumps(answer_sets[i % len(answer_sets)])), iterations),
+        timed("recommend_jobs", lambda i: recommend_jobs(tops[i % len(tops)]), iterations),
+    ]
+    # Memo hits: 50 distinct vectors submitted over and over (retakes, test flows)
+    cache = ScoreCache(max_entries=len(answer_sets))
+    results.append(timed("score_cache(hit)", lambda i: cache.score(answer_sets[i % min(50, len(answer_sets))]), iterations))
+    batch = [random_answers(rng) for _ in range(1000)]
+    calculate_riasec_batch(batch[:1])  # numpy import + weight matrix are one-off costs
+    results.append(timed("calculate_riasec_batch[1000]", lambda i: calculate_riasec_batch(batch), max(1, iterations // 1000), rows=1000))
+    return results
+
+
+# ================== REPORTING ==================
+COLUMNS = ["name", "count", "errors", "throughput_rps", "p50_ms", "p95_ms", "p99_ms", "max_ms"]
+
+
+def print_table(results: List[Dict[str, Any]]):
+    widths = [max(len(c), *(len(str(r.get(c))) for r in results)) for c in COLUMNS]
+    print("  ".join(c.ljust(w) for c, w in zip(COLUMNS, widths)))
+    for r in results:
+        print("  ".join(str(r.get(c)).ljust(w) for c, w in zip(COLUMNS, widths)))
+
+
+def compare(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], max_regression: float) -> List[str]:
+    """Human-readable regressions of ``results`` against ``baseline`` (matched by name)"""
+    before = {r["name"]: r for r in baseline}
+    problems = []
+    for r in results:
+        b = before.get(r["name"])
+        if b is None:
+            continue
+        if b.get("p95_ms") and r.get("p95_ms") and r["p95_ms"] > b["p95_ms"] * (1 + max_regression):
+            problems.append(f"{r['name']}: p95 {b['p95_ms']} -> {r['p95_ms']} ms")
+        if b.get("throughput_rps") and r.get("throughput_rps") and r["throughput_rps"] < b["throughput_rps"] * (1 - max_regression):
+            problems.append(f"{r['name']}: throughput {b['throughput_rps']} -> {r['throughput_rps']} req/s")
+        if r.get("errors") and not b.get("errors"):
+            problems.append(f"{r['name']}: {r['errors']} errors (baseline had none)")
+    return problems
+
+
+# ================== RUNNERS ==================
+PROFILES = ["start-conversation", "chat", "chat-stream", "submissions", "vr-jobs"]
+
+
+async def run_in_process(args) -> List[Dict[str, Any]]:
+    import main
+    from fake_upstreams import create_fake_upstreams
+    from settings import Settings
+
+    # Isolated app: throw-away storage, upstream URLs pointing at the fakes
+    data_dir = tempfile.mkdtemp(prefix="careergo-bench-")
+    app = main.create_app(Settings.from_env(
+        data_dir=Path(data_dir),
+        dify_api_key="bench",
+        dify_chat_url=FAKE_DIFY_URL,
+        google_script_url=FAKE_SHEET_URL,
+        rate_limit_per_minute=0,  # profiles replay the same students
+    ))
+    resources = app.state.resources
+    # Per-request INFO logs would dominate the timings
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    fake = create_fake_upstreams(
+        latency=args.dify_latency, jitter=args.dify_jitter, chunks=args.chunks, error_rate=args.error_rate, seed=args.seed
+    )
+    resources.dify_client.transport = httpx.ASGITransport(app=fake)
+    resources.sheet_outbox.transport = httpx.ASGITransport(app=fake)
+
+    results = []
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+            for profile in args.profiles:
+                results.append(await run_profile(client, profile, args.requests, args.concurrency, args.seed))
+        await resources.sheet_outbox.flush()
+    print(f"Fake upstream counters: {fake.state.stats}", file=sys.stderr)
+    if args.keep_data:
+        print(f"Benchmark data kept in {data_dir}", file=sys.stderr)
+    else:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    return results
+
+
+async def run_remote(args) -> List[Dict[str, Any]]:
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, timeout=120, limits=limits) as client:
+        return [await run_profile(client, p, args.requests, args.concurrency, args.seed) for p in args.profiles]
+
+
+def main_cli(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="CareerGo load and microbenchmarks")
+    parser.add_argument("--profile", dest="profiles", action="append", choices=PROFILES,
+                        help="load profile to run (repeatable; default: all)")
+    parser.add_argument("--requests", type=int, default=500, help="requests per profile")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--url", help="benchmark a running server instead of the in-process app")
+    parser.add_argument("--dify-latency", type=float, default=0.05, help="fake Dify latency in seconds")
+    parser.add_argument("--dify-jitter", type=float, default=0.0)
+    parser.add_argument("--chunks", type=int, default=5, help="fake Dify streamed chunks per answer")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fake Dify 429/503 rate")
+    parser.add_argument("--micro-iterations", type=int, default=20000)
+    parser.add_argument("--no-load", action="store_true", help="microbenchmarks only")
+    parser.add_argument("--no-micro", action="store_true", help="load profiles only")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep-data", action="store_true", help="keep the in-process run's data directory")
+    parser.add_argument("--json", dest="json_out", help="write results to this file")
+    parser.add_argument("--baseline", help="earlier --json report to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="allowed p95/throughput change (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+    args.profiles = args.profiles or PROFILES
+
+    results = []
+    if not args.no_micro:
+        results += run_micro(args.micro_iterations, args.seed)
+    if not args.no_load:
+        results += asyncio.run(run_remote(args) if args.url else run_in_process(args))
+    print_table(results)
+
+    if args.json_out:
+        Path(args.json_out).write_text(json.dumps(results, ensure_ascii=False, indent=2), encoding="utf-8")
+    if args.baseline:
+        problems = compare(results, json.loads(Path(args.baseline).read_text(encoding="utf-8")), args.max_regression)
+        for problem in problems:
+            print(f"REGRESSION {problem}", file=sys.stderr)
+        if problems:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,304 @@
+"""
+Conversation session stores.
+
+- MemoryConversationStore: in-process LRU with idle TTL and an entry cap (single worker).
+- SQLiteConversationStore: one SQLite file (WAL) shared by every uvicorn worker on the host,
+  so /chat finds the session whichever worker the load balancer picks.
+
+Both expire sessions idle longer than ``ttl`` seconds, evict least-recently-used
+sessions beyond ``max_entries`` and count hits, misses, evictions and expirations.
+Sessions are plain JSON-serialisable dicts; callers ``put`` them back after changing them.
+
+Message history is capped with ``trim_history``: ``conv["message_offset"]`` counts
+dropped messages so message indices stay absolute, and an optional summarizer
+can fold the dropped turns into a single ``summary`` message.
+"""
+
+import json
+import sqlite3
+from abc import ABC, abstractmethod
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+
+class ConversationStore(ABC):
+    """Interface for conversation session storage (a store missing a method cannot be instantiated)."""
+
+    def __init__(self, ttl: float = 7200, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @abstractmethod
+    def get(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def put(self, conversation_id: str, conv: Dict[str, Any]):
+        ...
+
+    @abstractmethod
+    def delete(self, conversation_id: str):
+        ...
+
+    @abstractmethod
+    def __len__(self) -> int:
+        ...
+
+    @abstractmethod
+    def append_turn(
+        self, conversation_id: str, messages: List[Dict[str, Any]], trim: Optional[Callable[[Dict[str, Any]], None]] = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Append ``messages`` to a stored session in one atomic step, so two workers
+        adding turns to the same conversation never overwrite each other's.
+        ``trim(conv)`` runs on the updated session before it is written back.
+        Returns the updated session, or None if it is missing or expired.
+        """
+
+    def __contains__(self, conversation_id: str) -> bool:
+        return self.get(conversation_id) is not None
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self).__name__,
+            "size": len(self),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class MemoryConversationStore(ConversationStore):
+    """In-process LRU + idle TTL. The OrderedDict is kept in last-access order."""
+
+    def __init__(self, ttl: float = 7200, max_entries: int = 10000):
+        super().__init__(ttl, max_entries)
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire_locked(self, now: float):
+        # Oldest access is at the front, so stop at the first live entry
+        while self._data:
+            key, (_, last_access) = next(iter(self._data.items()))
+            if now - last_access <= self.ttl:
+                break
+            del self._data[key]
+            self.expirations += 1
+
+    def get(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            self._expire_locked(now)
+            entry = self._data.get(conversation_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data[conversation_id] = (entry[0], now)
+            self._data.move_to_end(conversation_id)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, conversation_id: str, conv: Dict[str, Any]):
+        now = time.monotonic()
+        with self._lock:
+            self._data[conversation_id] = (conv, now)
+            self._data.move_to_end(conversation_id)
+            self._expire_locked(now)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, conversation_id: str):
+        with self._lock:
+            self._data.pop(conversation_id, None)
+
+    def append_turn(self, conversation_id, messages, trim=None):
+        now = time.monotonic()
+        with self._lock:
+            self._expire_locked(now)
+            entry = self._data.get(conversation_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            conv = entry[0]
+            conv["messages"].extend(messages)
+            if trim is not None:
+                trim(conv)
+            self._data[conversation_id] = (conv, now)
+            self._data.move_to_end(conversation_id)
+            self.hits += 1
+            return conv
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SQLiteConversationStore(ConversationStore):
+    """SQLite-backed store shared across worker processes (one connection per thread)."""
+
+    # Expiry/eviction sweeps run every N writes rather than on every put
+    SWEEP_EVERY = 50
+
+    def __init__(self, db_path: Path, ttl: float = 7200, max_entries: int = 10000):
+        super().__init__(ttl, max_entries)
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._writes = 0
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                " id TEXT PRIMARY KEY,"
+                " data TEXT NOT NULL,"
+                " last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_last_access ON conversations(last_access)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.db_path), timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT data, last_access FROM conversations WHERE id = ?", (conversation_id,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        if now - row[1] > self.ttl:
+            with conn:
+                conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+            self.expirations += 1
+            self.misses += 1
+            return None
+        with conn:
+            conn.execute("UPDATE conversations SET last_access = ? WHERE id = ?", (now, conversation_id))
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, conversation_id: str, conv: Dict[str, Any]):
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO conversations (id, data, last_access) VALUES (?, ?, ?)",
+                (conversation_id, json.dumps(conv, ensure_ascii=False), time.time()),
+            )
+        self._writes += 1
+        if self._writes % self.SWEEP_EVERY == 0:
+            self.sweep()
+
+    def append_turn(self, conversation_id, messages, trim=None):
+        now = time.time()
+        conn = self._conn()
+        # Write lock before the read: another worker's turn waits for this one instead of overwriting it
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT data, last_access FROM conversations WHERE id = ?", (conversation_id,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                conn.rollback()
+                self.misses += 1
+                return None
+            conv = json.loads(row[0])
+            conv["messages"].extend(messages)
+            if trim is not None:
+                trim(conv)
+            conn.execute(
+                "UPDATE conversations SET data = ?, last_access = ? WHERE id = ?",
+                (json.dumps(conv, ensure_ascii=False), now, conversation_id),
+            )
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        self.hits += 1
+        return conv
+
+    def sweep(self):
+        """Delete idle sessions and trim to ``max_entries`` (least recently used first)."""
+        conn = self._conn()
+        with conn:
+            cur = conn.execute("DELETE FROM conversations WHERE last_access < ?", (time.time() - self.ttl,))
+            self.expirations += cur.rowcount
+            cur = conn.execute(
+                "DELETE FROM conversations WHERE id IN ("
+                " SELECT id FROM conversations ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self.evictions += cur.rowcount
+
+    def delete(self, conversation_id: str):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+
+    def __len__(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+
+
+def create_conversation_store(backend: str, db_path: Path, ttl: float, max_entries: int) -> ConversationStore:
+    if backend == "sqlite":
+        return SQLiteConversationStore(db_path, ttl=ttl, max_entries=max_entries)
+    if backend == "memory":
+        return MemoryConversationStore(ttl=ttl, max_entries=max_entries)
+    raise ValueError(f"Unknown conversation store backend: {backend}")
+
+
+# ================== MESSAGE HISTORY ==================
+Summarizer = Callable[[List[Dict[str, Any]], Optional[Dict[str, Any]]], Optional[Dict[str, Any]]]
+
+
+def trim_history(conv: Dict[str, Any], max_messages: int, summarizer: Optional[Summarizer] = None):
+    """
+    Keep at most ``max_messages`` stored messages (0 = unlimited).
+    ``summarizer(dropped, previous_summary)`` may return a message that replaces the dropped turns.
+    """
+    messages = conv["messages"]
+    if not max_messages or len(messages) <= max_messages:
+        return
+    drop = len(messages) - max_messages
+    dropped = messages[:drop]
+    del messages[:drop]
+    conv["message_offset"] = conv.get("message_offset", 0) + drop
+    if summarizer is not None:
+        summary = summarizer(dropped, conv.get("summary"))
+        if summary is not None:
+            conv["summary"] = summary
+
+
+def message_window(conv: Dict[str, Any], since: Optional[int] = None, limit: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Slice stored history by absolute message index.
+    ``since`` is the first index wanted (default: oldest kept); ``limit`` caps the count.
+    """
+    offset = conv.get("message_offset", 0)
+    messages = conv["messages"]
+    total = offset + len(messages)
+    start = offset if since is None else max(since, offset)
+    end = total if limit is None else min(total, start + limit)
+    return {
+        "messages": messages[start - offset:end - offset],
+        "offset": start,
+        "total": total,
+        "next_offset": end if end < total else None,
+    }
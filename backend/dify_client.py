@@ -0,0 +1,199 @@
+"""
+Async Dify client with a shared keep-alive connection pool.
+
+- One httpx.AsyncClient per event loop (one per uvicorn worker), reused across requests.
+- Per-host concurrency limit so a burst queues locally instead of opening hundreds of sockets.
+- Separate connect / read timeouts.
+- Retries with jittered exponential backoff on 429 / 5xx and connection errors
+  (Retry-After is honoured when Dify sends it).
+- ``chat_stream`` uses Dify's streaming mode and yields its SSE events as dicts;
+  retries only happen before the first event, never mid-answer.
+"""
+
+import asyncio
+import json
+import logging
+import random
+import time
+from typing import Any, AsyncIterator, Dict, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# One observation per attempt; status is the HTTP status or "error" (connection/timeout)
+DIFY_REQUEST_SECONDS = metrics.histogram(
+    "dify_request_duration_seconds", "Dify chat-messages call time per attempt", ("mode", "status")
+)
+DIFY_QUEUE_SECONDS = metrics.histogram(
+    "dify_queue_wait_seconds", "Time waiting for the per-host concurrency limit", ("mode",)
+)
+DIFY_RETRIES = metrics.counter("dify_retries_total", "Dify attempts retried", ("mode",))
+
+
+class DifyError(Exception):
+    """Dify answered with a non-200 status (after retries), or a 200 that is not JSON."""
+
+    def __init__(self, status_code: int, text: str):
+        super().__init__(f"Dify error {status_code}: {text}")
+        self.status_code = status_code
+        self.text = text
+
+
+class DifyConnectionError(Exception):
+    """Dify could not be reached (after retries)."""
+
+
+class DifyClient:
+    def __init__(
+        self,
+        api_key: Optional[str],
+        chat_url: str,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 90.0,
+        max_connections: int = 200,
+        max_keepalive: int = 50,
+        max_concurrency_per_host: int = 100,
+        max_retries: int = 2,
+        backoff_base: float = 0.5,
+        backoff_max: float = 8.0,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.api_key = api_key
+        self.chat_url = chat_url
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive)
+        self.max_concurrency_per_host = max_concurrency_per_host
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.transport = transport
+
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._host_limits: Dict[str, asyncio.Semaphore] = {}
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+        }
+
+    def _ensure_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            # Pools are bound to the loop that created them
+            self._client = httpx.AsyncClient(timeout=self.timeout, limits=self.limits, transport=self.transport)
+            self._loop = loop
+            self._host_limits = {}
+        return self._client
+
+    def _host_limit(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(self.max_concurrency_per_host)
+        return self._host_limits[host]
+
+    def _backoff(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        # Full jitter: uniform(0, base * 2^attempt)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def chat(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """POST a blocking chat-messages request and return the parsed JSON body."""
+        client = self._ensure_client()
+        attempt = 0
+        while True:
+            queued = started = time.perf_counter()
+            try:
+                async with self._host_limit(self.chat_url):
+                    started = time.perf_counter()
+                    DIFY_QUEUE_SECONDS.observe(started - queued, mode="blocking")
+                    response = await client.post(self.chat_url, json=payload, headers=self.headers)
+            except httpx.TransportError as e:
+                DIFY_REQUEST_SECONDS.observe(time.perf_counter() - started, mode="blocking", status="error")
+                if attempt >= self.max_retries:
+                    raise DifyConnectionError(str(e)) from e
+                delay = self._backoff(attempt)
+                logger.warning(f"Dify request error ({e!r}), retry {attempt + 1} in {delay:.2f}s")
+            else:
+                DIFY_REQUEST_SECONDS.observe(
+                    time.perf_counter() - started, mode="blocking", status=response.status_code
+                )
+                if response.status_code == 200:
+                    try:
+                        return response.json()
+                    except ValueError:
+                        # e.g. a proxy's HTML page or a cut-off body: report it as an upstream error
+                        raise DifyError(response.status_code, f"invalid JSON: {response.text[:200]}")
+                if response.status_code not in RETRY_STATUS or attempt >= self.max_retries:
+                    raise DifyError(response.status_code, response.text)
+                delay = self._backoff(attempt, response.headers.get("Retry-After"))
+                logger.warning(f"Dify error {response.status_code}, retry {attempt + 1} in {delay:.2f}s")
+            DIFY_RETRIES.inc(mode="blocking")
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def chat_stream(self, payload: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        """POST a streaming chat-messages request and yield each Dify event (``message``, ``message_end``...)."""
+        client = self._ensure_client()
+        payload = {**payload, "response_mode": "streaming"}
+        attempt = 0
+        first_event = False
+        while True:
+            queued = started = time.perf_counter()
+            status = "error"
+            try:
+                async with self._host_limit(self.chat_url):
+                    started = time.perf_counter()
+                    DIFY_QUEUE_SECONDS.observe(started - queued, mode="streaming")
+                    async with client.stream("POST", self.chat_url, json=payload, headers=self.headers) as response:
+                        status = response.status_code
+                        if response.status_code == 200:
+                            async for line in response.aiter_lines():
+                                if not line.startswith("data:"):
+                                    continue
+                                data = line[5:].strip()
+                                if not data:
+                                    continue
+                                try:
+                                    event = json.loads(data)
+                                except ValueError:
+                                    logger.warning(f"Skipping malformed Dify stream chunk: {data[:200]}")
+                                    continue
+                                first_event = True
+                                yield event
+                            return
+                        text = (await response.aread()).decode("utf-8", "replace")
+                        if response.status_code not in RETRY_STATUS or attempt >= self.max_retries:
+                            raise DifyError(response.status_code, text)
+                        delay = self._backoff(attempt, response.headers.get("Retry-After"))
+                        logger.warning(f"Dify error {response.status_code}, retry {attempt + 1} in {delay:.2f}s")
+            except httpx.TransportError as e:
+                status = "error"
+                if first_event or attempt >= self.max_retries:
+                    raise DifyConnectionError(str(e)) from e
+                delay = self._backoff(attempt)
+                logger.warning(f"Dify request error ({e!r}), retry {attempt + 1} in {delay:.2f}s")
+            finally:
+                # Whole stream, first byte to last event
+                DIFY_REQUEST_SECONDS.observe(time.perf_counter() - started, mode="streaming", status=status)
+            DIFY_RETRIES.inc(mode="streaming")
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            self._loop = None
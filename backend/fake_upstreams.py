@@ -0,0 +1,109 @@
+"""
+Local stand-ins for Dify and the Google Sheet Apps Script.
+
+Used by benchmark.py (in-process, through httpx.ASGITransport) and for local
+load tests against a real server:
+
+    python fake_upstreams.py --port 8081 --latency 0.8 --chunks 20
+    DIFY_API_KEY=fake DIFY_CHAT_URL=http://127.0.0.1:8081/v1/chat-messages \\
+    GOOGLE_SCRIPT_URL=http://127.0.0.1:8081/sheet RATE_LIMIT_PER_MINUTE=0 \\
+    uvicorn main:app --workers 4
+
+- POST /v1/chat-messages: blocking or streaming (SSE) answers after a
+  configurable latency; ``error_rate`` of calls answer 503 (or 429).
+- POST /sheet: accepts a single row or ``{"rows": [...]}`` and counts rows.
+- GET /stats: request counters.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+def create_fake_upstreams(
+    latency: float = 0.05,
+    jitter: float = 0.0,
+    chunks: int = 5,
+    chunk_interval: float = 0.01,
+    error_rate: float = 0.0,
+    seed: int = 0,
+) -> FastAPI:
+    """
+    ``latency`` (+ uniform ``jitter``) seconds before the first byte; streaming
+    answers then send ``chunks`` message events ``chunk_interval`` apart.
+    """
+    app = FastAPI()
+    rng = random.Random(seed)
+    app.state.stats = {"dify_requests": 0, "dify_streams": 0, "dify_errors": 0, "sheet_requests": 0, "sheet_rows": 0}
+
+    def delay() -> float:
+        return latency + (rng.uniform(0, jitter) if jitter else 0)
+
+    @app.post("/v1/chat-messages")
+    async def chat_messages(request: Request):
+        stats = app.state.stats
+        body = await request.json()
+        stats["dify_requests"] += 1
+        await asyncio.sleep(delay())
+        if error_rate and rng.random() < error_rate:
+            stats["dify_errors"] += 1
+            status = rng.choice([429, 503])
+            return JSONResponse({"message": "fake upstream error"}, status_code=status, headers={"Retry-After": "0"})
+
+        conversation_id = body.get("conversation_id") or str(uuid.uuid4())
+        words = [f"Gợi ý {i + 1} cho câu hỏi: {body.get('query', '')[:40]}." for i in range(max(1, chunks))]
+        if body.get("response_mode") != "streaming":
+            return {"answer": " ".join(words), "conversation_id": conversation_id, "message_id": str(uuid.uuid4())}
+
+        stats["dify_streams"] += 1
+
+        async def events():
+            for i, word in enumerate(words):
+                if i:
+                    await asyncio.sleep(chunk_interval)
+                event = {"event": "message", "answer": word + " ", "conversation_id": conversation_id}
+                yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+            end = {"event": "message_end", "conversation_id": conversation_id}
+            yield f"data: {json.dumps(end)}\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.post("/sheet")
+    async def sheet(request: Request):
+        body = await request.json()
+        rows = body.get("rows", [body]) if isinstance(body, dict) else []
+        app.state.stats["sheet_requests"] += 1
+        app.state.stats["sheet_rows"] += len(rows)
+        return {"status": "success", "rows": len(rows)}
+
+    @app.get("/stats")
+    def stats():
+        return app.state.stats
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Fake Dify + Google Sheet endpoints")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds before the first byte")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra uniform random latency (seconds)")
+    parser.add_argument("--chunks", type=int, default=5, help="message events per streamed answer")
+    parser.add_argument("--chunk-interval", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of Dify calls answering 429/503")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    uvicorn.run(
+        create_fake_upstreams(args.latency, args.jitter, args.chunks, args.chunk_interval, args.error_rate, args.seed),
+        host=args.host,
+        port=args.port,
+        log_level="warning",
+    )
@@ -1,6 +1,8 @@
 
 # 100-Job RIASEC Matrix
 # Format: {"name": "Job Name", "code": "R-I-A", "group": "Group Name"}
+# Optional: "profile": {"R": 0.8, "I": 0.6, ...} weighted six-type profile for similarity ranking
+# (defaults to the code weighted 3-2-1 by letter position)
 
 MAJORS_DB = [
       # KỸ THUẬT – CÔNG NGHIỆP – CÔNG NGHỆ
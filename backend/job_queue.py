@@ -0,0 +1,341 @@
+"""
+Durable background jobs for long Dify analyses (POST /run-riasec/jobs).
+
+Jobs live in a SQLite table (WAL, shared by every uvicorn worker), so a client
+can submit to one worker and poll another, and results survive restarts:
+- ``submit`` stores a job under a request key; submitting the same key again
+  returns the existing job (and its stored result) instead of running it twice.
+- ``workers`` asyncio tasks per process claim queued jobs with a lease, the same
+  way the Sheet outbox leases rows; a job whose worker died is picked up again
+  once its lease expires. ``RetryLater`` puts a job back in the queue with a delay,
+  up to ``max_attempts`` runs.
+- ``wait`` long-polls: it returns as soon as the job finishes (woken directly
+  for jobs run by this process, by polling otherwise).
+- A finished job with a ``callback_url`` is POSTed there (the same body as a
+  status read), signed with HMAC-SHA256 when a ``callback_secret`` is set.
+- Finished jobs are deleted ``ttl`` seconds after they complete.
+"""
+
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+JOB_RUNS = metrics.counter("riasec_jobs_total", "Background analysis job runs", ("outcome",))
+JOB_SECONDS = metrics.histogram(
+    "riasec_job_duration_seconds", "Background analysis job time from submit to finish", ("outcome",)
+)
+
+FINISHED = ("done", "error")
+
+
+class RetryLater(Exception):
+    """Raised by a job runner for a transient failure (e.g. Dify overloaded)."""
+
+    def __init__(self, delay: float, message: str = ""):
+        super().__init__(message or f"retry in {delay}s")
+        self.delay = delay
+
+
+class JobQueue:
+    # Finished-job cleanup runs every N claims rather than on every one
+    SWEEP_EVERY = 100
+
+    def __init__(
+        self,
+        db_path: Path,
+        runner: Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]],
+        workers: int = 4,
+        lease: float = 300.0,
+        max_attempts: int = 3,
+        ttl: float = 7 * 86400,
+        poll_interval: float = 1.0,
+        callback_secret: Optional[str] = None,
+        callback_timeout: float = 10.0,
+        callback_attempts: int = 3,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.runner = runner
+        self.workers = max(1, workers)
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.callback_secret = callback_secret
+        self.callback_timeout = callback_timeout
+        self.callback_attempts = callback_attempts
+        self.transport = transport
+
+        self._local = threading.local()
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._finished: Dict[str, asyncio.Event] = {}  # job id -> event, for local long-polls
+        self._claims = 0
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS analysis_jobs ("
+                " id TEXT PRIMARY KEY,"
+                " request_key TEXT UNIQUE,"
+                " status TEXT NOT NULL,"
+                " input TEXT NOT NULL,"
+                " result TEXT,"
+                " error TEXT,"
+                " callback_url TEXT,"
+                " callback_status TEXT,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " created REAL NOT NULL,"
+                " updated REAL NOT NULL,"
+                " next_attempt REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_analysis_jobs_status_next ON analysis_jobs(status, next_attempt)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.db_path), timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    # ----- producer -----
+    def submit(self, job_input: Dict[str, Any], request_key: str, callback_url: Optional[str] = None) -> Tuple[Dict[str, Any], bool]:
+        """(job, created). An existing job with the same key is returned as is, unless it failed."""
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT * FROM analysis_jobs WHERE request_key = ?", (request_key,)).fetchone()
+            if row is not None and row["status"] != "error":
+                conn.execute("COMMIT")
+                return dict(row), False
+            if row is not None:
+                conn.execute("DELETE FROM analysis_jobs WHERE id = ?", (row["id"],))
+            job_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO analysis_jobs (id, request_key, status, input, callback_url, created, updated, next_attempt)"
+                " VALUES (?, ?, 'queued', ?, ?, ?, ?, ?)",
+                (job_id, request_key, json.dumps(job_input, ensure_ascii=False), callback_url, now, now, now),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return self.get(job_id), True
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute("SELECT * FROM analysis_jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    @staticmethod
+    def view(job: Dict[str, Any]) -> Dict[str, Any]:
+        """Public representation: status reads and callback bodies"""
+        body = {
+            "job_id": job["id"],
+            "status": job["status"],
+            "created": job["created"],
+            "updated": job["updated"],
+        }
+        if job["status"] == "done":
+            body["result"] = json.loads(job["result"])
+        elif job["status"] == "error":
+            body["error"] = job["error"]
+        return body
+
+    async def wait(self, job_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """The job once finished, or as it is after ``timeout`` seconds; None if unknown"""
+        deadline = time.monotonic() + timeout
+        job = None
+        event = self._finished.setdefault(job_id, asyncio.Event())
+        try:
+            while True:
+                job = await asyncio.to_thread(self.get, job_id)
+                remaining = deadline - time.monotonic()
+                if job is None or job["status"] in FINISHED or remaining <= 0:
+                    return job
+                try:
+                    # Jobs finished by another worker process are only seen by polling
+                    await asyncio.wait_for(event.wait(), min(remaining, self.poll_interval))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if event.is_set() or job is None or job["status"] in FINISHED:
+                self._finished.pop(job_id, None)
+
+    # ----- consumer -----
+    def _claim(self) -> Optional[Dict[str, Any]]:
+        """Lease the next due job; expired leases of running jobs count as due"""
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT * FROM analysis_jobs WHERE status IN ('queued', 'running') AND next_attempt <= ?"
+                " ORDER BY next_attempt LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE analysis_jobs SET status = 'running', attempts = attempts + 1, updated = ?, next_attempt = ?"
+                    " WHERE id = ?",
+                    (now, now + self.lease, row["id"]),
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self._claims += 1
+        if self._claims % self.SWEEP_EVERY == 0:
+            self.sweep()
+        if row is None:
+            return None
+        job = dict(row)
+        job["attempts"] += 1
+        return job
+
+    def _finish(self, job_id: str, status: str, result: Optional[Dict[str, Any]] = None, error: Optional[str] = None):
+        self._conn().execute(
+            "UPDATE analysis_jobs SET status = ?, result = ?, error = ?, updated = ?,"
+            " callback_status = CASE WHEN callback_url IS NULL THEN NULL ELSE 'pending' END WHERE id = ?",
+            (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error, time.time(), job_id),
+        )
+
+    def _requeue(self, job_id: str, delay: float, error: str):
+        now = time.time()
+        self._conn().execute(
+            "UPDATE analysis_jobs SET status = 'queued', error = ?, updated = ?, next_attempt = ? WHERE id = ?",
+            (error, now, now + delay, job_id),
+        )
+
+    def _set_callback_status(self, job_id: str, status: str):
+        self._conn().execute("UPDATE analysis_jobs SET callback_status = ? WHERE id = ?", (status, job_id))
+
+    async def run_once(self) -> bool:
+        """Claim and run one due job. Returns False when nothing was due."""
+        job = await asyncio.to_thread(self._claim)
+        if job is None:
+            return False
+        if job["attempts"] > self.max_attempts:
+            # Leases keep expiring (the worker dies or hangs on this job): give up
+            await self._complete(job, "error", error=job["error"] or "Job did not finish")
+            return True
+        try:
+            result = await self.runner(json.loads(job["input"]))
+        except asyncio.CancelledError:
+            raise  # shutdown: the lease expires and another worker takes the job
+        except RetryLater as e:
+            if job["attempts"] < self.max_attempts:
+                JOB_RUNS.inc(outcome="retried")
+                logger.warning(f"Analysis job {job['id']} will retry in {e.delay:.0f}s: {e}")
+                await asyncio.to_thread(self._requeue, job["id"], e.delay, str(e))
+                return True
+            await self._complete(job, "error", error=str(e))
+        except Exception as e:
+            logger.error(f"Analysis job {job['id']} failed: {e}")
+            await self._complete(job, "error", error=str(e))
+        else:
+            await self._complete(job, "done", result=result)
+        return True
+
+    async def _complete(self, job: Dict[str, Any], status: str, result=None, error=None):
+        await asyncio.to_thread(self._finish, job["id"], status, result, error)
+        JOB_RUNS.inc(outcome=status)
+        JOB_SECONDS.observe(time.time() - job["created"], outcome=status)
+        event = self._finished.get(job["id"])
+        if event is not None:
+            event.set()
+        if job["callback_url"]:
+            finished = await asyncio.to_thread(self.get, job["id"])
+            await self._callback(finished)
+
+    async def _callback(self, job: Dict[str, Any]):
+        body = json.dumps(self.view(job), ensure_ascii=False).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        if self.callback_secret:
+            digest = hmac.new(self.callback_secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+            headers["X-Signature-256"] = f"sha256={digest}"
+        async with httpx.AsyncClient(timeout=self.callback_timeout, transport=self.transport) as client:
+            for attempt in range(self.callback_attempts):
+                try:
+                    response = await client.post(job["callback_url"], content=body, headers=headers)
+                    if response.status_code < 400:
+                        await asyncio.to_thread(self._set_callback_status, job["id"], "sent")
+                        return
+                    error = f"HTTP {response.status_code}"
+                except httpx.HTTPError as e:
+                    error = repr(e)
+                logger.warning(f"Callback for job {job['id']} failed ({error}), attempt {attempt + 1}")
+                if attempt + 1 < self.callback_attempts:
+                    await asyncio.sleep(2 ** attempt)
+        await asyncio.to_thread(self._set_callback_status, job["id"], "failed")
+
+    async def _worker(self):
+        while True:
+            try:
+                if await self.run_once():
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Analysis job worker error: {e}")
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        self._wakeup = None
+
+    # ----- maintenance / observability -----
+    def sweep(self) -> int:
+        """Delete jobs finished more than ``ttl`` seconds ago"""
+        cursor = self._conn().execute(
+            "DELETE FROM analysis_jobs WHERE status IN ('done', 'error') AND updated < ?", (time.time() - self.ttl,)
+        )
+        return cursor.rowcount
+
+    def stats(self) -> Dict[str, Any]:
+        counts = dict(self._conn().execute("SELECT status, COUNT(*) FROM analysis_jobs GROUP BY status").fetchall())
+        oldest = self._conn().execute("SELECT MIN(created) FROM analysis_jobs WHERE status = 'queued'").fetchone()[0]
+        return {
+            "queued": counts.get("queued", 0),
+            "running": counts.get("running", 0),
+            "done": counts.get("done", 0),
+            "error": counts.get("error", 0),
+            "oldest_queued_seconds": round(time.time() - oldest, 1) if oldest else 0,
+            "workers": len(self._tasks),
+        }
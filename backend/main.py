@@ -1,22 +1,45 @@
 # ... (Keep existing imports and config)
 # ... (Keep existing imports and config)
-from fastapi import FastAPI, HTTPException, Request, BackgroundTasks
+import time
+
+# Cold start is measured from here: the imports below dominate it (see lifespan)
+_IMPORT_STARTED = time.perf_counter()
+
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Request, BackgroundTasks, Query, Header
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
-from pydantic import BaseModel, Field, field_validator
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, field_validator
 from typing import List, Optional, Dict, Any
-import os
-import requests
+import functools
+import hashlib
 import json
+import math
 from pathlib import Path
+from urllib.parse import urlsplit
 import logging
-from dotenv import load_dotenv
+import threading
 import uuid
-from riasec_calculator import calculate_riasec, recommend_jobs
-
-# Load environment variables from .env file
-load_dotenv()
+import asyncio
+from contextlib import asynccontextmanager
+from riasec_calculator import (
+    CURRENT_MAPPING_VERSION, RIASEC_TYPES, ScoreCache, calculate_riasec, calculate_riasec_batch, recommend_jobs, recommend_majors_by_scores, recommendation_index
+)
+from submission_store import InvalidCursor, SubmissionStore
+from dify_client import RETRY_STATUS, DifyClient, DifyConnectionError, DifyError
+from admission import FairAdmission, Overloaded, Slot, TokenBuckets
+from job_queue import JobQueue, RetryLater
+from sheet_outbox import SheetOutbox
+from response_cache import AsyncTTLCache
+from vr_catalog import VRJobCatalog, VRJobConflict, VRJobNotFound, etag_matches
+from submission_store import atomic_write_text
+from analytics import CohortAnalytics
+from static_assets import StaticAssets, StaticAssetsApp
+from storage import SQLiteDatabase, SQLiteSubmissionStore, SQLiteVRJobCatalog, migrate_json_to_sqlite
+from submission_export import EXPORT_FORMATS
+import metrics
+from conversation_store import create_conversation_store, message_window, trim_history
+from settings import Settings
 
 # ... logging setup ...
 logging.basicConfig(level=logging.INFO)
@@ -24,42 +47,7 @@ logger = logging.getLogger(__name__)
 
 # ================== STATIC FILES ==================
 STATIC_DIR = Path(__file__).parent / "static"
-STATIC_DIR.mkdir(exist_ok=True)
-
-# ================== CONFIG ==================
-DIFY_API_KEY = os.getenv("DIFY_API_KEY")
-if not DIFY_API_KEY:
-    # Optional: Log warning instead of crash if you want backend to run even without keys
-    logger.warning("❌ ERROR: DIFY_API_KEY not set. Chat features will not work.")
-    # raise ValueError("❌ ERROR: DIFY_API_KEY not set.") # Keeping it safe to avoid crash on start if user has no env yet? 
-    # User said file was crashing, so likely it raised error.
-    # But wait, lines 36-37 in original file raised ValueError. I will restore it to be safe or just log.
-    # Let's restore strictly.
-
-if not DIFY_API_KEY:
-    logger.error("DIFY_API_KEY not set")
-
-DIFY_CHAT_URL = os.getenv("DIFY_CHAT_URL", "https://api.dify.ai/v1/chat-messages")
-
-# In-memory conversation storage (use Redis/DB in production)
-conversations: Dict[str, Any] = {}
-
-app = FastAPI()
-
-# ... existing CORS ...
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
 
-# ===== PERSISTENCE SETUP =====
-DATA_DIR = Path("backend/data")
-DATA_DIR.mkdir(parents=True, exist_ok=True)
-VR_JOBS_FILE = DATA_DIR / "vr_jobs.json"
-SUBMISSIONS_FILE = DATA_DIR / "submissions.json"
 
 # Models
 class VRJob(BaseModel):
@@ -68,10 +56,13 @@ class VRJob(BaseModel):
     videoId: str
     description: str = ""
     icon: str = "🎬"
+    version: int = 1 # Bumped on every change, used for optimistic concurrency
 
 class Submission(BaseModel):
+    model_config = ConfigDict(populate_by_name=True)
+
     name: str = "Ẩn danh"
-    class_name: str = "-" # Field alias might be needed if frontend sends 'class'
+    class_name: str = Field("-", alias="class") # Frontend sends 'class'
     school: str = "-"
     riasec: List[str]
     scores: Dict[str, int]
@@ -79,9 +70,8 @@ class Submission(BaseModel):
     time: str
     suggestedMajors: str = ""
     combinations: str = ""
-    
-    class Config:
-        fields = {'class_name': 'class'} # Mapped 'class' from JSON to 'class_name'
+    mappingVersion: Optional[str] = None # Question mapping the scores were computed with
+    clientKey: Optional[str] = None # Set by offline clients so re-uploads are de-duplicated
 
 # Data Manager
 class DataManager:
@@ -99,8 +89,8 @@ class DataManager:
     @staticmethod
     def save_json(file_path: Path, data: Any):
         try:
-            with open(file_path, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            # Temp file + rename: a crash never leaves a truncated file behind
+            atomic_write_text(file_path, json.dumps(data, ensure_ascii=False, indent=2))
         except Exception as e:
             logger.error(f"Error writing {file_path}: {e}")
 
@@ -143,93 +133,665 @@ DEFAULT_VR_JOBS = [
       }
 ]
 
-# Ensure defaults exist
-if not VR_JOBS_FILE.exists():
-    DataManager.save_json(VR_JOBS_FILE, DEFAULT_VR_JOBS)
-if not SUBMISSIONS_FILE.exists():
-    DataManager.save_json(SUBMISSIONS_FILE, [])
+
+def validate_vr_jobs(jobs: List[Any]) -> List[Dict[str, Any]]:
+    """Validate catalog entries once at load instead of on every GET"""
+    valid = []
+    for job in jobs:
+        try:
+            valid.append(VRJob.model_validate(job).model_dump())
+        except Exception as e:
+            logger.error(f"Skipping invalid VR job {job!r}: {e}")
+    return valid
+
+
+# ===== RESOURCES =====
+class lazy_resource:
+    """
+    Attribute built on first access, once per Resources instance (thread-safe).
+    The value is stored in the instance dict, so later reads skip the descriptor
+    and tests can replace it with monkeypatch.setattr.
+    """
+
+    def __init__(self, build):
+        self.build = build
+        self.name = build.__name__
+        self.__doc__ = build.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        with instance._lock:
+            if self.name not in instance.__dict__:
+                instance.__dict__[self.name] = self.build(instance)
+        return instance.__dict__[self.name]
+
+
+class Resources:
+    """
+    Stores, clients and caches of one app instance. Nothing is built when the app
+    is created: each resource is constructed (and its files created) on first use,
+    and close() releases only what was built. The lifespan warms the hot ones.
+    """
+
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        self._lock = threading.RLock()
+        # Local stand-in for the sheet (POST /api/dev/sheet-stub); never enable in production
+        self.sheet_stub_rows: List[Dict[str, Any]] = []
+        # Optional hook: summarizer(dropped_messages, previous_summary) -> summary message
+        self.history_summarizer = None
+
+    def built(self, name: str) -> Optional[Any]:
+        """The resource if it has been constructed, without constructing it"""
+        return self.__dict__.get(name)
+
+    @lazy_resource
+    def data_dir(self) -> Path:
+        self.settings.data_dir.mkdir(parents=True, exist_ok=True)
+        return self.settings.data_dir
+
+    @lazy_resource
+    def dify_client(self) -> DifyClient:
+        """Shared async client: keep-alive pool, per-host concurrency cap, retries on 429/5xx"""
+        s = self.settings
+        return DifyClient(
+            s.dify_api_key,
+            s.dify_chat_url,
+            connect_timeout=s.dify_connect_timeout,
+            read_timeout=s.dify_read_timeout,
+            max_connections=s.dify_max_connections,
+            max_concurrency_per_host=s.dify_max_concurrency,
+            max_retries=s.dify_max_retries,
+        )
+
+    @lazy_resource
+    def llm_admission(self) -> FairAdmission:
+        """Concurrency limit and fair queue for Dify calls (see admission.py)"""
+        s = self.settings
+        return FairAdmission(s.llm_max_concurrency, s.llm_max_queue, s.llm_queue_timeout)
+
+    @lazy_resource
+    def user_rate_limit(self) -> Optional[TokenBuckets]:
+        """Token bucket per student (conversation, or name/class/school) on the Dify routes"""
+        s = self.settings
+        return TokenBuckets(s.rate_limit_per_minute, s.rate_limit_burst) if s.rate_limit_per_minute > 0 else None
+
+    @lazy_resource
+    def ip_rate_limit(self) -> Optional[TokenBuckets]:
+        """Token bucket per client IP; off by default since a class often shares one IP"""
+        s = self.settings
+        return TokenBuckets(s.rate_limit_ip_per_minute, s.rate_limit_ip_burst) if s.rate_limit_ip_per_minute > 0 else None
+
+    @lazy_resource
+    def database(self) -> Optional[SQLiteDatabase]:
+        """One WAL database for all workers when STORAGE_BACKEND=sqlite (see storage.py)"""
+        if self.settings.storage_backend != "sqlite":
+            return None
+        self.data_dir  # creates the directory
+        database = SQLiteDatabase(self.settings.database_file)
+        # One-shot import of the JSON files; later starts skip it
+        migrate_json_to_sqlite(
+            database, self.settings.submissions_log_file, self.settings.submissions_file,
+            self.settings.vr_jobs_file, DEFAULT_VR_JOBS, validate=validate_vr_jobs,
+        )
+        return database
+
+    @lazy_resource
+    def vr_catalog(self) -> VRJobCatalog:
+        """In-memory catalog served as pre-serialised bytes with an ETag (see vr_catalog.py)"""
+        if self.database is not None:
+            return SQLiteVRJobCatalog(self.database, DEFAULT_VR_JOBS, validate=validate_vr_jobs)
+        self.data_dir  # creates the directory
+        # Ensure defaults exist
+        if not self.settings.vr_jobs_file.exists():
+            DataManager.save_json(self.settings.vr_jobs_file, DEFAULT_VR_JOBS)
+        return VRJobCatalog(self.settings.vr_jobs_file, DEFAULT_VR_JOBS, validate=validate_vr_jobs)
+
+    @lazy_resource
+    def submission_store(self) -> SubmissionStore:
+        """Append-only submission log (see submission_store.py), or the indexed SQLite table"""
+        if self.database is not None:
+            return SQLiteSubmissionStore(self.database)
+        self.data_dir  # creates the directory
+        return SubmissionStore(
+            self.settings.submissions_log_file,
+            legacy_path=self.settings.submissions_file,
+            fsync_every=self.settings.submissions_fsync_every,
+            fsync_interval=self.settings.submissions_fsync_interval,
+        )
+
+    @lazy_resource
+    def cohort_analytics(self) -> CohortAnalytics:
+        """Cohort aggregates, updated incrementally from the submission log (see analytics.py)"""
+        return CohortAnalytics(self.submission_store, self.data_dir / "analytics_snapshot.json")
+
+    @lazy_resource
+    def conversation_store(self):
+        """Conversation sessions: "memory" (single worker) or "sqlite" (shared by all workers)"""
+        s = self.settings
+        sqlite_backend = s.storage_backend == "sqlite"
+        kind = s.conversation_store or ("sqlite" if sqlite_backend else "memory")
+        if kind == "sqlite":
+            self.data_dir  # creates the directory
+        return create_conversation_store(
+            kind,
+            s.database_file if sqlite_backend else s.data_dir / "conversations.db",
+            ttl=s.conversation_ttl,
+            max_entries=s.conversation_max,
+        )
+
+    @lazy_resource
+    def sheet_outbox(self) -> SheetOutbox:
+        """Google Sheet logging goes through a durable local outbox (see sheet_outbox.py)"""
+        return SheetOutbox(
+            self.data_dir / "sheet_outbox.db",
+            self.settings.google_script_url,
+            # >1 sends {"rows": [...]}; the Apps Script must handle that shape first
+            batch_size=self.settings.sheet_batch_size,
+            flush_interval=self.settings.sheet_flush_interval,
+            max_attempts=self.settings.sheet_max_attempts,
+        )
+
+    @lazy_resource
+    def score_cache(self) -> ScoreCache:
+        """Scores + recommended majors per answer vector, shared by every scoring route"""
+        return ScoreCache(max_entries=self.settings.riasec_score_cache_max)
+
+    @lazy_resource
+    def analysis_cache(self) -> AsyncTTLCache:
+        """Opt-in cache for /run-riasec analyses keyed on the score profile (see analyze_riasec)"""
+        return AsyncTTLCache(max_entries=self.settings.riasec_cache_max, ttl=self.settings.riasec_cache_ttl)
+
+    @lazy_resource
+    def analysis_jobs(self) -> JobQueue:
+        """Stored /run-riasec/jobs analyses and their bounded worker pool (see job_queue.py)"""
+        s = self.settings
+        return JobQueue(
+            s.database_file if s.storage_backend == "sqlite" else self.data_dir / "analysis_jobs.db",
+            functools.partial(run_analysis_job, self),
+            workers=s.riasec_job_workers,
+            ttl=s.riasec_job_ttl,
+            callback_secret=s.riasec_callback_secret,
+        )
+
+    @lazy_resource
+    def static_assets(self) -> StaticAssets:
+        """Hashed URLs, gzip/brotli variants and optional WebP/AVIF images (see static_assets.py)"""
+        return StaticAssets(STATIC_DIR, image_formats=self.settings.static_image_formats)
+
+    def start(self):
+        if not self.settings.dify_api_key:
+            logger.error("DIFY_API_KEY not set. Chat features will not work.")
+        # Precompute all 120 top-3 recommendation entries
+        recommendation_index().warm()
+        # Fingerprint + precompress static files once, before the first page load
+        self.static_assets.build()
+        self.sheet_outbox.start()
+        # Also resumes jobs left queued (or mid-run) by a previous process
+        self.analysis_jobs.start()
+
+    async def close(self):
+        for name in ("analysis_jobs", "sheet_outbox"):
+            worker = self.built(name)
+            if worker is not None:
+                await worker.stop()
+        # Flush batched fsyncs on shutdown
+        for name in ("cohort_analytics", "submission_store", "database"):
+            resource = self.built(name)
+            if resource is not None:
+                resource.close()
+        dify_client = self.built("dify_client")
+        if dify_client is not None:
+            await dify_client.aclose()
+
+def get_resources(request: Request) -> Resources:
+    """Dependency: the Resources of the app serving the request (helpers are passed them explicitly)"""
+    return request.app.state.resources
+
+# Local CPU work on the request path (sub-millisecond buckets)
+SCORING_SECONDS = metrics.histogram(
+    "scoring_duration_seconds",
+    "RIASEC scoring and recommendation time",
+    ("op",),
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1),
+)
+COLD_START_SECONDS = metrics.gauge("app_cold_start_seconds", "Worker cold start: module import and lifespan startup", ("phase",))
+
+def collect_app_metrics(res: Resources):
+    """Queue depths, cache and session counters of one app's resources, read at scrape time"""
+    families = []
+    outbox = res.built("sheet_outbox")
+    if outbox is not None:
+        stats = outbox.stats()
+        families += [
+            ("sheet_outbox_depth", "gauge", "Rows waiting in the Sheet outbox", [({}, stats["depth"])]),
+            ("sheet_outbox_lag_seconds", "gauge", "Age of the oldest queued Sheet row", [({}, stats["lag_seconds"])]),
+            ("sheet_outbox_dead_letters", "gauge", "Sheet rows given up on (outbox_dead table)", [({}, stats["dead_letters"])]),
+        ]
+    scores = res.built("score_cache")
+    if scores is not None:
+        stats = scores.stats()
+        families += [
+            ("riasec_score_cache_entries", "gauge", "Memoized answer vectors", [({}, stats["size"])]),
+            ("riasec_score_cache_lookups_total", "counter", "Scoring memo lookups", [
+                ({"result": "hit"}, stats["hits"]),
+                ({"result": "miss"}, stats["misses"]),
+            ]),
+        ]
+    cache = res.built("analysis_cache")
+    if cache is not None:
+        stats = cache.stats()
+        families += [
+            ("riasec_cache_entries", "gauge", "Cached /run-riasec analyses", [({}, stats["size"])]),
+            ("riasec_cache_lookups_total", "counter", "/run-riasec cache lookups", [
+                ({"result": "hit"}, stats["hits"]),
+                ({"result": "miss"}, stats["misses"]),
+                ({"result": "joined"}, stats["joined_inflight"]),
+            ]),
+        ]
+    jobs = res.built("analysis_jobs")
+    if jobs is not None:
+        stats = jobs.stats()
+        families += [
+            ("riasec_jobs", "gauge", "Background analysis jobs by status", [
+                ({"status": status}, stats[status]) for status in ("queued", "running", "done", "error")
+            ]),
+            ("riasec_jobs_oldest_queued_seconds", "gauge", "Age of the oldest queued analysis job", [
+                ({}, stats["oldest_queued_seconds"]),
+            ]),
+        ]
+    conversations = res.built("conversation_store")
+    if conversations is not None:
+        stats = conversations.stats()
+        families += [
+            ("conversations_active", "gauge", "Conversation sessions stored", [({}, stats["size"])]),
+            ("conversation_lookups_total", "counter", "Conversation store lookups", [
+                ({"result": "hit"}, stats["hits"]),
+                ({"result": "miss"}, stats["misses"]),
+            ]),
+        ]
+    return families
+
+router = APIRouter()
 
 
 # ===== API ROUTES =====
 
-@app.get("/api/vr-jobs", response_model=List[VRJob])
-async def get_vr_jobs():
-    return DataManager.load_json(VR_JOBS_FILE, DEFAULT_VR_JOBS)
+@router.get("/api/vr-jobs", response_model=List[VRJob])
+async def get_vr_jobs(request: Request, res: Resources = Depends(get_resources)):
+    """Served from memory; a matching If-None-Match gets 304 without a body"""
+    body, etag = res.vr_catalog.snapshot()
+    headers = {"ETag": etag, "Cache-Control": res.settings.vr_jobs_cache_control}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
 
-@app.post("/api/vr-jobs")
-async def update_vr_jobs(jobs: List[VRJob]):
-    DataManager.save_json(VR_JOBS_FILE, [job.dict(by_alias=True) for job in jobs])
+@router.post("/api/vr-jobs")
+def update_vr_jobs(jobs: List[VRJob], res: Resources = Depends(get_resources)):
+    """Replace the whole catalog (legacy admin UI); prefer the per-item endpoints below"""
+    res.vr_catalog.replace_all([job.model_dump() for job in jobs])
     return {"status": "success", "count": len(jobs)}
 
-@app.get("/api/submissions", response_model=List[Submission])
-async def get_submissions():
-    return DataManager.load_json(SUBMISSIONS_FILE, [])
+def parse_if_match(if_match: Optional[str]) -> int:
+    """Expected item version from If-Match ("3", W/"3" or 3); required for updates"""
+    if not if_match:
+        raise HTTPException(status_code=428, detail="Thiếu header If-Match (phiên bản nghề)")
+    value = if_match.strip()
+    if value.startswith("W/"):
+        value = value[2:]
+    try:
+        return int(value.strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="If-Match không hợp lệ")
+
+def vr_job_response(job: Dict[str, Any], status_code: int = 200) -> JSONResponse:
+    return JSONResponse(job, status_code=status_code, headers={"ETag": f'"{job["version"]}"'})
+
+def vr_job_conflict(e: VRJobConflict, status_code: int) -> HTTPException:
+    return HTTPException(status_code=status_code, detail={"message": str(e), "current": e.current})
+
+@router.get("/api/vr-jobs/{job_id}")
+def get_vr_job(job_id: str, res: Resources = Depends(get_resources)):
+    try:
+        return vr_job_response(res.vr_catalog.get(job_id))
+    except VRJobNotFound:
+        raise HTTPException(status_code=404, detail="Không tìm thấy nghề")
 
-@app.post("/api/submissions")
-async def add_submission(sub: Submission):
-    current = DataManager.load_json(SUBMISSIONS_FILE, [])
-    # Add new submission
-    current.append(sub.dict(by_alias=True))
-    DataManager.save_json(SUBMISSIONS_FILE, current)
+@router.post("/api/vr-jobs/items", status_code=201)
+def create_vr_job(job: VRJob, res: Resources = Depends(get_resources)):
+    try:
+        return vr_job_response(res.vr_catalog.create(job.model_dump()), status_code=201)
+    except VRJobConflict as e:
+        raise vr_job_conflict(e, 409)
+
+@router.put("/api/vr-jobs/{job_id}")
+def replace_vr_job(job_id: str, job: VRJob, if_match: Optional[str] = Header(None), res: Resources = Depends(get_resources)):
+    """Update one job; If-Match must carry the version the client last saw"""
+    expected = parse_if_match(if_match)
+    try:
+        return vr_job_response(res.vr_catalog.update(job_id, job.model_dump(), expected))
+    except VRJobNotFound:
+        raise HTTPException(status_code=404, detail="Không tìm thấy nghề")
+    except VRJobConflict as e:
+        raise vr_job_conflict(e, 412)
+
+@router.delete("/api/vr-jobs/{job_id}")
+def delete_vr_job(job_id: str, if_match: Optional[str] = Header(None), res: Resources = Depends(get_resources)):
+    expected = parse_if_match(if_match)
+    try:
+        res.vr_catalog.delete(job_id, expected)
+    except VRJobNotFound:
+        raise HTTPException(status_code=404, detail="Không tìm thấy nghề")
+    except VRJobConflict as e:
+        raise vr_job_conflict(e, 412)
     return {"status": "success"}
 
-# ================== HELPERS ==================
-def call_dify_api(payload: Dict[str, Any]) -> Dict[str, Any]:
-    """Helper to call Dify API with error handling"""
-    headers = {
-        "Authorization": f"Bearer {DIFY_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    
+SUBMISSIONS_MAX_PAGE = 1000
+
+@router.get("/api/submissions")
+def get_submissions(
+    limit: Optional[int] = Query(None, ge=1, le=SUBMISSIONS_MAX_PAGE),
+    cursor: Optional[str] = None,
+    school: Optional[str] = None,
+    class_name: Optional[str] = Query(None, alias="class"),
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    top: Optional[str] = Query(None, pattern="^[RIASECriasec]$"),
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+    res: Resources = Depends(get_resources),
+):
+    """
+    List submissions (oldest first), read straight from the log.
+    - No params: full JSON array, as before.
+    - `limit` + `cursor`: one page; the opaque cursor for the next page is in `X-Next-Cursor`.
+      A cursor from before a log compaction (or a forged one) gets 400: restart from the first page.
+    - `school`, `class`, `since`/`until` (ISO time), `top` (top RIASEC letter): server-side filters.
+    - `format=ndjson`: streams one record per line without building the list.
+    Records were validated on write, so raw lines are passed through unchanged.
+    """
+    store = res.submission_store
+    # Taken before reading: if the log is compacted meanwhile, the next cursor is rejected, not misread
+    generation = store.generation()
     try:
-        response = requests.post(
-            DIFY_CHAT_URL,
-            json=payload,
-            headers=headers,
-            timeout=90
-        )
-    except Exception as e:
-        print(f"Dify request error: {str(e)}")
-        raise HTTPException(
-            status_code=500,
-            detail=f"Lỗi kết nối Dify: {str(e)}"
+        offset = store.cursor_offset(cursor) if cursor else 0
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail="Cursor không hợp lệ hoặc đã hết hạn, hãy tải lại từ trang đầu")
+    try:
+        rows = store.select(offset, school=school, class_name=class_name, since=since, until=until, top=top)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Thời gian không hợp lệ: {e}")
+
+    def page():
+        taken = 0
+        for next_offset, raw, _ in rows:
+            yield next_offset, raw
+            taken += 1
+            if limit is not None and taken >= limit:
+                return
+
+    if format == "ndjson":
+        return StreamingResponse(
+            (raw + b"\n" for _, raw in page()),
+            media_type="application/x-ndjson",
         )
-    
-    if response.status_code != 200:
-        print(f"Dify error {response.status_code}: {response.text}")
-        raise HTTPException(
-            status_code=response.status_code,
-            detail=response.text
+
+    lines = []
+    next_cursor = None
+    for next_offset, raw in page():
+        lines.append(raw)
+        next_cursor = next_offset
+    headers = {}
+    # Only advertise a next page when this one was full
+    if limit is not None and len(lines) == limit:
+        headers["X-Next-Cursor"] = store.cursor(generation, next_cursor)
+    return Response(b"[" + b",".join(lines) + b"]", media_type="application/json", headers=headers)
+
+@router.get("/api/submissions/export")
+def export_submissions(
+    format: str = Query("csv", pattern="^(csv|xlsx)$"),
+    school: Optional[str] = None,
+    class_name: Optional[str] = Query(None, alias="class"),
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    top: Optional[str] = Query(None, pattern="^[RIASECriasec]$"),
+    res: Resources = Depends(get_resources),
+):
+    """
+    Download submissions as a spreadsheet (`format=csv` or `xlsx`), with the same
+    filters as GET /api/submissions. Scores, top-3 RIASEC and each answer get their
+    own column. Rows are streamed from the log, so memory does not grow with the export.
+    """
+    try:
+        rows = res.submission_store.select(school=school, class_name=class_name, since=since, until=until, top=top)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Thời gian không hợp lệ: {e}")
+    writer, media_type = EXPORT_FORMATS[format]
+    records = (record for _, _, record in rows)
+    return StreamingResponse(
+        writer(records),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="submissions.{format}"'},
+    )
+
+@router.post("/api/submissions")
+def add_submission(sub: Submission, res: Resources = Depends(get_resources)):
+    # Plain def: the append, periodic fsync and analytics refresh run in the threadpool, off the event loop
+    # Browser scores with the current mapping; tag it so results can be re-scored later
+    if sub.mappingVersion is None:
+        sub.mappingVersion = CURRENT_MAPPING_VERSION
+    # O(1) append, no read-modify-write of the whole history.
+    # A re-sent clientKey is not stored twice (either backend): answer with the stored record
+    record = sub.model_dump(by_alias=True)
+    if not res.submission_store.append(record, "clientKey"):
+        return {"status": "success", "duplicate": True, "submission": res.submission_store.find("clientKey", sub.clientKey)}
+    # Fold the new record (and any from other workers) into the running aggregates
+    res.cohort_analytics.refresh()
+    return {"status": "success"}
+
+def parse_bulk_body(body: bytes, content_type: str) -> List[Any]:
+    """JSON array, or NDJSON (one record per line) when the content type says so"""
+    try:
+        if "ndjson" in content_type or "jsonlines" in content_type:
+            return [json.loads(line) for line in body.splitlines() if line.strip()]
+        items = json.loads(body)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"JSON không hợp lệ: {e}")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="Cần một mảng JSON hoặc NDJSON")
+    return items
+
+def validation_message(e: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(str(p) for p in err['loc'])}: {err['msg']}" for err in e.errors())
+
+@router.post("/api/submissions/bulk")
+async def bulk_add_submissions(request: Request, rescore: bool = False, res: Resources = Depends(get_resources)):
+    """
+    Upload many submissions at once (offline classrooms).
+    Body: a JSON array, or NDJSON with Content-Type application/x-ndjson.
+    - Every record is validated; invalid ones are reported in `errors` and skipped.
+    - `rescore=true` recomputes scores, top-3 and suggested majors with the current mapping;
+      rows without 50 answers from 1 to 5 are reported in `errors`.
+    - Records whose `clientKey` is already stored (or repeated in the batch) are skipped as `duplicates`.
+    Accepted records are committed with a single write.
+    """
+    body = await request.body()
+    # Parsing, validation, scoring, the write and the analytics refresh are all
+    # proportional to the batch: run them in a worker thread, off the event loop
+    return await asyncio.to_thread(
+        ingest_submissions, res, body, request.headers.get("content-type", ""), rescore
+    )
+
+def ingest_submissions(res: Resources, body: bytes, content_type: str, rescore: bool) -> Dict[str, Any]:
+    """Blocking part of the bulk upload; see bulk_add_submissions"""
+    items = parse_bulk_body(body, content_type)
+    if len(items) > res.settings.submissions_bulk_max:
+        raise HTTPException(status_code=413, detail=f"Tối đa {res.settings.submissions_bulk_max} bản ghi mỗi lần")
+
+    errors = []
+    valid = []  # (index, Submission)
+    for i, item in enumerate(items):
+        try:
+            sub = Submission.model_validate(item)
+        except ValidationError as e:
+            errors.append({"index": i, "error": validation_message(e)})
+            continue
+        if rescore:
+            # Same rules as RIASECRequest.validate_answers: bad rows must not reach the scorer
+            if len(sub.answers) != 50:
+                errors.append({"index": i, "error": "khong_du_50_cau"})
+                continue
+            if not all(1 <= ans <= 5 for ans in sub.answers):
+                errors.append({"index": i, "error": "cau_tra_loi_ngoai_1_5"})
+                continue
+        valid.append((i, sub))
+
+    if rescore and valid:
+        # One vectorized pass for the whole batch
+        with SCORING_SECONDS.time(op="calculate_riasec_batch"):
+            results = calculate_riasec_batch([sub.answers for _, sub in valid])
+        with SCORING_SECONDS.time(op="recommend_jobs_batch"):
+            for (_, sub), result in zip(valid, results):
+                sub.scores = result["full_scores"]
+                sub.riasec = result["top_3_list"]
+                sub.suggestedMajors = recommend_jobs(result["top_3_list"])
+                sub.mappingVersion = result["mapping_version"]
+    for _, sub in valid:
+        if sub.mappingVersion is None:
+            sub.mappingVersion = CURRENT_MAPPING_VERSION
+
+    records = [sub.model_dump(by_alias=True) for _, sub in valid]
+    written = res.submission_store.append_many(records, "clientKey")
+    duplicates = [i for (i, _), ok in zip(valid, written) if not ok]
+    res.cohort_analytics.refresh()
+    return {
+        "status": "success",
+        "received": len(items),
+        "accepted": len(valid) - len(duplicates),
+        "duplicates": duplicates,
+        "errors": errors,
+    }
+
+@router.get("/api/analytics")
+def get_analytics(
+    school: Optional[str] = None,
+    class_name: Optional[str] = Query(None, alias="class"),
+    res: Resources = Depends(get_resources),
+):
+    """
+    RIASEC distributions, score mean/percentiles and top suggested majors,
+    overall and per school (or per class within `school`). Served from running
+    counters, so cost does not depend on the number of submissions.
+    """
+    if class_name is not None and school is None:
+        raise HTTPException(status_code=400, detail="Cần chọn trường khi lọc theo lớp")
+    return res.cohort_analytics.report(school=school, class_name=class_name)
+
+# ================== ADMISSION CONTROL ==================
+LLM_OVERLOADED = "Hệ thống AI đang quá tải, vui lòng thử lại sau ít phút"
+
+def client_ip(res: Resources, request: Request) -> str:
+    if res.settings.trust_proxy_headers:
+        # Set by nginx.conf; only trust it when the app is reachable through the proxy alone
+        forwarded = request.headers.get("x-real-ip") or request.headers.get("x-forwarded-for", "").split(",")[0].strip()
+        if forwarded:
+            return forwarded
+    return request.client.host if request.client else "unknown"
+
+async def rate_limit_key(request: Request) -> Optional[str]:
+    """Student a request is for: its conversation, or name/class/school when starting"""
+    try:
+        body = await request.json()
+    except ValueError:
+        return None
+    if not isinstance(body, dict):
+        return None
+    if body.get("conversation_id"):
+        return f"conversation:{body['conversation_id']}"
+    if body.get("name"):
+        return "student:" + "|".join(str(body.get(k, "")).strip().lower() for k in ("name", "class", "school"))
+    return None
+
+async def rate_limit(request: Request, res: Resources = Depends(get_resources)):
+    """Dependency of the Dify-backed routes: 429 + Retry-After once a student (or IP) runs out of tokens"""
+    ip = client_ip(res, request)
+    student = await rate_limit_key(request) or f"ip:{ip}"
+    for limiter, key in ((res.user_rate_limit, student), (res.ip_rate_limit, ip)):
+        if limiter is None:
+            continue
+        wait = limiter.take(key)
+        if wait:
+            raise HTTPException(
+                status_code=429,
+                detail="Bạn gửi yêu cầu quá nhanh, vui lòng thử lại sau",
+                headers={"Retry-After": str(max(1, math.ceil(min(wait, 3600))))},
+            )
+
+async def admit_llm_call(res: Resources, payload: Dict[str, Any]) -> Slot:
+    """Wait for a Dify slot (fair per user); 503 + Retry-After when the queue is full or too slow"""
+    try:
+        return await res.llm_admission.acquire(payload.get("user") or "student")
+    except Overloaded as e:
+        logger.warning(f"Dify call not admitted: {e}")
+        raise HTTPException(status_code=503, detail=LLM_OVERLOADED, headers={"Retry-After": str(e.retry_after)})
+
+# ================== HELPERS ==================
+def require_dify_key(res: Resources):
+    if not res.settings.dify_api_key:
+        raise HTTPException(status_code=500, detail="Lỗi kết nối Dify: DIFY_API_KEY chưa được cấu hình")
+
+def dify_http_error(res: Resources, e: DifyError) -> HTTPException:
+    """Dify's own error text stays in the log; students get a short message"""
+    logger.error(f"Dify error {e.status_code}: {e.text}")
+    if e.status_code in RETRY_STATUS:
+        # Still overloaded after retries: ask the client to come back instead of hammering it
+        return HTTPException(
+            status_code=503,
+            detail=LLM_OVERLOADED,
+            headers={"Retry-After": str(res.llm_admission.retry_after())},
         )
-        
-    return response.json()
+    # A 200 with an unreadable body is still a bad gateway for our client
+    status_code = e.status_code if e.status_code >= 400 else 502
+    return HTTPException(status_code=status_code, detail=f"Lỗi từ dịch vụ AI (Dify {e.status_code})")
+
+async def call_dify_api(res: Resources, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Helper to call Dify API with error handling"""
+    require_dify_key(res)
 
-def send_log_to_sheet(data: Dict[str, Any]):
-    """Background task to send data to Google Sheet"""
-    # Google Script URL provided by user
-    GOOGLE_SCRIPT_URL = "https://script.google.com/macros/s/AKfycbzclNQP90TSF7MuQ_Y6a4TUAmSJjeiu_wLw-DvfamwnB51Rk8JUMDYo_xm9jgsZuflG/exec"
+    with await admit_llm_call(res, payload):
+        try:
+            return await res.dify_client.chat(payload)
+        except DifyConnectionError as e:
+            logger.error(f"Dify request error: {e}")
+            raise HTTPException(
+                status_code=500,
+                detail=f"Lỗi kết nối Dify: {str(e)}"
+            ) from e
+        except DifyError as e:
+            raise dify_http_error(res, e)
+
+def send_log_to_sheet(res: Resources, data: Dict[str, Any]):
+    """Background task: queue a row for the Google Sheet (delivered by the outbox worker)"""
+    # Construct payload matching the Google Apps Script expectation
+    payload = {
+        "name": data.get("name"),
+        "class": data.get("class"),
+        "school": data.get("school"),
+        "R": data.get("riasec_scores", {}).get("R"),
+        "I": data.get("riasec_scores", {}).get("I"),
+        "A": data.get("riasec_scores", {}).get("A"),
+        "S": data.get("riasec_scores", {}).get("S"),
+        "E": data.get("riasec_scores", {}).get("E"),
+        "C": data.get("riasec_scores", {}).get("C"),
+        "top_riasec": ",".join(data.get("top_3_types", [])),
+        "nganh_de_xuat": data.get("nganh_de_xuat"),
+        "khoi_thi": "A00, A01" # Placeholder or logic for khoi_thi could be added later
+    }
     
     try:
-        # Construct payload matching the Google Apps Script expectation
-        payload = {
-            "name": data.get("name"),
-            "class": data.get("class"),
-            "school": data.get("school"),
-            "R": data.get("riasec_scores", {}).get("R"),
-            "I": data.get("riasec_scores", {}).get("I"),
-            "A": data.get("riasec_scores", {}).get("A"),
-            "S": data.get("riasec_scores", {}).get("S"),
-            "E": data.get("riasec_scores", {}).get("E"),
-            "C": data.get("riasec_scores", {}).get("C"),
-            "top_riasec": ",".join(data.get("top_3_types", [])),
-            "nganh_de_xuat": data.get("nganh_de_xuat"),
-            "khoi_thi": "A00, A01" # Placeholder or logic for khoi_thi could be added later
-        }
-        
-        requests.post(GOOGLE_SCRIPT_URL, json=payload, timeout=10)
-        print(f"✅ Logged to Google Sheet: {data.get('name')}")
+        res.sheet_outbox.enqueue(payload)
     except Exception as e:
-        print(f"❌ Failed to log to Google Sheet: {str(e)}")
+        logger.error(f"❌ Failed to queue Google Sheet log: {str(e)}")
 
 # ================== SCHEMA ==================
 class RIASECRequest(BaseModel):
@@ -254,39 +816,106 @@ class RIASECRequest(BaseModel):
             raise ValueError("Các câu trả lời phải từ 1 đến 5")
         return v
 
+class RIASECJobRequest(RIASECRequest):
+    # POSTed the finished job (see job_queue.py); host must be listed in RIASEC_CALLBACK_HOSTS
+    callback_url: Optional[str] = None
+
 class StartConversationRequest(RIASECRequest):
     initial_question: str = "Hãy giới thiệu về các hướng nghiệp phù hợp cho tôi"
 
+class MajorSimilarityRequest(BaseModel):
+    scores: Dict[str, float]
+    k: int = Field(3, ge=1, le=100)
+    groups: Optional[List[str]] = None
+
+    @field_validator("scores")
+    @classmethod
+    def check_types(cls, v):
+        if set(v) - set(RIASEC_TYPES):
+            raise ValueError("Điểm chỉ gồm các nhóm R, I, A, S, E, C")
+        return v
+
 class ChatMessage(BaseModel):
     conversation_id: str
     message: str
+    # Optional history window to return with the reply (absolute message index)
+    since: Optional[int] = Field(None, ge=0)
+    limit: Optional[int] = Field(None, ge=1, le=200)
 
 # ================== API ==================
-@app.get("/health")
+@router.get("/health")
 def health_check():
     """Health check endpoint"""
     return {"status": "ok", "message": "CareerGo - Hành trình hướng nghiệp số backend is running"}
 
-@app.get("/")
-def serve_index():
-    """Serve main app (index_redesigned_v2.html)"""
-    index_file = STATIC_DIR / "index_redesigned_v2.html"
-    if index_file.exists():
-        return FileResponse(index_file, media_type="text/html")
-    return {"error": "Main app not found. Place index_redesigned_v2.html in backend/static/"}
+@router.post("/api/recommend-majors")
+def recommend_majors(data: MajorSimilarityRequest):
+    """Top-k majors by similarity of the full six-score profile, optionally filtered by group"""
+    with SCORING_SECONDS.time(op="recommend_majors_by_scores"):
+        majors = recommend_majors_by_scores(data.scores, k=data.k, groups=data.groups)
+    return {"majors": majors}
 
-# ================== MOUNT STATIC FILES ==================
-app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
+@router.get("/api/sheet-outbox/stats")
+def sheet_outbox_stats(res: Resources = Depends(get_resources)):
+    """Google Sheet outbox depth, lag and delivery counters"""
+    return res.sheet_outbox.stats()
 
-@app.post("/start-conversation")
-def start_conversation(data: StartConversationRequest, background_tasks: BackgroundTasks):
-    """Start a new conversation session"""
-    
+@router.post("/api/dev/sheet-stub")
+async def sheet_stub(request: Request, res: Resources = Depends(get_resources)):
+    """Stand-in for the Google Apps Script in tests/benchmarks (SHEET_STUB_ENABLED=1)"""
+    if not res.settings.sheet_stub_enabled:
+        raise HTTPException(status_code=404, detail="Not Found")
+    body = await request.json()
+    res.sheet_stub_rows.extend(body["rows"] if isinstance(body, dict) and "rows" in body else [body])
+    return {"status": "success"}
+
+@router.get("/api/dev/sheet-stub")
+def sheet_stub_rows_list(res: Resources = Depends(get_resources)):
+    if not res.settings.sheet_stub_enabled:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return res.sheet_stub_rows
+
+@router.get("/api/riasec-cache/stats")
+def riasec_cache_stats(res: Resources = Depends(get_resources)):
+    """/run-riasec analysis cache counters"""
+    return {"enabled": res.settings.riasec_cache_enabled, **res.analysis_cache.stats()}
+
+@router.get("/api/scoring/stats")
+def scoring_stats(res: Resources = Depends(get_resources)):
+    """Memoized scoring: answer vectors cached, hits and misses"""
+    return res.score_cache.stats()
+
+@router.get("/api/llm-admission/stats")
+def llm_admission_stats(res: Resources = Depends(get_resources)):
+    """Dify calls in flight and queued in this worker, and the current Retry-After estimate"""
+    return res.llm_admission.stats()
+
+@router.get("/api/conversations/stats")
+def conversation_stats(res: Resources = Depends(get_resources)):
+    """Conversation store size, hit rate, evictions and expirations"""
+    return res.conversation_store.stats()
+
+@router.get("/metrics")
+def prometheus_metrics(res: Resources = Depends(get_resources)):
+    """Prometheus text format: HTTP, Dify, Sheet outbox, scoring and cache metrics of this worker"""
+    return Response(metrics.REGISTRY.render(collect_app_metrics(res)), media_type=metrics.CONTENT_TYPE)
+
+@router.get("/")
+def serve_index(request: Request, res: Resources = Depends(get_resources)):
+    """Serve main app (index_redesigned_v2.html), compressed, with asset links pointing at hashed URLs"""
+    asset = res.static_assets.get("index_redesigned_v2.html")
+    if asset is not None:
+        return res.static_assets.response(asset, request, immutable=False)
+    return {"error": "Main app not found. Place index_redesigned_v2.html in backend/static/"}
+
+# ================== CONVERSATION HELPERS ==================
+def prepare_start_conversation(res: Resources, data: StartConversationRequest):
+    """Score answers and build the Dify payload + Sheet log row for a new conversation"""
     # Calculate RIASEC scores
     try:
-        riasec_result = calculate_riasec(json.dumps(data.answers_json))
-        # Calculate recommended job locally
-        recommended_job = recommend_jobs(riasec_result["top_3_list"])
+        # Calculate recommended job locally; both are memoized per answer vector
+        with SCORING_SECONDS.time(op="calculate_riasec"):
+            riasec_result, recommended_job = res.score_cache.score(data.answers_json)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Lỗi tính toán RIASEC: {str(e)}")
     
@@ -309,7 +938,6 @@ def start_conversation(data: StartConversationRequest, background_tasks: Backgro
         "user": data.name.strip() or "student"
     }
     
-    # Trigger Background Logging
     log_data = {
         "name": data.name,
         "class": data.class_,
@@ -318,27 +946,17 @@ def start_conversation(data: StartConversationRequest, background_tasks: Backgro
         "top_3_types": riasec_result["top_3_list"],
         "nganh_de_xuat": recommended_job
     }
-    background_tasks.add_task(send_log_to_sheet, log_data)
-    
-    try:
-        dify_result = call_dify_api(payload)
-    except Exception:
-        # If Dify fails here, we shouldn't create the conversation
-        raise
+    return riasec_result, payload, log_data
 
-    ai_message = dify_result.get("answer", "")
-    dify_conv_id = dify_result.get("conversation_id")
-    
-    # Create and store conversation session
+def create_conversation(res: Resources, data: StartConversationRequest, riasec_result: Dict[str, Any], ai_message: str, dify_conv_id: Optional[str]) -> str:
+    """Create and store conversation session, returns its id"""
     conversation_id = str(uuid.uuid4())
-    conversations[conversation_id] = {
+    res.conversation_store.put(conversation_id, {
         "name": data.name,
         "class": data.class_,
         "school": data.school,
         "riasec_scores": riasec_result["full_scores"],
         "top_3_types": riasec_result["top_3_list"],
-        "riasec_scores": riasec_result["full_scores"],
-        "top_3_types": riasec_result["top_3_list"],
         "top_1_type": riasec_result["top_1_type"],
         "answers_json": data.answers_json,
         "messages": [
@@ -346,30 +964,19 @@ def start_conversation(data: StartConversationRequest, background_tasks: Backgro
             {"role": "assistant", "content": ai_message}
         ],
         "dify_conversation_id": dify_conv_id
-    }
-    
-    return {
-        "conversation_id": conversation_id,
-        "riasec_scores": riasec_result["full_scores"],
-        "top_3_types": riasec_result["top_3_list"],
-        "ai_response": ai_message
-    }
+    })
+    return conversation_id
 
-@app.post("/chat")
-def chat(data: ChatMessage):
-    """Continue conversation"""
-    conversation_id = data.conversation_id
-    
-    if conversation_id not in conversations:
+def prepare_chat(res: Resources, data: ChatMessage):
+    """Look up the conversation and build the Dify payload for the next turn"""
+    conv = res.conversation_store.get(data.conversation_id)
+    if conv is None:
         raise HTTPException(status_code=404, detail="Conversation không tồn tại")
     
-    conv = conversations[conversation_id]
-    
     # Prepare Dify payload with added RIASEC type
     scores_for_dify = conv["riasec_scores"].copy()
     scores_for_dify["riasec_type"] = "-".join(conv["top_3_types"])
     
-    # Send message to Dify
     payload = {
         "inputs": {
             "name": conv["name"],
@@ -384,59 +991,277 @@ def chat(data: ChatMessage):
         "conversation_id": conv["dify_conversation_id"],
         "user": conv["name"].strip() or "student"
     }
+    return conv, payload
+
+def record_chat_turn(res: Resources, conversation_id: str, message: str, ai_message: str) -> Dict[str, Any]:
+    """Store the new turn and return the updated session"""
+    turn = [{"role": "user", "content": message}, {"role": "assistant", "content": ai_message}]
+    trim = functools.partial(
+        trim_history, max_messages=res.settings.conversation_max_messages, summarizer=res.history_summarizer
+    )
+    # Appended in one step by the store: a concurrent turn (another worker) is never lost
+    conv = res.conversation_store.append_turn(conversation_id, turn, trim)
+    if conv is None:
+        raise HTTPException(status_code=404, detail="Conversation không tồn tại")
+    return conv
+
+# ================== SSE STREAMING ==================
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",  # nginx: flush each event instead of buffering
+}
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """Holds a Dify admission slot until the stream ends, fails or the client goes away"""
+
+    def __init__(self, *args, slot: Slot, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.slot = slot
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.slot.release()
+
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def relay_dify_stream(res: Resources, payload: Dict[str, Any], on_complete, first: Optional[Dict[str, Any]] = None):
+    """
+    Proxy Dify streaming events to the browser as SSE.
+    Emits `start` (optional), one `message` per answer chunk, then `end` with the
+    result of on_complete(answer, dify_conversation_id), run in a worker thread, and the time-to-first-token.
+    Upstream failures are reported as an `error` event since headers are already sent.
+    """
+    if first is not None:
+        yield sse_event("start", first)
+
+    started = time.perf_counter()
+    ttft_ms = None
+    chunks: List[str] = []
+    dify_conv_id = payload.get("conversation_id")
+    try:
+        async for event in res.dify_client.chat_stream(payload):
+            kind = event.get("event")
+            dify_conv_id = event.get("conversation_id") or dify_conv_id
+            if kind in ("message", "agent_message"):
+                chunk = event.get("answer", "")
+                if ttft_ms is None:
+                    ttft_ms = round((time.perf_counter() - started) * 1000, 1)
+                    logger.info(f"Dify time-to-first-token: {ttft_ms} ms")
+                chunks.append(chunk)
+                yield sse_event("message", {"answer": chunk})
+            elif kind == "error":
+                raise DifyError(event.get("status", 500), event.get("message", ""))
+    except DifyConnectionError as e:
+        logger.error(f"Dify request error: {e}")
+        yield sse_event("error", {"detail": f"Lỗi kết nối Dify: {str(e)}"})
+        return
+    except DifyError as e:
+        error = dify_http_error(res, e)
+        yield sse_event("error", {"status": error.status_code, "detail": error.detail})
+        return
+
+    try:
+        # Stores the conversation: blocking store calls stay off the event loop
+        result = await asyncio.to_thread(on_complete, "".join(chunks), dify_conv_id)
+    except HTTPException as e:
+        yield sse_event("error", {"status": e.status_code, "detail": e.detail})
+        return
+    result["ttft_ms"] = ttft_ms
+    result["total_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    yield sse_event("end", result)
+
+@router.post("/start-conversation", dependencies=[Depends(rate_limit)])
+async def start_conversation(data: StartConversationRequest, background_tasks: BackgroundTasks, res: Resources = Depends(get_resources)):
+    """Start a new conversation session"""
+    riasec_result, payload, log_data = prepare_start_conversation(res, data)
     
-    dify_result = call_dify_api(payload)
-    ai_message = dify_result.get("answer", "")
+    # Trigger Background Logging
+    background_tasks.add_task(send_log_to_sheet, res, log_data)
     
-    # Store messages
-    conv["messages"].append({"role": "user", "content": data.message})
-    conv["messages"].append({"role": "assistant", "content": ai_message})
+    # If Dify fails here, we shouldn't create the conversation
+    dify_result = await call_dify_api(res, payload)
+
+    ai_message = dify_result.get("answer", "")
+    conversation_id = await asyncio.to_thread(
+        create_conversation, res, data, riasec_result, ai_message, dify_result.get("conversation_id")
+    )
     
     return {
         "conversation_id": conversation_id,
-        "ai_response": ai_message,
-        "messages": conv["messages"]
+        "riasec_scores": riasec_result["full_scores"],
+        "top_3_types": riasec_result["top_3_list"],
+        "ai_response": ai_message
     }
 
-@app.post("/run-riasec")
-def run_riasec(data: RIASECRequest):
-    """
-    Legacy endpoint for RIASEC calculation + Dify Analysis.
-    Standardized to match other endpoints.
-    """
+@router.post("/start-conversation/stream", dependencies=[Depends(rate_limit)])
+async def start_conversation_stream(data: StartConversationRequest, background_tasks: BackgroundTasks, res: Resources = Depends(get_resources)):
+    """Streaming variant of /start-conversation (Server-Sent Events)"""
+    require_dify_key(res)
+    riasec_result, payload, log_data = prepare_start_conversation(res, data)
+    background_tasks.add_task(send_log_to_sheet, res, log_data)
+
+    def on_complete(ai_message: str, dify_conv_id: Optional[str]) -> Dict[str, Any]:
+        conversation_id = create_conversation(res, data, riasec_result, ai_message, dify_conv_id)
+        return {"conversation_id": conversation_id, "ai_response": ai_message}
+
+    first = {
+        "riasec_scores": riasec_result["full_scores"],
+        "top_3_types": riasec_result["top_3_list"],
+    }
+    # Admitted before the headers go out, so an overload is still a plain 503
+    slot = await admit_llm_call(res, payload)
+    return AdmittedStreamingResponse(
+        relay_dify_stream(res, payload, on_complete, first),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS,
+        slot=slot,
+    )
+
+@router.post("/chat", dependencies=[Depends(rate_limit)])
+async def chat(data: ChatMessage, res: Resources = Depends(get_resources)):
+    """Continue conversation"""
+    # Store calls block (SQLite): run them in the threadpool
+    _, payload = await asyncio.to_thread(prepare_chat, res, data)
     
-    # Calculate RIASEC scores
-    try:
-        riasec_result = calculate_riasec(json.dumps(data.answers_json))
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Lỗi tính toán RIASEC: {str(e)}")
+    dify_result = await call_dify_api(res, payload)
+    ai_message = dify_result.get("answer", "")
+    
+    conv = await asyncio.to_thread(record_chat_turn, res, data.conversation_id, data.message, ai_message)
+    
+    # Only the new turn by default, so the payload doesn't grow with the session
+    if data.since is None and data.limit is None:
+        messages = conv["messages"][-2:]
+    elif data.since is None:
+        messages = conv["messages"][-data.limit:]
+    else:
+        messages = message_window(conv, data.since, data.limit)["messages"]
+    
+    return {
+        "conversation_id": data.conversation_id,
+        "ai_response": ai_message,
+        "messages": messages
+    }
+
+@router.get("/conversations/{conversation_id}/messages")
+def get_conversation_messages(
+    conversation_id: str,
+    offset: Optional[int] = Query(None, ge=0),
+    limit: int = Query(50, ge=1, le=200),
+    res: Resources = Depends(get_resources),
+):
+    """Paginated chat history; pass `next_offset` back as `offset` for the next page"""
+    conv = res.conversation_store.get(conversation_id)
+    if conv is None:
+        raise HTTPException(status_code=404, detail="Conversation không tồn tại")
+    return {"conversation_id": conversation_id, **message_window(conv, offset, limit)}
+
+@router.post("/chat/stream", dependencies=[Depends(rate_limit)])
+async def chat_stream(data: ChatMessage, res: Resources = Depends(get_resources)):
+    """Streaming variant of /chat (Server-Sent Events)"""
+    require_dify_key(res)
+    _, payload = await asyncio.to_thread(prepare_chat, res, data)
+
+    def on_complete(ai_message: str, dify_conv_id: Optional[str]) -> Dict[str, Any]:
+        record_chat_turn(res, data.conversation_id, data.message, ai_message)
+        return {"conversation_id": data.conversation_id, "ai_response": ai_message}
+
+    slot = await admit_llm_call(res, payload)
+    return AdmittedStreamingResponse(
+        relay_dify_stream(res, payload, on_complete),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS,
+        slot=slot,
+    )
 
+# ================== RIASEC ANALYSIS ==================
+ANALYSIS_QUERY = (
+    "Dựa trên thông tin học sinh và kết quả trắc nghiệm RIASEC, "
+    "hãy phân tích và đưa ra bản tư vấn hướng nghiệp rõ ràng, "
+    "phù hợp với học sinh THPT Việt Nam."
+)
+
+# Placeholders sent to Dify instead of personal fields when the analysis cache is on,
+# then replaced with the real values in the cached text
+ANALYSIS_PLACEHOLDERS = {"name": "{ten_hoc_sinh}", "class": "{lop}", "school": "{truong}"}
+
+def build_analysis_payload(name: str, class_: str, school: str, riasec_result: Dict[str, Any], user: str) -> Dict[str, Any]:
     # Prepare Dify payload with added RIASEC type
     scores_for_dify = riasec_result["full_scores"].copy()
     scores_for_dify["riasec_type"] = "-".join(riasec_result["top_3_list"])
 
-    # Send to Dify
-    payload = {
+    return {
         "inputs": {
-            "name": data.name,
-            "class": data.class_,
-            "school": data.school,
+            "name": name,
+            "class": class_,
+            "school": school,
             "answer": json.dumps(scores_for_dify, ensure_ascii=False),
             "riasec_scores": json.dumps(scores_for_dify, ensure_ascii=False),
             "top_3_types": ",".join(riasec_result["top_3_list"])
         },
-        "query": (
-            "Dựa trên thông tin học sinh và kết quả trắc nghiệm RIASEC, "
-            "hãy phân tích và đưa ra bản tư vấn hướng nghiệp rõ ràng, "
-            "phù hợp với học sinh THPT Việt Nam."
-        ),
+        "query": ANALYSIS_QUERY,
         "response_mode": "blocking",
-        "user": data.name.strip() or "student"
+        "user": user
     }
 
-    dify_result = call_dify_api(payload)
-    text_output = dify_result.get("answer", "")
+class AnalysisNotTemplated(Exception):
+    """Dify dropped or rewrote a placeholder, so its answer cannot be shared between students"""
+
+def analysis_user(data: RIASECRequest) -> str:
+    # Dify "user" and admission key: the student the analysis is for
+    return data.name.strip() or "student"
+
+async def personal_analysis(res: Resources, data: RIASECRequest, riasec_result: Dict[str, Any]) -> str:
+    payload = build_analysis_payload(data.name, data.class_, data.school, riasec_result, analysis_user(data))
+    dify_result = await call_dify_api(res, payload)
+    return dify_result.get("answer", "")
+
+async def analyze_riasec(res: Resources, data: RIASECRequest, riasec_result: Dict[str, Any]) -> str:
+    """Dify analysis text for a scored student, served from the cache when enabled"""
+    if not res.settings.riasec_cache_enabled:
+        return await personal_analysis(res, data, riasec_result)
+
+    # Same scores + top-3 (+ mapping) => same prompt, so one Dify call serves them all
+    key = (
+        tuple(riasec_result["full_scores"][t] for t in RIASEC_TYPES),
+        tuple(riasec_result["top_3_list"]),
+        riasec_result.get("mapping_version"),
+    )
+
+    async def compute() -> str:
+        payload = build_analysis_payload(
+            ANALYSIS_PLACEHOLDERS["name"], ANALYSIS_PLACEHOLDERS["class"], ANALYSIS_PLACEHOLDERS["school"],
+            riasec_result, analysis_user(data)
+        )
+        dify_result = await call_dify_api(res, payload)
+        template = dify_result.get("answer", "")
+        if not all(placeholder in template for placeholder in ANALYSIS_PLACEHOLDERS.values()):
+            raise AnalysisNotTemplated()
+        return template
 
+    try:
+        template = await res.analysis_cache.get_or_compute(key, compute)
+    except AnalysisNotTemplated:
+        # Not cached; this student gets an answer written for them instead
+        logger.warning("Dify answer lost the analysis placeholders, falling back to a personal call")
+        return await personal_analysis(res, data, riasec_result)
+    return (
+        template.replace(ANALYSIS_PLACEHOLDERS["name"], data.name)
+        .replace(ANALYSIS_PLACEHOLDERS["class"], data.class_)
+        .replace(ANALYSIS_PLACEHOLDERS["school"], data.school)
+    )
+
+def score_riasec_request(res: Resources, data: RIASECRequest) -> Dict[str, Any]:
+    # Calculate RIASEC scores
+    try:
+        with SCORING_SECONDS.time(op="calculate_riasec"):
+            return res.score_cache.score(data.answers_json)[0]
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Lỗi tính toán RIASEC: {str(e)}")
+
+def riasec_response(text_output: str, riasec_result: Dict[str, Any]) -> Dict[str, Any]:
     # Standardized flat response (removes nested "data.outputs")
     return {
         "text": text_output,
@@ -445,3 +1270,132 @@ def run_riasec(data: RIASECRequest):
         "top_1_type": riasec_result["top_1_type"]
     }
 
+@router.post("/run-riasec", dependencies=[Depends(rate_limit)])
+async def run_riasec(data: RIASECRequest, res: Resources = Depends(get_resources)):
+    """
+    Legacy endpoint for RIASEC calculation + Dify Analysis.
+    Standardized to match other endpoints.
+    """
+    riasec_result = score_riasec_request(res, data)
+    text_output = await analyze_riasec(res, data, riasec_result)
+    return riasec_response(text_output, riasec_result)
+
+# ================== RIASEC ANALYSIS JOBS ==================
+def check_callback_url(res: Resources, url: Optional[str]):
+    """Only http(s) URLs on allow-listed hosts: the server must not be usable to reach arbitrary hosts"""
+    if url is None:
+        return
+    parts = urlsplit(url)
+    allowed = res.settings.riasec_callback_hosts
+    if parts.scheme not in ("http", "https") or (parts.hostname or "").lower() not in allowed:
+        raise HTTPException(status_code=400, detail="callback_url không được phép")
+
+def analysis_request_key(data: RIASECRequest, idempotency_key: Optional[str]) -> str:
+    """Same student + answers (or the same Idempotency-Key) => same job"""
+    if idempotency_key:
+        return f"key:{idempotency_key}"
+    identity = [data.name, data.class_, data.school, data.answers_json, CURRENT_MAPPING_VERSION]
+    return "req:" + hashlib.sha256(json.dumps(identity, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+async def run_analysis_job(res: Resources, job_input: Dict[str, Any]) -> Dict[str, Any]:
+    """Job runner: the /run-riasec analysis for an already scored request"""
+    data = RIASECRequest.model_validate(job_input["request"])
+    riasec_result = job_input["riasec"]
+    try:
+        text_output = await analyze_riasec(res, data, riasec_result)
+    except HTTPException as e:
+        if e.status_code == 503 or isinstance(e.__cause__, DifyConnectionError):
+            # Overloaded, unreachable or timed out: back off instead of failing the job.
+            # Anything else (bad key, rejected request...) would fail the same way again
+            retry_after = float((e.headers or {}).get("Retry-After", 10))
+            raise RetryLater(retry_after, str(e.detail))
+        raise RuntimeError(str(e.detail))
+    return riasec_response(text_output, riasec_result)
+
+def riasec_job_response(job: Dict[str, Any], status_code: int = 200) -> JSONResponse:
+    headers = {"Location": f"/run-riasec/jobs/{job['id']}"}
+    return JSONResponse(JobQueue.view(job), status_code=status_code, headers=headers)
+
+@router.post("/run-riasec/jobs", dependencies=[Depends(rate_limit)])
+async def submit_riasec_job(data: RIASECJobRequest, idempotency_key: Optional[str] = Header(None), res: Resources = Depends(get_resources)):
+    """
+    Async variant of /run-riasec for clients and proxies that cannot hold a
+    connection open for the whole Dify analysis.
+    - Returns 202 with `job_id` at once; the analysis runs on a bounded worker pool.
+    - Poll GET /run-riasec/jobs/{job_id} (add `wait=` seconds to long-poll) until
+      `status` is `done` (`result` has the /run-riasec response) or `error`.
+    - Optional `callback_url` receives the finished job as a POST.
+    - Submitting the same student and answers again (or the same Idempotency-Key)
+      returns the existing job with 200, so a reconnecting client never causes a second Dify call.
+    """
+    require_dify_key(res)
+    check_callback_url(res, data.callback_url)
+    riasec_result = score_riasec_request(res, data)
+    job_input = {"request": data.model_dump(by_alias=True, exclude={"callback_url"}), "riasec": riasec_result}
+    job, created = await asyncio.to_thread(
+        res.analysis_jobs.submit, job_input, analysis_request_key(data, idempotency_key), data.callback_url
+    )
+    return riasec_job_response(job, status_code=202 if created else 200)
+
+@router.get("/run-riasec/jobs/{job_id}")
+async def get_riasec_job(job_id: str, wait: float = Query(0, ge=0, le=120), res: Resources = Depends(get_resources)):
+    """Job status; with `wait`, held open until the job finishes (capped by RIASEC_JOB_MAX_WAIT)"""
+    job = await res.analysis_jobs.wait(job_id, min(wait, res.settings.riasec_job_max_wait))
+    if job is None:
+        raise HTTPException(status_code=404, detail="Không tìm thấy yêu cầu phân tích")
+    return riasec_job_response(job)
+
+@router.get("/api/riasec-jobs/stats")
+def riasec_job_stats(res: Resources = Depends(get_resources)):
+    """Background analysis jobs by status and the age of the oldest queued one"""
+    return res.analysis_jobs.stats()
+
+# ================== APP FACTORY ==================
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    res = app.state.resources
+    started = time.perf_counter()
+    res.start()
+    startup = time.perf_counter() - started
+    COLD_START_SECONDS.set(IMPORT_SECONDS, phase="import")
+    COLD_START_SECONDS.set(startup, phase="startup")
+    total_ms = (IMPORT_SECONDS + startup) * 1000
+    budget_ms = res.settings.startup_budget_ms
+    log = logger.warning if total_ms > budget_ms else logger.info
+    log(f"Cold start {total_ms:.0f} ms (import {IMPORT_SECONDS * 1000:.0f} ms, startup {startup * 1000:.0f} ms; budget {budget_ms:.0f} ms)")
+    yield
+    await res.close()
+
+def create_app(settings: Optional[Settings] = None) -> FastAPI:
+    """
+    Build an app with its own Resources (read from the environment unless
+    `settings` is given). Creating an app touches no files and opens no
+    connections, and apps in one process share nothing: handlers reach their
+    app's Resources through `request.app.state.resources`.
+    """
+    resources = Resources(settings if settings is not None else Settings.from_env())
+
+    app = FastAPI(lifespan=lifespan)
+    app.state.resources = resources
+
+    # ... existing CORS ...
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+        expose_headers=["X-Next-Cursor", "ETag"],
+    )
+    # Per-route latency/status histograms and in-flight gauge for /metrics; ACCESS_LOG_JSON=1 adds JSON access logs
+    app.add_middleware(metrics.MetricsMiddleware, access_log=resources.settings.access_log_json)
+
+    app.include_router(router)
+    # Built assets first; StaticFiles serves anything added after startup
+    static_files = StaticFiles(directory=str(STATIC_DIR), check_dir=False)
+    app.mount("/static", StaticAssetsApp(resources.static_assets, static_files), name="static")
+    return app
+
+app = create_app()
+
+IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED
@@ -0,0 +1,253 @@
+"""
+In-process metrics in the Prometheus text format (no client library needed).
+
+- Counter / Gauge / Histogram with fixed label names; create them at module
+  level where they are used (``metrics.histogram(...)``) and update them inline.
+- ``REGISTRY.collector(fn)`` adds values read at scrape time (queue depth,
+  cache size...); ``fn`` returns ``[(name, kind, help, [(labels, value), ...])]``.
+  Values that belong to one app rather than the process are passed to
+  ``REGISTRY.render(extra)`` by that app's /metrics route instead.
+- ``MetricsMiddleware`` records per-route latency, status and in-flight requests,
+  and can write one JSON access-log line per request.
+
+Metrics are per process: with several uvicorn workers each scrape sees the
+worker that answered it, so scrape each worker or aggregate by instance.
+"""
+
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+access_logger = logging.getLogger("access")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+Samples = List[Tuple[Dict[str, str], float]]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels_text(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], Any] = {}
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterator[Tuple[str, Dict[str, str], float]]:
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{_labels_text(labels)} {_number(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # [per-bucket counts..., sum, count]
+                entry = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+                    break
+            entry[-2] += value
+            entry[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> Iterator[Tuple[str, Dict[str, str], float]]:
+        with self._lock:
+            items = [(key, list(entry)) for key, entry in self._values.items()]
+        for key, entry in items:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry):
+                cumulative += count
+                yield f"{self.name}_bucket", {**labels, "le": _number(bound)}, cumulative
+            yield f"{self.name}_bucket", {**labels, "le": "+Inf"}, entry[-1]
+            yield f"{self.name}_sum", labels, entry[-2]
+            yield f"{self.name}_count", labels, entry[-1]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._collectors: List[Callable[[], List[Tuple[str, str, str, Samples]]]] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            # Re-importing a module (tests, reload) must not duplicate a series
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def collector(self, fn: Callable[[], List[Tuple[str, str, str, Samples]]]):
+        self._collectors.append(fn)
+        return fn
+
+    def render(self, extra: Sequence[Tuple[str, str, str, Samples]] = ()) -> str:
+        """Every metric and collector, plus ``extra`` families (e.g. one app's resources)"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        groups = [list(extra)]
+        for fn in self._collectors:
+            try:
+                groups.append(fn())
+            except Exception as e:
+                logger.error(f"Metrics collector {fn.__name__} failed: {e}")
+        for families in groups:
+            for name, kind, help, samples in families:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    if value is not None:
+                        lines.append(f"{name}{_labels_text(labels)} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def counter(name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, help, labels))
+
+
+def gauge(name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+    return REGISTRY.register(Gauge(name, help, labels))
+
+
+def histogram(name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, help, labels, buckets))
+
+
+# ================== HTTP ==================
+HTTP_REQUEST_SECONDS = histogram(
+    "http_request_duration_seconds", "Time to serve a request, until the last body byte", ("method", "route", "status")
+)
+HTTP_IN_FLIGHT = gauge("http_requests_in_flight", "Requests being served")
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware (streaming responses are timed to their end).
+    Routes are labelled by their template (/api/vr-jobs/{job_id}), never the raw path.
+    """
+
+    def __init__(self, app, access_log: bool = False):
+        self.app = app
+        self.access_log = access_log
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = 500  # unless a response starts
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            elapsed = time.perf_counter() - started
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            HTTP_REQUEST_SECONDS.observe(elapsed, method=scope["method"], route=route, status=status)
+            if self.access_log:
+                client = scope.get("client")
+                access_logger.info(json.dumps({
+                    "ts": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "route": route,
+                    "status": status,
+                    "duration_ms": round(elapsed * 1000, 2),
+                    "client": client[0] if client else None,
+                }, ensure_ascii=False))
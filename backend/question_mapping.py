@@ -0,0 +1,69 @@
+# Question -> RIASEC mapping, versioned
+# Format: {"q": question number (1-50), "type": "R".."C" or None (not scored), "weight": points per answer unit}
+# Compiled once at import by riasec_calculator. Add a new version instead of editing an old one,
+# so submissions tagged with a version can always be re-scored the same way.
+
+CURRENT_MAPPING_VERSION = "v1"
+
+QUESTION_MAPPINGS = {
+    # v1: original scoring (matches calculateRIASEC in index_redesigned_v2.html)
+    "v1": [
+        # PHẦN 1: SỞ THÍCH RIASEC (Q1-24, 4 câu mỗi nhóm)
+        { "q": 1, "type": "R", "weight": 1 },
+        { "q": 2, "type": "R", "weight": 1 },
+        { "q": 3, "type": "R", "weight": 1 },
+        { "q": 4, "type": "R", "weight": 1 },
+        { "q": 5, "type": "I", "weight": 1 },
+        { "q": 6, "type": "I", "weight": 1 },
+        { "q": 7, "type": "I", "weight": 1 },
+        { "q": 8, "type": "I", "weight": 1 },
+        { "q": 9, "type": "A", "weight": 1 },
+        { "q": 10, "type": "A", "weight": 1 },
+        { "q": 11, "type": "A", "weight": 1 },
+        { "q": 12, "type": "A", "weight": 1 },
+        { "q": 13, "type": "S", "weight": 1 },
+        { "q": 14, "type": "S", "weight": 1 },
+        { "q": 15, "type": "S", "weight": 1 },
+        { "q": 16, "type": "S", "weight": 1 },
+        { "q": 17, "type": "E", "weight": 1 },
+        { "q": 18, "type": "E", "weight": 1 },
+        { "q": 19, "type": "E", "weight": 1 },
+        { "q": 20, "type": "E", "weight": 1 },
+        { "q": 21, "type": "C", "weight": 1 },
+        { "q": 22, "type": "C", "weight": 1 },
+        { "q": 23, "type": "C", "weight": 1 },
+        { "q": 24, "type": "C", "weight": 1 },
+
+        # PHẦN 2: KỸ NĂNG (Q25-38)
+        { "q": 25, "type": "R", "weight": 1 },
+        { "q": 26, "type": "I", "weight": 1 },
+        { "q": 27, "type": "E", "weight": 1 },  # Câu máy tính, tính vào E
+        { "q": 28, "type": "S", "weight": 1 },  # Câu giao tiếp, tính vào S
+        { "q": 29, "type": "R", "weight": 1 },
+        { "q": 30, "type": "R", "weight": 1 },
+        { "q": 31, "type": "I", "weight": 1 },
+        { "q": 32, "type": "I", "weight": 1 },
+        { "q": 33, "type": "A", "weight": 1 },
+        { "q": 34, "type": "A", "weight": 1 },
+        { "q": 35, "type": "S", "weight": 1 },
+        { "q": 36, "type": "S", "weight": 1 },
+        { "q": 37, "type": "E", "weight": 1 },
+        { "q": 38, "type": "E", "weight": 1 },
+
+        # PHẦN 3: GIÁ TRỊ (Q39-46)
+        { "q": 39, "type": "C", "weight": 1 },
+        { "q": 40, "type": "C", "weight": 1 },
+        { "q": 41, "type": None, "weight": 0 },
+        { "q": 42, "type": "A", "weight": 1 },
+        { "q": 43, "type": None, "weight": 0 },
+        { "q": 44, "type": None, "weight": 0 },
+        { "q": 45, "type": "C", "weight": 1 },
+        { "q": 46, "type": None, "weight": 0 },
+
+        # PHẦN 4: ĐIỀU KIỆN THỰC TẾ (Q47-50)
+        { "q": 47, "type": None, "weight": 0 },
+        { "q": 48, "type": None, "weight": 0 },
+        { "q": 49, "type": None, "weight": 0 },
+        { "q": 50, "type": None, "weight": 0 },
+    ],
+}
@@ -0,0 +1,92 @@
+"""
+Async LRU + TTL cache with single-flight de-duplication.
+
+Concurrent callers asking for the same missing key share one computation
+(it runs in a task of its own, so a caller that is cancelled does not cancel
+it for the others). Failures are not cached: every waiter gets the exception
+and the next call tries again.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+def _retrieve_exception(task: asyncio.Future):
+    # Every caller may have given up already; don't log "exception never retrieved"
+    if not task.cancelled():
+        task.exception()
+
+
+class AsyncTTLCache:
+    def __init__(self, max_entries: int = 1000, ttl: float = 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.joined = 0
+        self.evictions = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = {}  # key -> computing task
+
+    def get(self, key: Hashable):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    async def get_or_compute(self, key: Hashable, compute: Callable[[], Awaitable[Any]]) -> Any:
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.joined += 1
+        else:
+            self.misses += 1
+            # Its own task: no caller, not even the first, owns the computation
+            task = asyncio.ensure_future(self._compute(key, compute))
+            task.add_done_callback(_retrieve_exception)
+            self._inflight[key] = task
+        # shield: a caller giving up (client disconnect) must not cancel it for the others
+        return await asyncio.shield(task)
+
+    async def _compute(self, key: Hashable, compute: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            value = await compute()
+            self.set(key, value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses + self.joined
+        return {
+            "size": len(self._data),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "joined_inflight": self.joined,
+            "hit_rate": round((self.hits + self.joined) / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "inflight": len(self._inflight),
+        }
@@ -1,9 +1,103 @@
 import json
+import threading
+from collections import OrderedDict
 
-def calculate_riasec(answers_json):
+from question_mapping import CURRENT_MAPPING_VERSION, QUESTION_MAPPINGS
+
+RIASEC_TYPES = ["R", "I", "A", "S", "E", "C"]
+
+class CompiledMapping:
+    """A question mapping compiled for scoring: (index, weight) terms per type + lazy NumPy matrix"""
+
+    def __init__(self, version, questions):
+        if len(questions) != 50 or sorted(q["q"] for q in questions) != list(range(1, 51)):
+            raise ValueError(f"Mapping {version} must define questions 1-50 exactly once")
+        terms = {letter: [] for letter in RIASEC_TYPES}
+        for q in questions:
+            if q["type"] is None or not q["weight"]:
+                continue
+            if q["type"] not in terms:
+                raise ValueError(f"Mapping {version}: unknown type {q['type']} for Q{q['q']}")
+            terms[q["type"]].append((q["q"] - 1, q["weight"]))
+        self.version = version
+        # One tuple of (answer index, weight) per type, in RIASEC_TYPES order
+        self.terms = tuple(tuple(terms[letter]) for letter in RIASEC_TYPES)
+        self._matrix = None
+
+    def score(self, answers):
+        """Six scores in RIASEC_TYPES order"""
+        return [sum(answers[i] * w for i, w in type_terms) for type_terms in self.terms]
+
+    @property
+    def matrix(self):
+        """50x6 weight matrix W so that scores = answers @ W (built once, needs NumPy)"""
+        if self._matrix is None:
+            import numpy as np
+            weights = np.zeros((50, 6), dtype=np.int64)
+            for col, type_terms in enumerate(self.terms):
+                for idx, w in type_terms:
+                    weights[idx, col] += w
+            weights.setflags(write=False)
+            self._matrix = weights
+        return self._matrix
+
+# Compiled once at import
+COMPILED_MAPPINGS = {version: CompiledMapping(version, questions) for version, questions in QUESTION_MAPPINGS.items()}
+
+def get_mapping(version=None):
+    """Compiled mapping for `version` (default: CURRENT_MAPPING_VERSION)"""
+    try:
+        return COMPILED_MAPPINGS[version or CURRENT_MAPPING_VERSION]
+    except KeyError:
+        raise ValueError(f"unknown_mapping_version: {version}")
+
+def riasec_weight_matrix(version=None):
+    return get_mapping(version).matrix
+
+def score_riasec_batch(answers_matrix, version=None):
+    """
+    Vectorized scoring for a cohort.
+    Takes an N x 50 array-like of answers and returns (scores, top3):
+    - scores: N x 6 int array in RIASEC_TYPES order
+    - top3: N x 3 column indexes, highest first; ties keep R-I-A-S-E-C order
+      exactly like the stable sort in calculate_riasec
+    """
+    import numpy as np
+    answers = np.asarray(answers_matrix, dtype=np.int64)
+    if answers.ndim != 2 or answers.shape[1] != 50:
+        raise ValueError("khong_du_50_cau")
+    scores = answers @ riasec_weight_matrix(version)
+    top3 = np.argsort(-scores, axis=1, kind="stable")[:, :3]
+    return scores, top3
+
+def calculate_riasec_batch(answers_matrix, version=None):
+    """Batch version of calculate_riasec: one result dict per row, identical to the single-student result"""
+    mapping_version = get_mapping(version).version
+    scores, top3 = score_riasec_batch(answers_matrix, version)
+    results = []
+    for row, top_idx in zip(scores.tolist(), top3.tolist()):
+        full_scores = dict(zip(RIASEC_TYPES, row))
+        top_3_list = [RIASEC_TYPES[i] for i in top_idx]
+        results.append({
+            "full_scores": full_scores,
+            "score_R": row[0],
+            "score_I": row[1],
+            "score_A": row[2],
+            "score_S": row[3],
+            "score_E": row[4],
+            "score_C": row[5],
+            "top_1_type": top_3_list[0],
+            "top_3_list": top_3_list,
+            "mapping_version": mapping_version
+        })
+    return results
+
+def calculate_riasec(answers_json, version=None):
     """
     Calculate RIASEC scores from 50 questions.
     
+    The question -> type mapping is data (question_mapping.py), compiled at import.
+    Mapping v1:
     Part 1: RIASEC Interests (Q1-24, 4 per category)
     - Q1-4: R (Realistic)
     - Q5-8: I (Investigative)
@@ -23,25 +117,8 @@ def calculate_riasec(answers_json):
     if len(answers) != 50:
         raise ValueError("khong_du_50_cau")
     
-    # =====================
-    # PART 1: RIASEC BASE (1-24)
-    # =====================
-    R = sum(answers[0:4])      # Q1-4
-    I = sum(answers[4:8])      # Q5-8
-    A = sum(answers[8:12])     # Q9-12
-    S = sum(answers[12:16])    # Q13-16
-    E = sum(answers[16:20])    # Q17-20
-    C = sum(answers[20:24])    # Q21-24
-    
-    # =====================
-    # PART 2: SKILLS (Q25-38) - ADD TO BASE
-    # =====================
-    R += answers[24] + answers[28] + answers[29]  # Q25, Q29, Q30
-    I += answers[25] + answers[30] + answers[31]  # Q26, Q31, Q32
-    A += answers[32] + answers[33] + answers[41]  # Q33, Q34, Q42
-    S += answers[27] + answers[34] + answers[35]  # Q28, Q35, Q36 (NOTE: Q28 is giao tiếp but mapped to S here)
-    E += answers[26] + answers[36] + answers[37]  # Q27, Q37, Q38 (NOTE: Q27 is máy tính but mapped to E here)
-    C += answers[38] + answers[39] + answers[44]  # Q39, Q40, Q45
+    mapping = get_mapping(version)
+    R, I, A, S, E, C = mapping.score(answers)
     
     # =====================
     # TOTAL RIASEC SCORES
@@ -76,54 +153,261 @@ def calculate_riasec(answers_json):
         "score_E": E,
         "score_C": C,
         "top_1_type": top_3_riasec[0],
-        "top_3_list": top_3_riasec
+        "top_3_list": top_3_riasec,
+        "mapping_version": mapping.version
     }
 
+class RecommendationIndex:
+    """
+    Ranked majors per ordered top-3 tuple, memoized.
+    There are only 6*5*4 = 120 tuples, so after warm-up every lookup is a dict hit.
+    Major codes are parsed once per catalog, not per request.
+    """
+
+    def __init__(self, majors):
+        self.source = majors
+        self.size = len(majors)
+        self.majors = [(job["name"], job["code"].split("-")) for job in majors]
+        self.table = {}
+        self._profiles = None
+        self._groups = None
+
+    def is_current(self, majors):
+        # Cheap O(1) change check: a new list (reload/reassign) or added/removed majors.
+        # In-place edits of existing entries need invalidate_recommendations().
+        return majors is self.source and len(majors) == self.size
+
+    def rank(self, user_codes):
+        """
+        Logic:
+        1. Filter jobs with >= 2 matching letters.
+        2. Score: 10 pts per match. +20 if 3 matches. +5 if 1st letter matches.
+        3. Stable sort by score (catalog order breaks ties).
+        """
+        recommendations = []
+        for name, job_codes in self.majors:
+            # Count matches
+            match_count = sum(1 for c in job_codes if c in user_codes)
+            if match_count < 2:
+                continue
+            # Score
+            score = match_count * 10
+            if match_count == 3:
+                score += 20
+            if job_codes[0] == user_codes[0]:
+                score += 5
+            recommendations.append((name, score))
+        # Sort descending
+        recommendations.sort(key=lambda x: x[1], reverse=True)
+        return recommendations
+
+    def lookup(self, top_3_riasec):
+        key = tuple(top_3_riasec)
+        ranked = self.table.get(key)
+        if ranked is None:
+            ranked = self.rank(key)
+            # Only memoize real top-3 tuples so odd input cannot grow the table
+            if len(key) == 3 and len(set(key)) == 3 and set(key) <= set(RIASEC_TYPES):
+                self.table[key] = ranked
+        return ranked
+
+    def warm(self):
+        """Build all 120 entries up front"""
+        from itertools import permutations
+        for key in permutations(RIASEC_TYPES, 3):
+            self.lookup(key)
+
+    # ----- score-vector similarity -----
+    @property
+    def profiles(self):
+        """
+        n x 6 matrix of major profiles, mean-centred and L2-normalised (built once per catalog).
+        A major's "profile" ({"R": w, ...}) is used when present, otherwise its code is
+        weighted 3-2-1 by letter position.
+        """
+        if self._profiles is None:
+            import numpy as np
+            matrix = np.zeros((self.size, 6), dtype=np.float64)
+            for row, job in enumerate(self.source):
+                profile = job.get("profile")
+                if profile:
+                    for col, letter in enumerate(RIASEC_TYPES):
+                        matrix[row, col] = profile.get(letter, 0)
+                else:
+                    for weight, letter in zip((3, 2, 1), job["code"].split("-")):
+                        matrix[row, RIASEC_TYPES.index(letter)] += weight
+            matrix -= matrix.mean(axis=1, keepdims=True)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            self._profiles = matrix / norms
+        return self._profiles
+
+    def group_rows(self, groups):
+        """Row indexes of majors in any of `groups` (index built once per catalog)"""
+        import numpy as np
+        if self._groups is None:
+            by_group = {}
+            for row, job in enumerate(self.source):
+                by_group.setdefault(job.get("group"), []).append(row)
+            self._groups = {g: np.array(rows, dtype=np.intp) for g, rows in by_group.items()}
+        parts = [self._groups[g] for g in groups if g in self._groups]
+        if not parts:
+            return np.array([], dtype=np.intp)
+        return np.unique(np.concatenate(parts))
+
+    def similar(self, full_scores, k=3, groups=None):
+        """
+        Top-k majors by cosine similarity between the student's centred score vector
+        and the major profiles. Uses argpartition (O(n)) and only sorts the k winners;
+        ties keep catalog order.
+        """
+        import numpy as np
+        student = np.array([full_scores.get(letter, 0) for letter in RIASEC_TYPES], dtype=np.float64)
+        student -= student.mean()
+        norm = np.linalg.norm(student)
+        if norm:
+            student /= norm
+
+        rows = self.group_rows(groups) if groups else np.arange(self.size)
+        if rows.size == 0 or k <= 0:
+            return []
+        sims = self.profiles[rows] @ student
+        k = min(k, rows.size)
+        if k < rows.size:
+            candidates = np.argpartition(-sims, k - 1)[:k]
+        else:
+            candidates = np.arange(rows.size)
+        order = candidates[np.lexsort((rows[candidates], -sims[candidates]))]
+
+        results = []
+        for pos in order:
+            job = self.source[rows[pos]]
+            results.append({
+                "name": job["name"],
+                "code": job["code"],
+                "group": job.get("group"),
+                "similarity": round(float(sims[pos]), 4)
+            })
+        return results
+
+_RECOMMENDATION_INDEX = None
+
+def recommendation_index():
+    """Current index, rebuilt automatically when job_data.MAJORS_DB is replaced or resized"""
+    global _RECOMMENDATION_INDEX
+    from job_data import MAJORS_DB # Import inside function to avoid circular dep if any
+    index = _RECOMMENDATION_INDEX
+    if index is None or not index.is_current(MAJORS_DB):
+        index = _RECOMMENDATION_INDEX = RecommendationIndex(MAJORS_DB)
+    return index
+
+def invalidate_recommendations():
+    """Force a rebuild after editing MAJORS_DB entries in place"""
+    global _RECOMMENDATION_INDEX
+    _RECOMMENDATION_INDEX = None
+
 def recommend_jobs(top_3_riasec):
     """
     Recommend jobs based on user's Top 3 RIASEC types.
-    Logic:
-    1. Filter jobs with >= 2 matching letters.
-    2. Score: 10 pts per match. +20 if 3 matches. +5 if 1st letter matches.
-    3. Return top 3 recommendations (names) joined by comma.
+    Ranking rules are in RecommendationIndex.rank; results are memoized per top-3 tuple.
+    Return top 3 recommendations (names) joined by comma.
     """
-    from job_data import MAJORS_DB # Import inside function to avoid circular dep if any
-    
-    user_codes = top_3_riasec # e.g. ["R", "I", "C"]
-    
-    recommendations = []
+    ranked = recommendation_index().lookup(top_3_riasec)
     
-    for job in MAJORS_DB:
-        job_codes = job["code"].split("-") # "R-I-C" -> ["R", "I", "C"]
-        
-        # Count matches
-        intersection = [c for c in job_codes if c in user_codes]
-        match_count = len(intersection)
-        
-        if match_count < 2:
-            continue
-            
-        # Score
-        score = match_count * 10
-        if match_count == 3:
-            score += 20
-        if job_codes[0] == user_codes[0]:
-            score += 5
-            
-        recommendations.append({
-            "name": job["name"],
-            "score": score
-        })
-        
-    # Sort descending
-    recommendations.sort(key=lambda x: x["score"], reverse=True)
-    
-    if not recommendations:
+    if not ranked:
         return "Chưa xác định"
         
     # Return top 3 recommendations joined by comma
-    top_recs = [rec["name"] for rec in recommendations[:3]]
-    return ", ".join(top_recs)
+    return ", ".join(name for name, _ in ranked[:3])
+
+# Answer byte 1-5 -> base-5 digit "0"-"4"; anything else -> "x", which int(..., 5) rejects
+_BASE5_DIGITS = bytes(b"01234"[value - 1] if 1 <= value <= 5 else ord("x") for value in range(256))
+
+def pack_answers(answers):
+    """
+    50 answers of 1-5 packed into one int (base 5, Q1 most significant): < 5**50,
+    a cheap hashable key. bytes/translate/int do the work in C, no per-answer Python loop.
+    Raises ValueError on bad input.
+    """
+    if len(answers) != 50:
+        raise ValueError("khong_du_50_cau")
+    try:
+        return int(bytes(answers).translate(_BASE5_DIGITS), 5)
+    except (TypeError, ValueError):
+        raise ValueError("cau_tra_loi_ngoai_1_5")
+
+def unpack_answers(packed):
+    answers = []
+    for _ in range(50):
+        packed, digit = divmod(packed, 5)
+        answers.append(digit + 1)
+    return answers[::-1]
+
+class ScoreCache:
+    """
+    Bounded LRU memo of (calculate_riasec result, recommend_jobs text) per answer vector.
+    Retakes and test flows submit the same 50 answers again and again; a hit skips
+    scoring and ranking entirely. Keyed on (mapping version, pack_answers(answers)).
+    The recommendation is recomputed when the recommendation index was rebuilt.
+    Returned dicts are shared between callers: treat them as read-only.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()  # key -> (result, index, recommended)
+        self._lock = threading.Lock()
+
+    def score(self, answers, version=None):
+        """(riasec result, recommended majors) for a list of 50 answers"""
+        mapping = get_mapping(version)
+        key = (mapping.version, pack_answers(answers))
+        index = recommendation_index()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data.move_to_end(key)
+                if entry[1] is index:
+                    self.hits += 1
+                    return entry[0], entry[2]
+            self.misses += 1
+        result = entry[0] if entry is not None else calculate_riasec(answers, mapping.version)
+        recommended = recommend_jobs(result["top_3_list"])
+        if self.max_entries > 0:
+            with self._lock:
+                self._data[key] = (result, index, recommended)
+                self._data.move_to_end(key)
+                while len(self._data) > self.max_entries:
+                    self._data.popitem(last=False)
+                    self.evictions += 1
+        return result, recommended
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+        }
+
+def recommend_majors_by_scores(full_scores, k=3, groups=None):
+    """
+    Similarity ranking mode: compare all six scores (not just the top-3 letters)
+    with each major's profile. Optionally restrict to majors in `groups`.
+    """
+    return recommendation_index().similar(full_scores, k=k, groups=groups)
 
 # Example usage
 if __name__ == "__main__":
@@ -0,0 +1,155 @@
+"""
+Application settings, read from the environment (and ``.env``) in one place.
+
+``Settings.from_env()`` is called by ``main.create_app()`` when no settings are
+passed; tests and benchmarks build their own (``Settings(data_dir=tmp)``) so
+they never touch the real data directory or the process environment. Paths are
+only computed here: nothing is created until a resource first needs it.
+"""
+
+import logging
+import os
+from dataclasses import dataclass, field, fields, replace
+from pathlib import Path
+from typing import List, Optional
+
+from dotenv import load_dotenv
+
+DEFAULT_GOOGLE_SCRIPT_URL = (
+    "https://script.google.com/macros/s/AKfycbzclNQP90TSF7MuQ_Y6a4TUAmSJjeiu_wLw-DvfamwnB51Rk8JUMDYo_xm9jgsZuflG/exec"
+)
+
+
+logger = logging.getLogger(__name__)
+
+BACKEND_DIR = Path(__file__).resolve().parent
+
+
+def default_data_dir(backend_dir: Path = BACKEND_DIR) -> Path:
+    """
+    backend/data, whatever the working directory. Deployments started from
+    backend/ (Procfile, deploy.sh) under the old CWD-relative default keep their
+    files in backend/backend/data: that directory is used until backend/data exists.
+    """
+    data_dir = backend_dir / "data"
+    legacy = backend_dir / "backend" / "data"
+    if not data_dir.exists() and legacy.is_dir():
+        logger.warning(f"Using legacy data directory {legacy}; move it to {data_dir} or set DATA_DIR")
+        return legacy
+    return data_dir
+
+
+def _flag(value: str) -> bool:
+    return value == "1"
+
+
+def _list(value: str) -> List[str]:
+    return [item.strip().lower() for item in value.split(",") if item.strip()]
+
+
+@dataclass
+class Settings:
+    # Dify
+    dify_api_key: Optional[str] = field(default=None, metadata={"env": "DIFY_API_KEY"})
+    dify_chat_url: str = field(default="https://api.dify.ai/v1/chat-messages", metadata={"env": "DIFY_CHAT_URL"})
+    dify_connect_timeout: float = field(default=5.0, metadata={"env": "DIFY_CONNECT_TIMEOUT"})
+    dify_read_timeout: float = field(default=90.0, metadata={"env": "DIFY_READ_TIMEOUT"})
+    dify_max_connections: int = field(default=200, metadata={"env": "DIFY_MAX_CONNECTIONS"})
+    dify_max_concurrency: int = field(default=100, metadata={"env": "DIFY_MAX_CONCURRENCY"})
+    dify_max_retries: int = field(default=2, metadata={"env": "DIFY_MAX_RETRIES"})
+
+    # Storage
+    # See default_data_dir(); a relative DATA_DIR is CWD-relative
+    data_dir: Path = field(default_factory=default_data_dir, metadata={"env": "DATA_DIR", "parse": Path})
+    storage_backend: str = field(default="json", metadata={"env": "STORAGE_BACKEND"})
+    submissions_fsync_every: int = field(default=20, metadata={"env": "SUBMISSIONS_FSYNC_EVERY"})
+    submissions_fsync_interval: float = field(default=1.0, metadata={"env": "SUBMISSIONS_FSYNC_INTERVAL"})
+    submissions_bulk_max: int = field(default=10000, metadata={"env": "SUBMISSIONS_BULK_MAX"})
+    vr_jobs_max_age: int = field(default=0, metadata={"env": "VR_JOBS_MAX_AGE"})
+
+    # Conversations; None = "sqlite" with the SQLite backend, else "memory"
+    conversation_store: Optional[str] = field(default=None, metadata={"env": "CONVERSATION_STORE"})
+    conversation_ttl: float = field(default=7200.0, metadata={"env": "CONVERSATION_TTL"})
+    conversation_max: int = field(default=10000, metadata={"env": "CONVERSATION_MAX"})
+    conversation_max_messages: int = field(default=100, metadata={"env": "CONVERSATION_MAX_MESSAGES"})
+
+    # Admission control in front of Dify (see admission.py); 0 disables a rate limit
+    llm_max_concurrency: int = field(default=20, metadata={"env": "LLM_MAX_CONCURRENCY"})
+    llm_max_queue: int = field(default=200, metadata={"env": "LLM_MAX_QUEUE"})
+    llm_queue_timeout: float = field(default=20.0, metadata={"env": "LLM_QUEUE_TIMEOUT"})
+    rate_limit_per_minute: float = field(default=20.0, metadata={"env": "RATE_LIMIT_PER_MINUTE"})
+    rate_limit_burst: int = field(default=5, metadata={"env": "RATE_LIMIT_BURST"})
+    rate_limit_ip_per_minute: float = field(default=0.0, metadata={"env": "RATE_LIMIT_IP_PER_MINUTE"})
+    rate_limit_ip_burst: int = field(default=60, metadata={"env": "RATE_LIMIT_IP_BURST"})
+    trust_proxy_headers: bool = field(default=False, metadata={"env": "TRUST_PROXY_HEADERS", "parse": _flag})
+
+    # Google Sheet outbox
+    google_script_url: str = field(default=DEFAULT_GOOGLE_SCRIPT_URL, metadata={"env": "GOOGLE_SCRIPT_URL"})
+    sheet_batch_size: int = field(default=1, metadata={"env": "SHEET_BATCH_SIZE"})
+    sheet_flush_interval: float = field(default=2.0, metadata={"env": "SHEET_FLUSH_INTERVAL"})
+    sheet_max_attempts: int = field(default=10, metadata={"env": "SHEET_MAX_ATTEMPTS"})
+    sheet_stub_enabled: bool = field(default=False, metadata={"env": "SHEET_STUB_ENABLED", "parse": _flag})
+
+    # Memoized scoring per answer vector (see riasec_calculator.ScoreCache); 0 disables
+    riasec_score_cache_max: int = field(default=10000, metadata={"env": "RIASEC_SCORE_CACHE_MAX"})
+
+    # /run-riasec analysis cache
+    riasec_cache_enabled: bool = field(default=False, metadata={"env": "RIASEC_CACHE_ENABLED", "parse": _flag})
+    riasec_cache_max: int = field(default=2000, metadata={"env": "RIASEC_CACHE_MAX"})
+    riasec_cache_ttl: float = field(default=86400.0, metadata={"env": "RIASEC_CACHE_TTL"})
+
+    # POST /run-riasec/jobs: background workers per process, result retention, long-poll cap,
+    # hosts allowed as callback_url (none = callbacks off) and the callback HMAC secret
+    riasec_job_workers: int = field(default=4, metadata={"env": "RIASEC_JOB_WORKERS"})
+    riasec_job_ttl: float = field(default=7 * 86400.0, metadata={"env": "RIASEC_JOB_TTL"})
+    riasec_job_max_wait: float = field(default=30.0, metadata={"env": "RIASEC_JOB_MAX_WAIT"})
+    riasec_callback_hosts: List[str] = field(default_factory=list, metadata={"env": "RIASEC_CALLBACK_HOSTS", "parse": _list})
+    riasec_callback_secret: Optional[str] = field(default=None, metadata={"env": "RIASEC_CALLBACK_SECRET"})
+
+    # Static files, observability, startup
+    static_image_formats: List[str] = field(default_factory=list, metadata={"env": "STATIC_IMAGE_FORMATS", "parse": _list})
+    access_log_json: bool = field(default=False, metadata={"env": "ACCESS_LOG_JSON", "parse": _flag})
+    startup_budget_ms: float = field(default=1500.0, metadata={"env": "STARTUP_BUDGET_MS"})
+
+    def __post_init__(self):
+        self.data_dir = Path(self.data_dir)
+        if self.storage_backend not in ("json", "sqlite"):
+            raise ValueError(f"Unknown STORAGE_BACKEND: {self.storage_backend}")
+
+    @classmethod
+    def from_env(cls, **overrides) -> "Settings":
+        """Defaults, overridden by environment variables, overridden by ``overrides``"""
+        load_dotenv()
+        values = {}
+        for f in fields(cls):
+            raw = os.getenv(f.metadata["env"])
+            if raw is None:
+                continue
+            parse = f.metadata.get("parse")
+            if parse is None:
+                # int/float/str/Path/Optional[str] fields all parse from their default's type
+                parse = type(f.default) if f.default is not None else str
+            values[f.name] = parse(raw)
+        return replace(cls(**values), **overrides)
+
+    # ----- derived paths -----
+    @property
+    def database_file(self) -> Path:
+        return self.data_dir / "app.db"
+
+    @property
+    def vr_jobs_file(self) -> Path:
+        return self.data_dir / "vr_jobs.json"
+
+    @property
+    def submissions_file(self) -> Path:
+        """Legacy array, imported once into the log"""
+        return self.data_dir / "submissions.json"
+
+    @property
+    def submissions_log_file(self) -> Path:
+        return self.data_dir / "submissions.jsonl"
+
+    @property
+    def vr_jobs_cache_control(self) -> str:
+        return f"public, max-age={self.vr_jobs_max_age}" if self.vr_jobs_max_age else "no-cache"
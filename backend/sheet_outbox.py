@@ -0,0 +1,276 @@
+"""
+Durable outbox for Google Sheet logging.
+
+Rows are written to a local SQLite queue (survives restarts, shared by workers)
+and a background task ships them upstream:
+- up to ``batch_size`` rows per upstream call (``{"rows": [...]}``; batch_size=1
+  sends the single-row body the original Apps Script expects),
+- failed batches are retried with jittered exponential backoff,
+- a row that still fails after ``max_attempts`` tries, or that the Apps Script
+  rejects outright (a 4xx other than 408/429 on a single-row batch), moves to the
+  ``outbox_dead`` table so it stops coming back; ``stats()["dead_letters"]`` counts them,
+- rows are leased while in flight so two workers never send the same batch.
+"""
+
+import asyncio
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SHEET_BATCH_SECONDS = metrics.histogram(
+    "sheet_outbox_batch_duration_seconds", "Upstream call time per outbox batch", ("outcome",)
+)
+SHEET_ROWS = metrics.counter("sheet_outbox_rows_total", "Rows handled by the outbox", ("outcome",))
+
+# Upstream answers worth another try; any other 4xx will fail the same way again
+TRANSIENT_4XX = {408, 429}
+
+
+class SheetRejected(Exception):
+    """The Apps Script answered with a status that retrying will not change."""
+
+
+class SheetOutbox:
+    def __init__(
+        self,
+        db_path: Path,
+        url: str,
+        batch_size: int = 1,
+        flush_interval: float = 2.0,
+        timeout: float = 10.0,
+        backoff_base: float = 2.0,
+        backoff_max: float = 300.0,
+        lease: float = 60.0,
+        max_attempts: int = 10,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.url = url
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lease = lease
+        self.max_attempts = max(1, max_attempts)
+        self.transport = transport
+
+        self.sent = 0
+        self.failed_attempts = 0
+        self.dead_lettered = 0
+        self.last_error: Optional[str] = None
+        self.last_batch_ms: Optional[float] = None
+
+        self._local = threading.local()
+        self._task: Optional[asyncio.Task] = None
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " payload TEXT NOT NULL,"
+                " created REAL NOT NULL,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " next_attempt REAL NOT NULL,"
+                " last_error TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_next_attempt ON outbox(next_attempt)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox_dead ("
+                " id INTEGER PRIMARY KEY,"
+                " payload TEXT NOT NULL,"
+                " created REAL NOT NULL,"
+                " attempts INTEGER NOT NULL,"
+                " failed REAL NOT NULL,"
+                " last_error TEXT)"
+            )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.db_path), timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # ----- producer -----
+    def enqueue(self, row: Dict[str, Any]):
+        SHEET_ROWS.inc(outcome="enqueued")
+        now = time.time()
+        self._conn().execute(
+            "INSERT INTO outbox (payload, created, next_attempt) VALUES (?, ?, ?)",
+            (json.dumps(row, ensure_ascii=False), now, now),
+        )
+
+    # ----- consumer -----
+    def _claim(self) -> List[tuple]:
+        """Lease the next due batch so other workers skip it until the lease expires."""
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT id, payload, attempts FROM outbox WHERE next_attempt <= ? ORDER BY id LIMIT ?",
+                (now, self.batch_size),
+            ).fetchall()
+            if rows:
+                conn.executemany(
+                    "UPDATE outbox SET next_attempt = ? WHERE id = ?",
+                    [(now + self.lease, row[0]) for row in rows],
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return rows
+
+    def _ack(self, ids: List[int]):
+        self._conn().executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i in ids])
+
+    def _retry_later(self, rows: List[tuple], error: str, permanent: bool = False) -> int:
+        """Back off, or dead-letter rows out of attempts. Returns the number dead-lettered."""
+        now = time.time()
+        updates = []
+        dead = []
+        for row_id, _, attempts in rows:
+            if attempts + 1 >= self.max_attempts or (permanent and len(rows) == 1):
+                dead.append((now, attempts + 1, error[:500], row_id))
+                continue
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempts)))
+            updates.append((attempts + 1, now + delay, error[:500], row_id))
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "UPDATE outbox SET attempts = ?, next_attempt = ?, last_error = ? WHERE id = ?", updates
+            )
+            conn.executemany(
+                "INSERT INTO outbox_dead (id, payload, created, attempts, failed, last_error)"
+                " SELECT id, payload, created, ?, ?, ? FROM outbox WHERE id = ?",
+                [(attempts, failed, last_error, row_id) for failed, attempts, last_error, row_id in dead],
+            )
+            conn.executemany("DELETE FROM outbox WHERE id = ?", [(row[-1],) for row in dead])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return len(dead)
+
+    def dead_letters(self, limit: int = 100) -> List[Dict[str, Any]]:
+        """Rows given up on, oldest first (re-send them by hand once the cause is fixed)"""
+        rows = self._conn().execute(
+            "SELECT id, payload, created, attempts, failed, last_error FROM outbox_dead ORDER BY id LIMIT ?",
+            (limit,),
+        ).fetchall()
+        return [
+            {"id": i, "payload": json.loads(p), "created": c, "attempts": a, "failed": f, "last_error": e}
+            for i, p, c, a, f, e in rows
+        ]
+
+    async def flush_once(self, client: httpx.AsyncClient) -> int:
+        """Send one batch. Returns the number of rows delivered."""
+        rows = await asyncio.to_thread(self._claim)
+        if not rows:
+            return 0
+        payloads = [json.loads(row[1]) for row in rows]
+        body = payloads[0] if self.batch_size == 1 else {"rows": payloads}
+        started = time.perf_counter()
+        try:
+            response = await client.post(self.url, json=body)
+            if 400 <= response.status_code < 500 and response.status_code not in TRANSIENT_4XX:
+                raise SheetRejected(f"HTTP {response.status_code}: {response.text[:200]}")
+            if response.status_code >= 400:
+                raise RuntimeError(f"HTTP {response.status_code}: {response.text[:200]}")
+        except Exception as e:
+            self.failed_attempts += 1
+            self.last_error = str(e)
+            SHEET_BATCH_SECONDS.observe(time.perf_counter() - started, outcome="error")
+            dead = await asyncio.to_thread(self._retry_later, rows, str(e), isinstance(e, SheetRejected))
+            SHEET_ROWS.inc(len(rows) - dead, outcome="retried")
+            if dead:
+                self.dead_lettered += dead
+                SHEET_ROWS.inc(dead, outcome="dead_lettered")
+                logger.error(f"Sheet log gave up on {dead} rows (moved to outbox_dead): {e}")
+            if len(rows) > dead:
+                logger.warning(f"Sheet log failed for {len(rows) - dead} rows, will retry: {e}")
+            return 0
+        finally:
+            self.last_batch_ms = round((time.perf_counter() - started) * 1000, 1)
+        SHEET_BATCH_SECONDS.observe(self.last_batch_ms / 1000, outcome="sent")
+        await asyncio.to_thread(self._ack, [row[0] for row in rows])
+        SHEET_ROWS.inc(len(rows), outcome="sent")
+        self.sent += len(rows)
+        logger.info(f"✅ Logged {len(rows)} rows to Google Sheet")
+        return len(rows)
+
+    async def flush(self, client: Optional[httpx.AsyncClient] = None) -> int:
+        """Drain everything currently due. Returns the number of rows delivered."""
+        own_client = client is None
+        if own_client:
+            client = httpx.AsyncClient(timeout=self.timeout, transport=self.transport, follow_redirects=True)
+        try:
+            total = 0
+            while True:
+                sent = await self.flush_once(client)
+                if not sent:
+                    return total
+                total += sent
+        finally:
+            if own_client:
+                await client.aclose()
+
+    async def run(self):
+        """Background loop: drain due rows, then sleep flush_interval."""
+        async with httpx.AsyncClient(timeout=self.timeout, transport=self.transport, follow_redirects=True) as client:
+            while True:
+                try:
+                    await self.flush(client)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Sheet outbox worker error: {e}")
+                await asyncio.sleep(self.flush_interval)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    # ----- observability -----
+    def stats(self) -> Dict[str, Any]:
+        conn = self._conn()
+        depth, oldest, retrying = conn.execute(
+            "SELECT COUNT(*), MIN(created), SUM(attempts > 0) FROM outbox"
+        ).fetchone()
+        dead_letters = conn.execute("SELECT COUNT(*) FROM outbox_dead").fetchone()[0]
+        return {
+            "depth": depth,
+            "lag_seconds": round(time.time() - oldest, 1) if oldest else 0,
+            "retrying": retrying or 0,
+            "dead_letters": dead_letters,
+            "sent": self.sent,
+            "failed_attempts": self.failed_attempts,
+            "last_error": self.last_error,
+            "last_batch_ms": self.last_batch_ms,
+            "batch_size": self.batch_size,
+        }
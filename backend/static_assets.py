@@ -0,0 +1,230 @@
+"""
+Precompressed, fingerprinted static assets.
+
+``build()`` (run once at startup, or lazily on first request) reads
+``backend/static`` into memory and:
+- gives every file a content-hashed alias (``background.3f2a9c1b7d4e.png``) and
+  rewrites ``static/<file>`` references inside the HTML pages to those aliases;
+- precompresses text assets with gzip and, when the optional ``brotli``
+  package is installed, brotli;
+- optionally re-encodes raster images to WebP/AVIF (needs Pillow), served to
+  browsers whose ``Accept`` header lists the format.
+
+Responses negotiate ``Accept-Encoding``, carry a strong ETag per variant and
+answer ``If-None-Match`` with 304. Hashed URLs are cached for a year as
+``immutable``; plain names (and the HTML pages, whose URLs never change) are
+revalidated on every use.
+"""
+
+import gzip
+import hashlib
+import io
+import logging
+import mimetypes
+import threading
+from pathlib import Path
+from typing import Dict, Optional, Sequence
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+from vr_catalog import etag_matches
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:  # optional: no WebP/AVIF variants
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+COMPRESSIBLE_TYPES = {"application/javascript", "application/json", "image/svg+xml", "application/xml"}
+IMAGE_TYPES = {"image/png", "image/jpeg"}
+IMAGE_FORMATS = {"webp": ("WEBP", "image/webp"), "avif": ("AVIF", "image/avif")}
+
+
+def _compressible(content_type: str) -> bool:
+    return content_type.startswith("text/") or content_type in COMPRESSIBLE_TYPES
+
+
+def _accepted(header: Optional[str]) -> Dict[str, float]:
+    """Token -> q-value from an Accept / Accept-Encoding header"""
+    accepted = {}
+    for part in (header or "").split(","):
+        token, _, params = part.strip().partition(";")
+        if not token:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[token.strip().lower()] = q
+    return accepted
+
+
+class Asset:
+    def __init__(self, name: str, body: bytes, content_type: str):
+        self.name = name
+        self.content_type = content_type
+        digest = hashlib.sha256(body).hexdigest()
+        stem, dot, ext = name.rpartition(".")
+        self.hashed_name = f"{stem}.{digest[:12]}.{ext}" if dot else f"{name}.{digest[:12]}"
+        # (content type, content encoding) -> body; identity is always present
+        self.variants: Dict[tuple, bytes] = {(content_type, "identity"): body}
+        self.tag = digest[:32]
+
+
+class StaticAssets:
+    def __init__(
+        self,
+        static_dir: Path,
+        encodings: Sequence[str] = ("br", "gzip"),
+        image_formats: Sequence[str] = (),
+        min_size: int = 1024,
+    ):
+        self.static_dir = Path(static_dir)
+        self.encodings = [e for e in encodings if e == "gzip" or (e == "br" and brotli is not None)]
+        self.image_formats = [f for f in image_formats if f in IMAGE_FORMATS]
+        self.min_size = min_size
+        self._assets: Optional[Dict[str, Asset]] = None  # by plain and hashed name
+        self._lock = threading.Lock()
+
+    # ----- build -----
+    def build(self) -> Dict[str, Asset]:
+        with self._lock:
+            if self._assets is None:
+                self._assets = self._build()
+            return self._assets
+
+    def _build(self) -> Dict[str, Asset]:
+        if not self.static_dir.is_dir():
+            return {}
+        files = sorted(p for p in self.static_dir.rglob("*") if p.is_file() and not p.name.startswith("."))
+        assets = {}
+        pages = []
+        for path in files:
+            name = path.relative_to(self.static_dir).as_posix()
+            content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            if content_type == "text/html":
+                pages.append((name, path.read_bytes()))
+                continue
+            assets[name] = Asset(name, path.read_bytes(), content_type)
+
+        # Point pages at the hashed URLs, then hash the pages themselves
+        for name, body in pages:
+            text = body.decode("utf-8")
+            for asset in assets.values():
+                text = text.replace(f"static/{asset.name}", f"static/{asset.hashed_name}")
+            assets[name] = Asset(name, text.encode("utf-8"), "text/html; charset=utf-8")
+
+        for asset in list(assets.values()):
+            self._add_variants(asset)
+            assets[asset.hashed_name] = asset
+        identity = sum(len(a.variants[(a.content_type, "identity")]) for a in set(assets.values()))
+        logger.info(
+            f"Static assets ready: {len(set(assets.values()))} files, {identity // 1024} KB "
+            f"(encodings: {self.encodings or ['identity']}, images: {self.image_formats or ['original']})"
+        )
+        return assets
+
+    def _add_variants(self, asset: Asset):
+        body = asset.variants[(asset.content_type, "identity")]
+        base_type = asset.content_type.split(";")[0]
+        if _compressible(base_type) and len(body) >= self.min_size:
+            for encoding in self.encodings:
+                if encoding == "gzip":
+                    compressed = gzip.compress(body, compresslevel=9, mtime=0)
+                else:
+                    compressed = brotli.compress(body, quality=11)
+                if len(compressed) < len(body) * 0.95:
+                    asset.variants[(asset.content_type, encoding)] = compressed
+        if base_type in IMAGE_TYPES and Image is not None:
+            for fmt in self.image_formats:
+                pil_format, content_type = IMAGE_FORMATS[fmt]
+                try:
+                    out = io.BytesIO()
+                    with Image.open(io.BytesIO(body)) as image:
+                        image.save(out, pil_format, quality=80)
+                except Exception as e:  # codec not built into this Pillow
+                    logger.warning(f"Cannot encode {asset.name} as {fmt}: {e}")
+                    continue
+                if out.tell() < len(body):
+                    asset.variants[(content_type, "identity")] = out.getvalue()
+
+    # ----- lookup -----
+    def get(self, name: str) -> Optional[Asset]:
+        return self.build().get(name)
+
+    def url(self, name: str) -> str:
+        """Hashed URL for templates and API responses"""
+        asset = self.get(name)
+        return f"/static/{asset.hashed_name if asset else name}"
+
+    def manifest(self) -> Dict[str, str]:
+        return {a.name: a.hashed_name for a in set(self.build().values())}
+
+    # ----- responses -----
+    def _choose(self, asset: Asset, request: Request) -> tuple:
+        content_type = asset.content_type
+        accept = _accepted(request.headers.get("accept"))
+        for fmt in self.image_formats:
+            candidate = IMAGE_FORMATS[fmt][1]
+            if accept.get(candidate, 0) > 0 and (candidate, "identity") in asset.variants:
+                content_type = candidate
+                break
+        accept_encoding = _accepted(request.headers.get("accept-encoding"))
+        for encoding in self.encodings:
+            q = accept_encoding.get(encoding, accept_encoding.get("*", 0))
+            if q > 0 and (content_type, encoding) in asset.variants:
+                return content_type, encoding
+        return content_type, "identity"
+
+    def response(self, asset: Asset, request: Request, immutable: bool) -> Response:
+        content_type, encoding = self._choose(asset, request)
+        vary = ["Accept-Encoding"]
+        if len({ct for ct, _ in asset.variants}) > 1:
+            vary.append("Accept")
+        suffix = "" if (content_type, encoding) == (asset.content_type, "identity") else f"-{content_type.split('/')[-1]}-{encoding}"
+        headers = {
+            "ETag": f'"{asset.tag}{suffix}"',
+            "Cache-Control": IMMUTABLE if immutable else REVALIDATE,
+            "Vary": ", ".join(vary),
+        }
+        if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(asset.variants[(content_type, encoding)], media_type=content_type, headers=headers)
+
+
+class StaticAssetsApp:
+    """
+    ASGI app mounted at /static: serves built assets, and hands anything else
+    (files added after startup, unusual methods) to ``fallback`` (StaticFiles).
+    """
+
+    def __init__(self, assets: StaticAssets, fallback):
+        self.assets = assets
+        self.fallback = fallback
+
+    async def __call__(self, scope, receive, send):
+        # Path inside the mount: root_path ends with the mount prefix
+        path, root = scope["path"], scope.get("root_path", "")
+        name = (path[len(root):] if root and path.startswith(root) else path).lstrip("/")
+        asset = self.assets.get(name) if scope["type"] == "http" and scope["method"] in ("GET", "HEAD") else None
+        if asset is None:
+            await self.fallback(scope, receive, send)
+            return
+        response = self.assets.response(asset, Request(scope), immutable=name == asset.hashed_name)
+        await response(scope, receive, send)
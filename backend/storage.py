@@ -0,0 +1,362 @@
+"""
+SQLite storage backend (STORAGE_BACKEND=sqlite).
+
+One database file (WAL mode) shared by every uvicorn worker on the host holds
+submissions, the VR job catalog and conversation sessions:
+
+- SQLiteSubmissionStore: same interface as the JSON-lines SubmissionStore
+  (append / append_many / scan / select). school, class, time and top type are
+  indexed columns, so filtered listings and exports no longer scan every record.
+  Scan offsets are row ids (never reused), wrapped in the same opaque cursors.
+- SQLiteVRJobCatalog: VRJobCatalog with its snapshot/journal files replaced by a
+  table; writers serialise on ``BEGIN IMMEDIATE`` and readers notice other
+  workers' commits through ``PRAGMA data_version``.
+- Conversations use SQLiteConversationStore pointed at the same file.
+
+``migrate_json_to_sqlite`` copies the existing JSON files in once; a flag in the
+``meta`` table makes later starts (and other workers) skip it.
+
+Statements are constant SQL with parameters, so sqlite3's per-connection
+statement cache prepares each one once. Connections are per thread.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from submission_store import InvalidCursor, _parse_time, decode_cursor, encode_cursor, record_class
+from vr_catalog import VRJobCatalog
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS submissions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    data TEXT NOT NULL,
+    school TEXT,
+    class TEXT,
+    ts TEXT,
+    top TEXT,
+    client_key TEXT UNIQUE
+);
+CREATE INDEX IF NOT EXISTS idx_submissions_school_class ON submissions(school, class);
+CREATE INDEX IF NOT EXISTS idx_submissions_ts ON submissions(ts);
+CREATE INDEX IF NOT EXISTS idx_submissions_top ON submissions(top);
+CREATE TABLE IF NOT EXISTS vr_jobs (
+    id TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+"""
+
+
+class SQLiteDatabase:
+    """A database file with one connection per thread (autocommit; explicit transactions)."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._all: List[sqlite3.Connection] = []
+        self._all_lock = threading.Lock()
+        self.conn().executescript(SCHEMA)
+
+    def connect(self, check_same_thread: bool = True) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            str(self.path), timeout=10, isolation_level=None, check_same_thread=check_same_thread
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with self._all_lock:
+            self._all.append(conn)
+        return conn
+
+    def conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self.connect()
+        return conn
+
+    @contextmanager
+    def transaction(self, conn: Optional[sqlite3.Connection] = None):
+        """Write transaction; BEGIN IMMEDIATE takes the write lock up front (no upgrade deadlocks)."""
+        conn = conn or self.conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def close(self):
+        with self._all_lock:
+            conns, self._all = self._all, []
+        for conn in conns:
+            try:
+                conn.close()
+            except sqlite3.ProgrammingError:
+                pass  # owned by another thread; closed with it
+        self._local = threading.local()
+
+
+# ================== SUBMISSIONS ==================
+def _sortable_time(value: Any) -> Optional[str]:
+    """Fixed-width UTC text, so string comparison in SQL is time order."""
+    parsed = _parse_time(value)
+    if parsed is None:
+        return None
+    return parsed.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+class SQLiteSubmissionStore:
+    """
+    Submissions table with the SubmissionStore interface.
+    Records whose ``key_field`` is already stored are never inserted twice.
+    """
+
+    # Rows fetched per query while scanning. Each chunk is a fresh query, so a
+    # scan can be resumed from any thread (streaming responses hop threads).
+    SCAN_CHUNK = 500
+
+    INSERT = "INSERT OR IGNORE INTO submissions (data, school, class, ts, top, client_key) VALUES (?, ?, ?, ?, ?, ?)"
+
+    def __init__(self, db: SQLiteDatabase, key_field: str = "clientKey"):
+        self.db = db
+        self.log_path = db.path  # stable file identity for CohortAnalytics
+        self.key_field = key_field
+
+    def _row(self, record: Dict[str, Any]) -> tuple:
+        riasec = record.get("riasec") or []
+        return (
+            json.dumps(record, ensure_ascii=False, separators=(",", ":")),
+            record.get("school"),
+            record_class(record),
+            _sortable_time(record.get("time")),
+            riasec[0] if riasec else None,
+            record.get(self.key_field),
+        )
+
+    # ----- writes -----
+    def _check_key_field(self, key_field: Optional[str]):
+        if key_field is not None and key_field != self.key_field:
+            raise ValueError(f"SQLite store de-duplicates on {self.key_field!r}, not {key_field!r}")
+
+    def append(self, record: Dict[str, Any], key_field: Optional[str] = None) -> bool:
+        """Insert one record. Returns False if its key was already stored."""
+        self._check_key_field(key_field)
+        return self.db.conn().execute(self.INSERT, self._row(record)).rowcount == 1
+
+    def append_many(self, records: Iterable[Dict[str, Any]], key_field: Optional[str] = None) -> List[bool]:
+        """Insert a batch in one transaction. Returns one flag per record: False if its key was already stored."""
+        self._check_key_field(key_field)
+        rows = [self._row(record) for record in records]
+        accepted = []
+        with self.db.transaction() as conn:
+            for row in rows:
+                accepted.append(conn.execute(self.INSERT, row).rowcount == 1)
+        return accepted
+
+    def find(self, key_field: str, key: str) -> Optional[Dict[str, Any]]:
+        """The stored record with this key, or None."""
+        self._check_key_field(key_field)
+        row = self.db.conn().execute("SELECT data FROM submissions WHERE client_key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def sync(self):
+        pass  # every commit is already durable in the WAL
+
+    def close(self):
+        pass  # connections belong to the shared SQLiteDatabase
+
+    def compact(self) -> int:
+        """Nothing to rewrite; checkpoint the WAL back into the main file."""
+        conn = self.db.conn()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return conn.execute("SELECT COUNT(*) FROM submissions").fetchone()[0]
+
+    # ----- reads -----
+    def _query(self, where: str, params: List[Any], offset: int) -> Iterator[Tuple[int, bytes, Dict[str, Any]]]:
+        sql = f"SELECT id, data FROM submissions WHERE id > ?{where} ORDER BY id LIMIT {self.SCAN_CHUNK}"
+        while True:
+            rows = self.db.conn().execute(sql, [offset] + params).fetchall()
+            for row_id, data in rows:
+                offset = row_id
+                yield row_id, data.encode("utf-8"), json.loads(data)
+            if len(rows) < self.SCAN_CHUNK:
+                return
+
+    def scan(self, offset: int = 0) -> Iterator[Tuple[int, bytes, Dict[str, Any]]]:
+        """Yield ``(row_id, raw_json, record)`` after row id ``offset``; the row id is the cursor."""
+        return self._query("", [], offset)
+
+    def select(
+        self,
+        offset: int = 0,
+        school: Optional[str] = None,
+        class_name: Optional[str] = None,
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+        top: Optional[str] = None,
+    ) -> Iterator[Tuple[int, bytes, Dict[str, Any]]]:
+        """Same filters as ``submission_filter``, answered from the indexes. Raises ValueError on a bad time."""
+        where = []
+        params: List[Any] = []
+        if school is not None:
+            where.append("school = ?")
+            params.append(school)
+        if class_name is not None:
+            where.append("class = ?")
+            params.append(class_name)
+        for name, value, op in (("since", since, ">="), ("until", until, "<=")):
+            if value:
+                bound = _sortable_time(value)
+                if bound is None:
+                    raise ValueError(f"{name}: {value}")
+                where.append(f"ts {op} ?")
+                params.append(bound)
+        if top:
+            where.append("top = ?")
+            params.append(top.upper())
+        return self._query("".join(" AND " + clause for clause in where), params, offset)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return (record for _, _, record in self.scan())
+
+    def load_all(self) -> List[Dict[str, Any]]:
+        return list(self)
+
+    # ----- page cursors -----
+    def generation(self) -> int:
+        return 0  # rows are never rewritten, so row-id cursors never go stale
+
+    def cursor(self, generation: int, offset: int) -> str:
+        return encode_cursor(generation, offset)
+
+    def cursor_offset(self, cursor: str) -> int:
+        generation, offset = decode_cursor(cursor)
+        if generation != 0:
+            raise InvalidCursor("stale")
+        return offset
+
+
+# ================== VR JOBS ==================
+class SQLiteVRJobCatalog(VRJobCatalog):
+    """VRJobCatalog whose storage is the ``vr_jobs`` table instead of snapshot + journal files."""
+
+    UPSERT = (
+        "INSERT INTO vr_jobs (id, position, data)"
+        " VALUES (?, (SELECT COALESCE(MAX(position), 0) + 1 FROM vr_jobs), ?)"
+        " ON CONFLICT(id) DO UPDATE SET data = excluded.data"
+    )
+
+    def __init__(
+        self,
+        db: SQLiteDatabase,
+        default: List[Dict[str, Any]],
+        validate: Optional[Callable[[List[Any]], List[Dict[str, Any]]]] = None,
+        check_interval: float = 1.0,
+    ):
+        super().__init__(db.path, default, validate=validate, check_interval=check_interval)
+        self.db = db
+        # Used only under self._lock; data_version is per connection, so keep a single one
+        self._conn = db.connect(check_same_thread=False)
+
+    def _file_stamp(self) -> Tuple:
+        # Changes whenever another connection commits
+        return (self._conn.execute("PRAGMA data_version").fetchone()[0],)
+
+    def _read_snapshot(self) -> List[Any]:
+        rows = self._conn.execute("SELECT data FROM vr_jobs ORDER BY position").fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def _read_journal(self) -> List[Dict[str, Any]]:
+        return []
+
+    @contextmanager
+    def _write_lock(self):
+        with self._lock, self.db.transaction(self._conn):
+            self._refresh_locked()
+            yield
+
+    def _commit_locked(self, op: Dict[str, Any]):
+        if op["op"] == "upsert":
+            job = op["job"]
+            self._conn.execute(self.UPSERT, (job["id"], json.dumps(job, ensure_ascii=False)))
+        else:
+            self._conn.execute("DELETE FROM vr_jobs WHERE id = ?", (op["id"],))
+        self._apply(self._jobs, op)
+        self._publish_locked()
+
+    def _compact_locked(self):
+        self._conn.execute("DELETE FROM vr_jobs")
+        self._conn.executemany(
+            "INSERT INTO vr_jobs (id, position, data) VALUES (?, ?, ?)",
+            [(job["id"], i, json.dumps(job, ensure_ascii=False)) for i, job in enumerate(self._jobs.values())],
+        )
+
+
+# ================== MIGRATION ==================
+def _read_json_submissions(log_path: Path, legacy_path: Path) -> Iterator[Dict[str, Any]]:
+    if log_path.exists():
+        with open(log_path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # blank, torn or corrupt line
+                if isinstance(record, dict):
+                    yield record
+    elif legacy_path.exists():
+        try:
+            with open(legacy_path, "r", encoding="utf-8") as f:
+                records = json.load(f)
+        except Exception as e:
+            logger.error(f"Error reading {legacy_path}: {e}")
+            return
+        if isinstance(records, list):
+            yield from (r for r in records if isinstance(r, dict))
+
+
+def migrate_json_to_sqlite(
+    db: SQLiteDatabase,
+    submissions_log: Path,
+    submissions_legacy: Path,
+    vr_jobs_path: Path,
+    default_vr_jobs: List[Dict[str, Any]],
+    validate: Optional[Callable[[List[Any]], List[Dict[str, Any]]]] = None,
+) -> Optional[Dict[str, int]]:
+    """
+    Copy the JSON data files into the database, once. Returns the counts, or
+    None when the database was already migrated. The JSON files are left as they are.
+    """
+    conn = db.conn()
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+        return None
+    store = SQLiteSubmissionStore(db)
+    # Snapshot + journal, exactly as the file-backed catalog would serve it
+    vr_jobs = VRJobCatalog(vr_jobs_path, default_vr_jobs, validate=validate).jobs()
+    with db.transaction(conn):
+        # Another worker may have migrated while we were reading
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+            return None
+        submissions = 0
+        for record in _read_json_submissions(Path(submissions_log), Path(submissions_legacy)):
+            submissions += conn.execute(store.INSERT, store._row(record)).rowcount
+        conn.executemany(
+            "INSERT OR REPLACE INTO vr_jobs (id, position, data) VALUES (?, ?, ?)",
+            [(job["id"], i, json.dumps(job, ensure_ascii=False)) for i, job in enumerate(vr_jobs)],
+        )
+        conn.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', datetime('now'))")
+    counts = {"submissions": submissions, "vr_jobs": len(vr_jobs)}
+    logger.info(f"Migrated JSON data into {db.path}: {counts}")
+    return counts
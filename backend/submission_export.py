@@ -0,0 +1,173 @@
+"""
+Streaming CSV / XLSX export of submissions.
+
+Records are flattened one at a time (scores, top-3 RIASEC and every answer get
+their own column) and written into a small buffer that is drained after each
+row, so memory stays flat however many submissions are exported.
+
+XLSX is produced without extra dependencies: a minimal SpreadsheetML workbook
+with inline strings, written through ``zipfile`` onto a non-seekable sink
+(entries use data descriptors, so nothing has to be rewound).
+"""
+
+import csv
+import io
+import zipfile
+from typing import Any, Dict, Iterable, Iterator, List
+from xml.sax.saxutils import escape
+
+from question_mapping import CURRENT_MAPPING_VERSION, QUESTION_MAPPINGS
+from submission_store import record_class
+
+RIASEC_TYPES = ["R", "I", "A", "S", "E", "C"]
+ANSWER_COUNT = len(QUESTION_MAPPINGS[CURRENT_MAPPING_VERSION])
+
+EXPORT_COLUMNS = (
+    ["name", "class", "school", "time", "mappingVersion", "top1", "top2", "top3"]
+    + [f"score_{t}" for t in RIASEC_TYPES]
+    + ["suggestedMajors", "combinations"]
+    + [f"q{i}" for i in range(1, ANSWER_COUNT + 1)]
+)
+
+# Excel treats cells starting with these as formulas
+_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+
+def _text(value: Any) -> str:
+    text = "" if value is None else str(value)
+    if text.startswith(_FORMULA_PREFIXES):
+        return "'" + text
+    return text
+
+
+def submission_row(record: Dict[str, Any]) -> List[Any]:
+    """One export row; numbers stay numbers, missing values become empty cells."""
+    riasec = [_text(t) for t in list(record.get("riasec") or [])[:3]]
+    scores = record.get("scores") or {}
+    answers = list(record.get("answers") or [])[:ANSWER_COUNT]
+    return (
+        [
+            _text(record.get("name")),
+            _text(record_class(record)),
+            _text(record.get("school")),
+            _text(record.get("time")),
+            _text(record.get("mappingVersion")),
+        ]
+        + riasec + [""] * (3 - len(riasec))
+        + [scores.get(t, "") for t in RIASEC_TYPES]
+        + [_text(record.get("suggestedMajors")), _text(record.get("combinations"))]
+        + answers + [""] * (ANSWER_COUNT - len(answers))
+    )
+
+
+class _Sink(io.RawIOBase):
+    """Write-only, non-seekable buffer drained by the generator after each row."""
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def iter_csv(records: Iterable[Dict[str, Any]]) -> Iterator[bytes]:
+    # BOM so Excel opens the UTF-8 (Vietnamese) text correctly
+    yield "\ufeff".encode("utf-8")
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(EXPORT_COLUMNS)
+    for record in records:
+        writer.writerow(submission_row(record))
+        yield buf.getvalue().encode("utf-8")
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode("utf-8")
+
+
+# ================== XLSX ==================
+_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    "</Types>"
+)
+_ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="xl/workbook.xml"/>'
+    "</Relationships>"
+)
+_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name="Submissions" sheetId="1" r:id="rId1"/></sheets>'
+    "</workbook>"
+)
+_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+    'Target="worksheets/sheet1.xml"/>'
+    "</Relationships>"
+)
+_SHEET_HEAD = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+)
+_SHEET_TAIL = "</sheetData></worksheet>"
+
+
+def _xlsx_row(values: List[Any]) -> str:
+    cells = []
+    for value in values:
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            if value == "":
+                cells.append("<c/>")
+            else:
+                cells.append(f'<c t="inlineStr"><is><t xml:space="preserve">{escape(str(value))}</t></is></c>')
+        else:
+            cells.append(f"<c><v>{value}</v></c>")
+    return "<row>" + "".join(cells) + "</row>"
+
+
+def iter_xlsx(records: Iterable[Dict[str, Any]]) -> Iterator[bytes]:
+    sink = _Sink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("[Content_Types].xml", _CONTENT_TYPES)
+        zf.writestr("_rels/.rels", _ROOT_RELS)
+        zf.writestr("xl/workbook.xml", _WORKBOOK)
+        zf.writestr("xl/_rels/workbook.xml.rels", _WORKBOOK_RELS)
+        yield sink.drain()
+        with zf.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as sheet:
+            sheet.write((_SHEET_HEAD + _xlsx_row(EXPORT_COLUMNS)).encode("utf-8"))
+            for record in records:
+                sheet.write(_xlsx_row(submission_row(record)).encode("utf-8"))
+                if sink.chunks:
+                    yield sink.drain()
+            sheet.write(_SHEET_TAIL.encode("utf-8"))
+    yield sink.drain()
+
+
+EXPORT_FORMATS = {
+    "csv": (iter_csv, "text/csv; charset=utf-8"),
+    "xlsx": (iter_xlsx, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+}
@@ -0,0 +1,486 @@
+"""
+Append-only submission store (JSON lines).
+
+Each submission is one line in ``submissions.jsonl``:
+- POST cost is a single O_APPEND write, independent of history size.
+- fsync is batched (every N records or every T seconds) instead of per write;
+  a timer syncs the tail of a burst T seconds after it, even if nothing follows.
+- A torn last line left by a crash is truncated away when the log is opened.
+- ``compact()`` rewrites the log without corrupt lines via temp file + rename.
+- ``append_many()`` commits a batch in one write and can skip records whose
+  client key is already in the log (kept as an incrementally tailed key index).
+
+The legacy ``submissions.json`` array is imported once, the first time the
+log is created next to it.
+
+Page cursors handed to clients are opaque (``cursor()``): they carry the log
+generation (its inode, which compaction changes) with the byte offset, and
+``cursor_offset()`` rejects a stale cursor or one that is not on a line boundary.
+"""
+
+import base64
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: in-process locking only
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+def atomic_write_text(path: Path, text: str):
+    """Write ``text`` to ``path`` so readers see either the old or the new file, never a partial one."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=str(path.parent))
+    try:
+        # mkstemp creates 0600; keep the target's mode (or the usual 0644)
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o644
+        if hasattr(os, "fchmod"):
+            os.fchmod(fd, mode)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_name, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_name)
+        except OSError:
+            pass
+        raise
+    _fsync_dir(path.parent)
+
+
+def _fsync_dir(directory: Path):
+    """Persist a rename in ``directory`` (no-op where directories cannot be opened)."""
+    try:
+        dir_fd = os.open(str(directory), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+def _encode(record: Dict[str, Any]) -> bytes:
+    return (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+class SubmissionStore:
+    """Append-only JSON-lines log of submissions, safe across threads and worker processes."""
+
+    def __init__(
+        self,
+        log_path: Path,
+        legacy_path: Optional[Path] = None,
+        fsync_every: int = 20,
+        fsync_interval: float = 1.0,
+    ):
+        self.log_path = Path(log_path)
+        self.lock_path = self.log_path.with_name(self.log_path.name + ".lock")
+        self.legacy_path = Path(legacy_path) if legacy_path else None
+        self.fsync_every = max(1, fsync_every)
+        self.fsync_interval = fsync_interval
+
+        self._lock = threading.Lock()
+        self._fd: Optional[int] = None
+        self._pending = 0
+        self._last_sync = time.monotonic()
+        # One-shot fsync armed by the first unsynced append, so a burst followed by silence is still synced
+        self._timer: Optional[threading.Timer] = None
+        # Client-key index for de-duplication: key -> offset of its record, up to _keys_offset of the log file _keys_inode
+        self._keys: Dict[str, Optional[int]] = {}
+        self._keys_field: Optional[str] = None
+        self._keys_offset = 0
+        self._keys_inode: Optional[int] = None
+        self._open()
+
+    # ----- lifecycle -----
+    def _open(self):
+        self.log_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._file_lock(exclusive=True):
+            if not self.log_path.exists():
+                self._import_legacy()
+            self._truncate_torn_tail()
+        self._reopen()
+
+    def _reopen(self):
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(str(self.log_path), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def close(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._fd is None:
+                return
+            self._sync_locked()
+            os.close(self._fd)
+            self._fd = None
+
+    @contextmanager
+    def _file_lock(self, exclusive: bool):
+        """Cross-process lock: appends share it, compaction takes it exclusively."""
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _import_legacy(self):
+        if not self.legacy_path or not self.legacy_path.exists():
+            atomic_write_text(self.log_path, "")
+            return
+        try:
+            with open(self.legacy_path, "r", encoding="utf-8") as f:
+                records = json.load(f)
+        except Exception as e:
+            logger.error(f"Error reading {self.legacy_path}: {e}")
+            records = []
+        if not isinstance(records, list):
+            records = []
+        text = "".join(_encode(r).decode("utf-8") for r in records if isinstance(r, dict))
+        atomic_write_text(self.log_path, text)
+        logger.info(f"Imported {len(records)} submissions from {self.legacy_path} into {self.log_path}")
+
+    def _truncate_torn_tail(self):
+        """Drop a partial last line left by a crash mid-append."""
+        size = self.log_path.stat().st_size
+        if size == 0:
+            return
+        with open(self.log_path, "rb+") as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) == b"\n":
+                return
+            # Walk back to the previous newline
+            pos = size
+            chunk = 4096
+            while pos > 0:
+                step = min(chunk, pos)
+                pos -= step
+                f.seek(pos)
+                data = f.read(step)
+                idx = data.rfind(b"\n")
+                if idx != -1:
+                    pos += idx + 1
+                    break
+            logger.warning(f"Truncating torn tail of {self.log_path} ({size - pos} bytes)")
+            f.truncate(pos)
+            f.flush()
+            os.fsync(f.fileno())
+
+    # ----- writes -----
+    def append(self, record: Dict[str, Any], key_field: Optional[str] = None) -> bool:
+        """
+        Append one record. Cost is O(1) in the size of the log.
+        With ``key_field``, a record whose key is already in the log is not written
+        (same rule as ``append_many``). Returns True if it was written.
+        """
+        data = _encode(record)
+        key = record.get(key_field) if key_field else None
+        with self._lock, self._file_lock(exclusive=key is not None):
+            self._follow_compaction()
+            if key is not None:
+                seen = self._client_keys_locked(key_field)
+                if key in seen:
+                    return False
+                seen[key] = None  # offset filled in when the index tails past it
+            self._write_locked(data)
+            self._pending += 1
+            now = time.monotonic()
+            if self._pending >= self.fsync_every or now - self._last_sync >= self.fsync_interval:
+                self._sync_locked()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.fsync_interval, self._timed_sync)
+                self._timer.daemon = True
+                self._timer.start()
+        return True
+
+    def append_many(self, records: Iterable[Dict[str, Any]], key_field: Optional[str] = None) -> List[bool]:
+        """
+        Append a batch with a single write + fsync.
+        With ``key_field``, records whose key is already in the log (or earlier in
+        the batch) are skipped. Returns one flag per record: True if it was written.
+        """
+        # Dedup needs the exclusive lock so two workers cannot both accept the same key
+        with self._lock, self._file_lock(exclusive=key_field is not None):
+            self._follow_compaction()
+            seen = self._client_keys_locked(key_field) if key_field else None
+            accepted = []
+            chunks = []
+            for record in records:
+                key = record.get(key_field) if key_field else None
+                if key is not None:
+                    if key in seen:
+                        accepted.append(False)
+                        continue
+                    seen[key] = None
+                chunks.append(_encode(record))
+                accepted.append(True)
+            self._write_locked(b"".join(chunks))
+            self._pending += len(chunks)
+            self._sync_locked()
+        return accepted
+
+    def _write_locked(self, data: bytes):
+        view = memoryview(data)
+        try:
+            while view:
+                written = os.write(self._fd, view)
+                view = view[written:]
+        except BaseException:
+            self._keys_inode = None  # keys were added optimistically: rebuild next time
+            raise
+
+    def _client_keys_locked(self, key_field: str) -> Dict[str, Optional[int]]:
+        """Keys already in the log -> offset of their first record, tailed from where the last call stopped."""
+        try:
+            inode = os.stat(self.log_path).st_ino
+        except FileNotFoundError:
+            inode = None
+        if inode != self._keys_inode or key_field != self._keys_field:
+            # Compacted/replaced log (offsets moved) or another key: rebuild
+            self._keys = {}
+            self._keys_field = key_field
+            self._keys_offset = 0
+            self._keys_inode = inode
+        for next_offset, _, record in self.scan(self._keys_offset):
+            key = record.get(key_field)
+            if key is not None and self._keys.get(key) is None:
+                self._keys[key] = self._keys_offset
+            self._keys_offset = next_offset
+        return self._keys
+
+    def find(self, key_field: str, key: str) -> Optional[Dict[str, Any]]:
+        """The stored record with this key (the first one written), or None."""
+        with self._lock, self._file_lock(exclusive=False):
+            offset = self._client_keys_locked(key_field).get(key)
+            if offset is None:
+                return None
+            for _, _, record in self.scan(offset):
+                return record if record.get(key_field) == key else None
+        return None
+
+    def sync(self):
+        """Force pending appends to disk."""
+        with self._lock:
+            self._sync_locked()
+
+    def _timed_sync(self):
+        with self._lock:
+            self._timer = None
+            self._sync_locked()
+
+    def _sync_locked(self):
+        if self._fd is not None and self._pending:
+            os.fsync(self._fd)
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def _follow_compaction(self):
+        """Reopen if another process replaced the log file during compaction."""
+        if self._fd is None:
+            self._reopen()
+            return
+        try:
+            if os.fstat(self._fd).st_ino != os.stat(self.log_path).st_ino:
+                self._reopen()
+        except FileNotFoundError:
+            self._reopen()
+
+    def compact(self) -> int:
+        """Rewrite the log without corrupt lines. Returns the number of records kept."""
+        with self._lock, self._file_lock(exclusive=True):
+            self._sync_locked()
+            records = list(self._read())
+            atomic_write_text(self.log_path, "".join(_encode(r).decode("utf-8") for r in records))
+            self._reopen()
+        return len(records)
+
+    # ----- reads -----
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return self._read()
+
+    def _read(self) -> Iterator[Dict[str, Any]]:
+        for _, _, record in self.scan():
+            yield record
+
+    def scan(self, offset: int = 0) -> Iterator[Tuple[int, bytes, Dict[str, Any]]]:
+        """
+        Yield ``(next_offset, raw_line, record)`` starting at byte ``offset``.
+        Passing ``next_offset`` back resumes after this record, as long as the log
+        has not been compacted since; clients get it wrapped by ``cursor()``.
+        """
+        try:
+            f = open(self.log_path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            f.seek(offset)
+            for line in iter(f.readline, b""):
+                if not line.endswith(b"\n"):
+                    break  # append in progress
+                offset += len(line)
+                stripped = line.strip()
+                if not stripped:
+                    continue
+                try:
+                    record = json.loads(stripped)
+                except ValueError:
+                    logger.warning(f"Skipping corrupt line before offset {offset} in {self.log_path}")
+                    continue
+                yield offset, stripped, record
+
+    def select(self, offset: int = 0, **filters) -> Iterator[Tuple[int, bytes, Dict[str, Any]]]:
+        """
+        ``scan`` restricted to records matching ``submission_filter(**filters)``.
+        Raises ValueError on a bad filter before any I/O.
+        """
+        match = submission_filter(**filters)
+        return (item for item in self.scan(offset) if match(item[2]))
+
+    def load_all(self) -> List[Dict[str, Any]]:
+        return list(self._read())
+
+    # ----- page cursors -----
+    def generation(self) -> int:
+        """Identity of the current log file; compaction replaces the file, so it changes"""
+        try:
+            return os.stat(self.log_path).st_ino
+        except FileNotFoundError:
+            return 0
+
+    def cursor(self, generation: int, offset: int) -> str:
+        """Opaque cursor for resuming a scan at ``offset`` of the log generation it came from"""
+        return encode_cursor(generation, offset)
+
+    def cursor_offset(self, cursor: str) -> int:
+        """Offset to resume from; InvalidCursor unless it is a line boundary of the current log"""
+        generation, offset = decode_cursor(cursor)
+        try:
+            f = open(self.log_path, "rb")
+        except FileNotFoundError:
+            raise InvalidCursor("stale")
+        with f:
+            if os.fstat(f.fileno()).st_ino != generation:
+                raise InvalidCursor("stale")  # compacted or replaced since the cursor was issued
+            if offset:
+                f.seek(offset - 1)
+                if f.read(1) != b"\n":
+                    raise InvalidCursor("not on a record boundary")
+        return offset
+
+
+# ================== CURSORS ==================
+class InvalidCursor(ValueError):
+    """A page cursor that is malformed, from an older log generation, or not on a record boundary"""
+
+
+def encode_cursor(generation: int, offset: int) -> str:
+    return base64.urlsafe_b64encode(f"{generation}:{offset}".encode("ascii")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[int, int]:
+    """(generation, offset) of a cursor from ``encode_cursor``; raises InvalidCursor"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("ascii")
+        generation, offset = (int(part) for part in raw.split(":"))
+    except ValueError:  # also binascii.Error and UnicodeDecodeError
+        raise InvalidCursor("malformed")
+    if offset < 0:
+        raise InvalidCursor("malformed")
+    return generation, offset
+
+
+# ================== FILTERS ==================
+def _parse_time(value: Any) -> Optional[datetime]:
+    if not isinstance(value, str) or not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def record_class(record: Dict[str, Any]) -> str:
+    """Class of a record; older records stored it as ``class_name``."""
+    return record.get("class") or record.get("class_name") or "-"
+
+
+def submission_filter(
+    school: Optional[str] = None,
+    class_name: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    top: Optional[str] = None,
+) -> Callable[[Dict[str, Any]], bool]:
+    """
+    Build a predicate over stored submissions.
+    ``since``/``until`` are ISO-8601 times (inclusive); ``top`` is the top RIASEC letter.
+    Raises ValueError on an unparseable time.
+    """
+    since_dt = _parse_time(since) if since else None
+    until_dt = _parse_time(until) if until else None
+    if since and since_dt is None:
+        raise ValueError(f"since: {since}")
+    if until and until_dt is None:
+        raise ValueError(f"until: {until}")
+    top = top.upper() if top else None
+
+    def match(record: Dict[str, Any]) -> bool:
+        if school is not None and record.get("school") != school:
+            return False
+        if class_name is not None and record_class(record) != class_name:
+            return False
+        if top is not None:
+            riasec = record.get("riasec") or []
+            if not riasec or riasec[0] != top:
+                return False
+        if since_dt or until_dt:
+            t = _parse_time(record.get("time"))
+            if t is None:
+                return False
+            if since_dt and t < since_dt:
+                return False
+            if until_dt and t > until_dt:
+                return False
+        return True
+
+    return match
+
+
+if __name__ == "__main__":
+    import sys
+
+    # Usage: python submission_store.py compact backend/data/submissions.jsonl
+    if len(sys.argv) == 3 and sys.argv[1] == "compact":
+        kept = SubmissionStore(Path(sys.argv[2])).compact()
+        print(f"Compacted {sys.argv[2]}: {kept} records")
+    else:
+        print("Usage: python submission_store.py compact <submissions.jsonl>")
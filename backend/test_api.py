@@ -3,10 +3,45 @@ Test cases for CareerVR API
 Run with: pytest test_api.py -v
 """
 
+import asyncio
+import atexit
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
 from fastapi.testclient import TestClient
-from main import app
+import main
+from settings import Settings, default_data_dir
+from submission_store import SubmissionStore, encode_cursor
+from riasec_calculator import calculate_riasec, calculate_riasec_batch
+from dify_client import DifyClient, DifyConnectionError, DifyError
+from conversation_store import ConversationStore, MemoryConversationStore, SQLiteConversationStore
+from sheet_outbox import SheetOutbox
+from response_cache import AsyncTTLCache
+from vr_catalog import VRJobCatalog
+from analytics import CohortAnalytics
+from admission import FairAdmission, Overloaded, TokenBuckets
+from job_queue import JobQueue, RetryLater
+import benchmark
+from fake_upstreams import create_fake_upstreams
+from storage import SQLiteDatabase, SQLiteSubmissionStore, SQLiteVRJobCatalog, migrate_json_to_sqlite
 
+# Isolated app: its data files live in a throw-away directory, never backend/data
+TEST_DATA_DIR = Path(tempfile.mkdtemp(prefix="careergo-test-"))
+atexit.register(shutil.rmtree, TEST_DATA_DIR, True)
+# (no per-student rate limit: tests replay the same student many times)
+app = main.create_app(Settings.from_env(data_dir=TEST_DATA_DIR, rate_limit_per_minute=0))
 client = TestClient(app)
+# Tests patch this app's stores, clients and settings
+resources = app.state.resources
 
 def test_health():
     """Test health check endpoint"""
@@ -83,16 +118,1051 @@ def test_riasec_whitespace_name():
     assert response.status_code == 422
     print("✅ Whitespace name validation test passed")
 
+def _submission(name="Test", answers=None):
+    return {
+        "name": name,
+        "class": "10A1",
+        "school": "School",
+        "riasec": ["R", "I", "C"],
+        "scores": {"R": 30, "I": 28, "A": 10, "S": 12, "E": 15, "C": 25},
+        "answers": answers or [3] * 50,
+        "time": "2025-01-05T08:00:00Z",
+    }
+
+def test_submission_store_append_and_recover(tmp_path, monkeypatch):
+    """Test append-only log survives a torn last line and compacts"""
+    log = tmp_path / "submissions.jsonl"
+    store = SubmissionStore(log, fsync_every=1)
+    store.append({"name": "A"})
+    store.append({"name": "B"})
+    store.close()
+
+    # Simulate a crash mid-append and a corrupt line in the middle
+    with open(log, "a", encoding="utf-8") as f:
+        f.write('{"name": "broken"')
+    store = SubmissionStore(log)
+    assert [r["name"] for r in store] == ["A", "B"]
+
+    with open(log, "a", encoding="utf-8") as f:
+        f.write("not json\n")
+    store.append({"name": "C"})
+    assert store.compact() == 3
+    assert "not json" not in log.read_text(encoding="utf-8")
+    store.append({"name": "D"})
+    assert [r["name"] for r in store] == ["A", "B", "C", "D"]
+    store.close()
+
+    # A burst then silence: the timer syncs within fsync_interval, without waiting for another append
+    synced = []
+    real_fsync = os.fsync
+    monkeypatch.setattr("submission_store.os.fsync", lambda fd: (real_fsync(fd), synced.append(fd)))
+    store = SubmissionStore(log, fsync_every=100, fsync_interval=0.05)
+    store.append({"name": "E"})
+    store.append({"name": "F"})
+    deadline = time.time() + 2
+    while store._fd not in synced and time.time() < deadline:
+        time.sleep(0.01)
+    with store._lock:  # held by the timer until its fsync is recorded
+        assert synced.count(store._fd) == 1 and store._pending == 0
+    store.close()
+    print("✅ Submission store recovery test passed")
+
+def test_submission_store_imports_legacy(tmp_path):
+    """Test legacy submissions.json array is imported once"""
+    legacy = tmp_path / "submissions.json"
+    legacy.write_text(json.dumps([{"name": "Old"}]), encoding="utf-8")
+    store = SubmissionStore(tmp_path / "submissions.jsonl", legacy_path=legacy)
+    store.append({"name": "New"})
+    assert [r["name"] for r in store.load_all()] == ["Old", "New"]
+    store.close()
+    print("✅ Legacy import test passed")
+
+def test_submissions_roundtrip(tmp_path, monkeypatch):
+    """Test POST then GET /api/submissions through the log"""
+    monkeypatch.setattr(resources, "submission_store", SubmissionStore(tmp_path / "submissions.jsonl"))
+    assert client.post("/api/submissions", json=_submission("Nguyễn Văn A")).status_code == 200
+    response = client.get("/api/submissions")
+    assert response.status_code == 200
+    assert [r["name"] for r in response.json()] == ["Nguyễn Văn A"]
+    assert response.json()[0]["mappingVersion"] == "v1"
+    print("✅ Submissions roundtrip test passed")
+
+def test_submissions_pagination_and_filters(tmp_path, monkeypatch):
+    """Test cursor pagination, filters and NDJSON streaming"""
+    monkeypatch.setattr(resources, "submission_store", SubmissionStore(tmp_path / "submissions.jsonl"))
+    for i in range(5):
+        record = _submission(f"HS {i}")
+        record["school"] = "A" if i % 2 == 0 else "B"
+        record["time"] = f"2025-01-0{i + 1}T08:00:00Z"
+        client.post("/api/submissions", json=record)
+
+    names, cursor = [], None
+    while True:
+        params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        response = client.get("/api/submissions", params=params)
+        names += [r["name"] for r in response.json()]
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+    assert names == [f"HS {i}" for i in range(5)]
+
+    response = client.get("/api/submissions", params={"school": "A", "since": "2025-01-02", "class": "10A1", "top": "r"})
+    assert [r["name"] for r in response.json()] == ["HS 2", "HS 4"]
+
+    response = client.get("/api/submissions", params={"format": "ndjson", "school": "B"})
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert [json.loads(line)["name"] for line in response.text.splitlines()] == ["HS 1", "HS 3"]
+
+    assert client.get("/api/submissions", params={"cursor": "abc"}).status_code == 400
+    # Forged mid-line and negative offsets are refused instead of skipping records
+    store = resources.submission_store
+    assert client.get("/api/submissions", params={"cursor": encode_cursor(store.generation(), 5)}).status_code == 400
+    assert client.get("/api/submissions", params={"cursor": encode_cursor(store.generation(), -1)}).status_code == 400
+    # A cursor from before compaction is stale (the rewritten log has new offsets)
+    page = client.get("/api/submissions", params={"limit": 2})
+    store.compact()
+    stale = client.get("/api/submissions", params={"limit": 2, "cursor": page.headers["X-Next-Cursor"]})
+    assert stale.status_code == 400
+    assert client.get("/api/submissions", params={"since": "yesterday"}).status_code == 400
+    print("✅ Submissions pagination test passed")
+
+def test_dify_client_retries_on_429():
+    """Test Dify client retries 429/5xx with backoff and gives up on 4xx"""
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if len(calls) < 3:
+            return httpx.Response(429 if len(calls) == 1 else 503, headers={"Retry-After": "0"})
+        return httpx.Response(200, json={"answer": "ok", "conversation_id": "c1"})
+
+    dify = DifyClient("key", "http://dify.test/v1/chat-messages", max_retries=2, transport=httpx.MockTransport(handler))
+    result = asyncio.run(dify.chat({"query": "hi"}))
+    assert result["answer"] == "ok" and len(calls) == 3
+    assert calls[0].headers["Authorization"] == "Bearer key"
+
+    dify = DifyClient("key", "http://dify.test/v1/chat-messages", transport=httpx.MockTransport(lambda r: httpx.Response(400, text="bad")))
+    try:
+        asyncio.run(dify.chat({"query": "hi"}))
+        assert False, "expected DifyError"
+    except DifyError as e:
+        assert e.status_code == 400
+
+    # A 200 that is not JSON (e.g. a proxy error page) is an upstream error too
+    html = lambda r: httpx.Response(200, text="<html>Bad Gateway</html>")
+    dify = DifyClient("key", "http://dify.test/v1/chat-messages", transport=httpx.MockTransport(html))
+    try:
+        asyncio.run(dify.chat({"query": "hi"}))
+        assert False, "expected DifyError"
+    except DifyError as e:
+        assert e.status_code == 200 and "Bad Gateway" in e.text
+        assert main.dify_http_error(resources, e).status_code == 502
+    print("✅ Dify client retry test passed")
+
+def _fake_dify_stream(request):
+    body = json.loads(request.content)
+    assert body["response_mode"] == "streaming"
+    events = [
+        {"event": "message", "answer": "Xin ", "conversation_id": "dify-1"},
+        {"event": "message", "answer": "chào", "conversation_id": "dify-1"},
+        {"event": "message_end", "conversation_id": "dify-1"},
+    ]
+    return httpx.Response(200, text="".join(f"data: {json.dumps(e)}\n\n" for e in events))
+
+def _sse_events(text):
+    events = []
+    for block in text.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+def test_chat_streaming(monkeypatch):
+    """Test SSE variants relay Dify chunks and store the final message"""
+    monkeypatch.setattr(resources.settings, "dify_api_key", "key")
+    monkeypatch.setattr(resources, "dify_client", DifyClient("key", "http://dify.test/v1/chat-messages", transport=httpx.MockTransport(_fake_dify_stream)))
+    monkeypatch.setattr(main, "send_log_to_sheet", lambda res, data: None)
+
+    payload = {"name": "Test", "class": "10A1", "school": "School", "answer": [3] * 50}
+    response = client.post("/start-conversation/stream", json=payload)
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = _sse_events(response.text)
+    assert [e for e, _ in events] == ["start", "message", "message", "end"]
+    end = events[-1][1]
+    assert end["ai_response"] == "Xin chào" and end["ttft_ms"] is not None
+
+    conversation_id = end["conversation_id"]
+    assert resources.conversation_store.get(conversation_id)["dify_conversation_id"] == "dify-1"
+
+    response = client.post("/chat/stream", json={"conversation_id": conversation_id, "message": "Hỏi tiếp"})
+    assert _sse_events(response.text)[-1][1]["ai_response"] == "Xin chào"
+    assert [m["content"] for m in resources.conversation_store.get(conversation_id)["messages"]][-2:] == ["Hỏi tiếp", "Xin chào"]
+
+    assert client.post("/chat/stream", json={"conversation_id": "missing", "message": "hi"}).status_code == 404
+    print("✅ Chat streaming test passed")
+
+def test_memory_conversation_store_lru_and_ttl(monkeypatch):
+    """Test in-process store evicts LRU entries and expires idle sessions"""
+    now = [1000.0]
+    monkeypatch.setattr("conversation_store.time.monotonic", lambda: now[0])
+    store = MemoryConversationStore(ttl=60, max_entries=2)
+    store.put("a", {"n": 1})
+    store.put("b", {"n": 2})
+    assert store.get("a") == {"n": 1}  # "a" is now most recent
+    store.put("c", {"n": 3})
+    assert store.get("b") is None and store.evictions == 1
+
+    now[0] += 61
+    assert store.get("a") is None and store.expirations == 2
+    stats = store.stats()
+    assert stats["hits"] == 1 and stats["misses"] == 2 and stats["size"] == 0
+
+    # A store missing part of the interface fails when built, not on its first request
+    class IncompleteStore(ConversationStore):
+        def get(self, conversation_id):
+            return None
+    try:
+        IncompleteStore()
+        assert False, "expected TypeError"
+    except TypeError:
+        pass
+    print("✅ Memory conversation store test passed")
+
+def test_sqlite_conversation_store_shared(tmp_path):
+    """Test SQLite store is visible to a second instance (another worker)"""
+    worker_1 = SQLiteConversationStore(tmp_path / "conversations.db", ttl=60, max_entries=2)
+    worker_2 = SQLiteConversationStore(tmp_path / "conversations.db", ttl=60, max_entries=2)
+    worker_1.put("a", {"messages": ["xin chào"]})
+    assert worker_2.get("a") == {"messages": ["xin chào"]}
+    worker_1.put("b", {})
+    worker_1.put("c", {})
+    worker_1.sweep()
+    assert len(worker_2) == 2 and worker_1.evictions == 1
+    assert worker_2.get("missing") is None and worker_2.stats()["hit_rate"] == 0.5
+
+    # Both workers add turns to one conversation at once: no turn is lost
+    import threading
+    worker_1.put("chat", {"messages": []})
+
+    def add_turns(store, name):
+        for i in range(20):
+            store.append_turn("chat", [{"role": "user", "content": f"{name}{i}"}])
+
+    threads = [threading.Thread(target=add_turns, args=(w, n)) for w, n in ((worker_1, "a"), (worker_2, "b"))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(worker_1.get("chat")["messages"]) == 40
+    assert worker_2.append_turn("missing", [{"role": "user", "content": "x"}]) is None
+    print("✅ SQLite conversation store test passed")
+
+def test_chat_returns_bounded_history(monkeypatch):
+    """Test /chat returns only the new turn and history is capped and paginated"""
+    async def fake_dify(res, payload):
+        return {"answer": f"Trả lời: {payload['query']}", "conversation_id": "dify-1"}
+
+    monkeypatch.setattr(main, "call_dify_api", fake_dify)
+    monkeypatch.setattr(resources, "conversation_store", MemoryConversationStore())
+    monkeypatch.setattr(resources.settings, "conversation_max_messages", 6)
+    resources.conversation_store.put("c1", {
+        "name": "Test", "class": "10A1", "school": "School",
+        "riasec_scores": {"R": 1}, "top_3_types": ["R", "I", "C"],
+        "messages": [], "dify_conversation_id": "dify-1",
+    })
+
+    for i in range(5):
+        response = client.post("/chat", json={"conversation_id": "c1", "message": f"q{i}"})
+    assert [m["content"] for m in response.json()["messages"]] == ["q4", "Trả lời: q4"]
+
+    conv = resources.conversation_store.get("c1")
+    assert len(conv["messages"]) == 6 and conv["message_offset"] == 4
+
+    response = client.post("/chat", json={"conversation_id": "c1", "message": "q5", "since": 8, "limit": 3})
+    assert [m["content"] for m in response.json()["messages"]] == ["q4", "Trả lời: q4", "q5"]
+
+    page = client.get("/conversations/c1/messages", params={"limit": 4}).json()
+    assert page["offset"] == 6 and page["total"] == 12 and page["next_offset"] == 10
+    page = client.get("/conversations/c1/messages", params={"offset": page["next_offset"]}).json()
+    assert [m["content"] for m in page["messages"]] == ["q5", "Trả lời: q5"] and page["next_offset"] is None
+    assert client.get("/conversations/missing/messages").status_code == 404
+    print("✅ Bounded chat history test passed")
+
+def test_batch_scoring_matches_single():
+    """Test vectorized batch scoring gives identical per-student results"""
+    import random
+    rng = random.Random(42)
+    cohort = [[rng.randint(1, 5) for _ in range(50)] for _ in range(500)]
+    cohort += [[3] * 50, [1] * 50, list(range(1, 6)) * 10]  # tie-heavy rows
+    assert calculate_riasec_batch(cohort) == [calculate_riasec(answers) for answers in cohort]
+    try:
+        calculate_riasec_batch([[3] * 49])
+        assert False, "expected ValueError"
+    except ValueError:
+        pass
+    print("✅ Batch scoring test passed")
+
+def test_question_mapping_compiles():
+    """Test mapping data is validated and compiled into per-type terms"""
+    from riasec_calculator import CompiledMapping, get_mapping
+    mapping = get_mapping("v1")
+    assert calculate_riasec([3] * 50)["mapping_version"] == "v1"
+    assert sum(len(terms) for terms in mapping.terms) == 42  # Q41, Q43, Q44, Q46-50 not scored
+    assert mapping.matrix.sum() == 42
+    try:
+        get_mapping("v0")
+        assert False, "expected ValueError"
+    except ValueError:
+        pass
+    try:
+        CompiledMapping("bad", [{"q": 1, "type": "R", "weight": 1}])
+        assert False, "expected ValueError"
+    except ValueError:
+        pass
+    print("✅ Question mapping test passed")
+
+def _recommend_jobs_reference(top_3, majors):
+    """Original linear-scan recommend_jobs, kept to check the index against"""
+    recommendations = []
+    for job in majors:
+        job_codes = job["code"].split("-")
+        match_count = len([c for c in job_codes if c in top_3])
+        if match_count < 2:
+            continue
+        score = match_count * 10 + (20 if match_count == 3 else 0) + (5 if job_codes[0] == top_3[0] else 0)
+        recommendations.append({"name": job["name"], "score": score})
+    recommendations.sort(key=lambda x: x["score"], reverse=True)
+    if not recommendations:
+        return "Chưa xác định"
+    return ", ".join(rec["name"] for rec in recommendations[:3])
+
+def test_recommendation_index(monkeypatch):
+    """Test memoized recommendations match the linear scan and follow MAJORS_DB changes"""
+    from itertools import permutations
+    import job_data
+    import riasec_calculator
+    from riasec_calculator import recommend_jobs, recommendation_index
+    for top_3 in permutations("RIASEC", 3):
+        assert recommend_jobs(list(top_3)) == _recommend_jobs_reference(top_3, job_data.MAJORS_DB)
+    assert len(recommendation_index().table) == 120
+
+    monkeypatch.setattr(job_data, "MAJORS_DB", [{"name": "Nghề mới", "code": "R-I-C", "group": "Test"}])
+    assert recommend_jobs(["R", "I", "C"]) == "Nghề mới"
+    assert recommend_jobs(["A", "S", "E"]) == "Chưa xác định"
+    monkeypatch.setattr(riasec_calculator, "_RECOMMENDATION_INDEX", None)
+    print("✅ Recommendation index test passed")
+
+def test_score_cache_memoizes_answer_vectors(monkeypatch):
+    """Test repeated answers hit the memo, packing round-trips and results match direct scoring"""
+    import job_data
+    import riasec_calculator
+    from riasec_calculator import ScoreCache, pack_answers, recommend_jobs, unpack_answers
+    answers = [(i % 5) + 1 for i in range(50)]
+    assert unpack_answers(pack_answers(answers)) == answers
+    assert pack_answers([5] * 50) == 5 ** 50 - 1
+    for bad in ([3] * 49, [3] * 49 + [6]):
+        try:
+            pack_answers(bad)
+            assert False, "expected ValueError"
+        except ValueError:
+            pass
+
+    cache = ScoreCache(max_entries=2)
+    result, recommended = cache.score(answers)
+    assert result == main.calculate_riasec(answers)
+    assert recommended == recommend_jobs(result["top_3_list"])
+    assert cache.score(answers)[0] is result
+    cache.score([1] * 50)
+    cache.score([2] * 50)
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 3 and len(cache) == 2 and cache.evictions == 1
+
+    # A replaced catalog refreshes the recommendation without re-scoring
+    monkeypatch.setattr(job_data, "MAJORS_DB", [{"name": "Nghề mới", "code": "-".join(result["top_3_list"]), "group": "Test"}])
+    assert cache.score(answers) == (result, "Nghề mới")
+    monkeypatch.setattr(riasec_calculator, "_RECOMMENDATION_INDEX", None)
+
+    monkeypatch.setattr(resources, "score_cache", ScoreCache(max_entries=10))
+    body = {"name": "Lan", "class": "11B", "school": "S", "answer": answers}
+    monkeypatch.setattr(main, "call_dify_api", lambda res, payload: asyncio.sleep(0, {"answer": "ok", "conversation_id": "c"}))
+    for _ in range(3):
+        assert client.post("/start-conversation", json=body).status_code == 200
+    assert client.get("/api/scoring/stats").json()["hits"] == 2
+    assert 'riasec_score_cache_lookups_total{result="hit"} 2' in client.get("/metrics").text
+    print("✅ Score cache test passed")
+
+def test_similarity_ranking(monkeypatch):
+    """Test score-vector ranking uses full profiles, top-k and group filters"""
+    import job_data
+    majors = [
+        {"name": "Kỹ sư", "code": "R-I-C", "group": "Kỹ thuật"},
+        {"name": "Nhà khoa học", "code": "I-R-C", "group": "Khoa học"},
+        {"name": "Họa sĩ", "code": "A-S-E", "group": "Nghệ thuật"},
+        {"name": "Giáo viên", "code": "S-A-C", "group": "Giáo dục",
+         "profile": {"S": 0.9, "A": 0.5, "I": 0.3, "C": 0.2}},
+    ]
+    monkeypatch.setattr(job_data, "MAJORS_DB", majors)
+    scores = {"R": 30, "I": 28, "A": 10, "S": 12, "E": 15, "C": 20}
+    response = client.post("/api/recommend-majors", json={"scores": scores, "k": 2})
+    assert [m["name"] for m in response.json()["majors"]] == ["Kỹ sư", "Nhà khoa học"]
+
+    response = client.post("/api/recommend-majors", json={"scores": scores, "k": 5, "groups": ["Giáo dục", "Nghệ thuật"]})
+    assert [m["name"] for m in response.json()["majors"]] == ["Giáo viên", "Họa sĩ"]
+    assert client.post("/api/recommend-majors", json={"scores": {"X": 1}}).status_code == 422
+    print("✅ Similarity ranking test passed")
+
+def test_sheet_outbox_batches_and_retries(tmp_path, monkeypatch):
+    """Test outbox survives a restart, retries failures and batches into the local stub"""
+    monkeypatch.setattr(resources.settings, "sheet_stub_enabled", True)
+    monkeypatch.setattr(resources, "sheet_stub_rows", [])
+    stub = httpx.ASGITransport(app=app)
+    url = "http://testserver/api/dev/sheet-stub"
+
+    outbox = SheetOutbox(tmp_path / "outbox.db", "http://sheet.test/down", batch_size=10, backoff_base=0)
+    for i in range(3):
+        outbox.enqueue({"name": f"HS {i}"})
+    down = httpx.MockTransport(lambda request: httpx.Response(503))
+    outbox.transport = down
+    assert asyncio.run(outbox.flush()) == 0
+    assert outbox.stats()["depth"] == 3 and outbox.stats()["retrying"] == 3
+
+    # "Restart": a new outbox on the same file delivers the queued rows in one call
+    outbox = SheetOutbox(tmp_path / "outbox.db", url, batch_size=10, transport=stub)
+    assert asyncio.run(outbox.flush()) == 3
+    assert [r["name"] for r in client.get("/api/dev/sheet-stub").json()] == ["HS 0", "HS 1", "HS 2"]
+    assert outbox.stats()["depth"] == 0 and outbox.stats()["sent"] == 3
+
+    # A rejected row is dead-lettered at once, a failing one after max_attempts: neither blocks the queue
+    outbox = SheetOutbox(tmp_path / "dead.db", url, backoff_base=0, max_attempts=2,
+                         transport=httpx.MockTransport(lambda request: httpx.Response(400, text="bad row")))
+    outbox.enqueue({"name": "Sai"})
+    asyncio.run(outbox.flush())
+    outbox.transport = down
+    outbox.enqueue({"name": "Lỗi mạng"})
+    asyncio.run(outbox.flush())
+    assert outbox.stats()["depth"] == 1 and outbox.stats()["dead_letters"] == 1
+    asyncio.run(outbox.flush())
+    outbox.enqueue({"name": "Sau"})
+    outbox.transport = stub
+    assert asyncio.run(outbox.flush()) == 1
+    assert outbox.stats()["depth"] == 0 and outbox.stats()["dead_letters"] == 2
+    dead = outbox.dead_letters()
+    assert [d["payload"]["name"] for d in dead] == ["Sai", "Lỗi mạng"] and [d["attempts"] for d in dead] == [1, 2]
+    assert dead[0]["last_error"] == "HTTP 400: bad row"
+    print("✅ Sheet outbox test passed")
+
+def test_riasec_analysis_cache_single_flight(monkeypatch):
+    """Test identical score profiles share one Dify call, with personal fields filled back in"""
+    calls = []
+
+    async def fake_dify(res, payload):
+        calls.append(payload)
+        await asyncio.sleep(0.05)
+        inputs = payload["inputs"]
+        return {"answer": f"Chào {inputs['name']} lớp {inputs['class']} trường {inputs['school']}"}
+
+    monkeypatch.setattr(main, "call_dify_api", fake_dify)
+    monkeypatch.setattr(resources.settings, "riasec_cache_enabled", True)
+    monkeypatch.setattr(resources, "analysis_cache", AsyncTTLCache(max_entries=10, ttl=60))
+
+    def request(name):
+        return main.RIASECRequest(name=name, school="School", answer=[3] * 50, **{"class": "10A1"})
+
+    async def burst():
+        result = main.calculate_riasec([3] * 50)
+        return await asyncio.gather(*(main.analyze_riasec(resources, request(f"HS {i}"), result) for i in range(5)))
+
+    texts = asyncio.run(burst())
+    assert texts == [f"Chào HS {i} lớp 10A1 trường School" for i in range(5)]
+    # The call is admitted under the student who started it, not one shared key
+    assert len(calls) == 1 and calls[0]["user"] == "HS 0"
+    assert resources.analysis_cache.joined == 4
+
+    response = client.post("/run-riasec", json={"name": "Lan", "class": "11B", "school": "S", "answer": [3] * 50})
+    assert response.json()["text"] == "Chào Lan lớp 11B trường S" and len(calls) == 1
+
+    # An answer that lost the placeholders is not cached: personal call instead
+    async def rewriting_dify(res, payload):
+        calls.append(payload)
+        return {"answer": f"Chào {payload['inputs']['name'].strip('{}').upper()}"}
+
+    monkeypatch.setattr(main, "call_dify_api", rewriting_dify)
+    response = client.post("/run-riasec", json={"name": "Minh", "class": "11B", "school": "S", "answer": [1] * 50})
+    assert response.json()["text"] == "Chào MINH"
+    assert [c["inputs"]["name"] for c in calls[1:]] == ["{ten_hoc_sinh}", "Minh"]
+    assert len(resources.analysis_cache) == 1
+    print("✅ RIASEC analysis cache test passed")
+
+def test_analysis_cache_survives_cancelled_caller():
+    """Test cancelling the caller that started a computation does not fail the callers that joined it"""
+    cache = AsyncTTLCache(max_entries=10, ttl=60)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "ok"
+
+    async def scenario():
+        first = asyncio.ensure_future(cache.get_or_compute("k", compute))
+        await asyncio.sleep(0.01)
+        second = asyncio.ensure_future(cache.get_or_compute("k", compute))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        assert await second == "ok"
+        assert first.cancelled()
+
+    asyncio.run(scenario())
+    assert calls == [1] and cache.get("k") == "ok" and cache.stats()["inflight"] == 0
+    print("✅ Analysis cache cancellation test passed")
+
+def test_vr_jobs_etag(tmp_path, monkeypatch):
+    """Test VR jobs are served from memory with ETag/304 and reload on change"""
+    path = tmp_path / "vr_jobs.json"
+    path.write_text(json.dumps([{"id": "j1", "title": "Phi công", "videoId": "abc"}]), encoding="utf-8")
+    catalog = VRJobCatalog(path, main.DEFAULT_VR_JOBS, validate=main.validate_vr_jobs, check_interval=0)
+    monkeypatch.setattr(resources, "vr_catalog", catalog)
+
+    response = client.get("/api/vr-jobs")
+    etag = response.headers["ETag"]
+    assert response.json()[0]["icon"] == "🎬" and response.headers["Cache-Control"] == "no-cache"
+    response = client.get("/api/vr-jobs", headers={"If-None-Match": etag})
+    assert response.status_code == 304 and response.content == b""
+    assert catalog.reloads == 1
+
+    client.post("/api/vr-jobs", json=[{"id": "j2", "title": "Bác sĩ", "videoId": "xyz"}])
+    response = client.get("/api/vr-jobs", headers={"If-None-Match": etag})
+    assert response.status_code == 200 and response.json()[0]["id"] == "j2"
+    assert response.headers["ETag"] != etag
+    print("✅ VR jobs ETag test passed")
+
+def test_vr_jobs_incremental_crud(tmp_path, monkeypatch):
+    """Test per-item VR job CRUD with version checks and journal compaction"""
+    path = tmp_path / "vr_jobs.json"
+    catalog = VRJobCatalog(path, [], validate=main.validate_vr_jobs, check_interval=0, compact_every=3)
+    monkeypatch.setattr(resources, "vr_catalog", catalog)
+
+    response = client.post("/api/vr-jobs/items", json={"id": "j1", "title": "Phi công", "videoId": "abc"})
+    assert response.status_code == 201 and response.headers["ETag"] == '"1"'
+    assert client.post("/api/vr-jobs/items", json={"id": "j1", "title": "x", "videoId": "y"}).status_code == 409
+    assert catalog.journal_path.read_text(encoding="utf-8").count("\n") == 1
+
+    job = {"id": "j1", "title": "Phi công dân dụng", "videoId": "abc"}
+    assert client.put("/api/vr-jobs/j1", json=job).status_code == 428
+    response = client.put("/api/vr-jobs/j1", json=job, headers={"If-Match": '"1"'})
+    assert response.json()["version"] == 2
+    stale = client.put("/api/vr-jobs/j1", json=job, headers={"If-Match": '"1"'})
+    assert stale.status_code == 412 and stale.json()["detail"]["current"]["version"] == 2
+
+    # Third change triggers compaction into the snapshot
+    client.post("/api/vr-jobs/items", json={"id": "j2", "title": "Bác sĩ", "videoId": "xyz"})
+    assert catalog.journal_path.read_text(encoding="utf-8") == ""
+    assert [j["id"] for j in json.loads(path.read_text(encoding="utf-8"))] == ["j1", "j2"]
+
+    assert client.delete("/api/vr-jobs/j2", headers={"If-Match": "1"}).status_code == 200
+    assert client.get("/api/vr-jobs/j2").status_code == 404
+
+    # Another worker sees the same state from disk
+    other = VRJobCatalog(path, [], validate=main.validate_vr_jobs)
+    assert [(j["id"], j["version"]) for j in other.jobs()] == [("j1", 2)]
+    print("✅ VR jobs CRUD test passed")
+
+def test_cohort_analytics_incremental(tmp_path, monkeypatch):
+    """Test aggregates follow each POST and survive a restart via the snapshot"""
+    store = SubmissionStore(tmp_path / "submissions.jsonl")
+    snapshot = tmp_path / "analytics.json"
+    monkeypatch.setattr(resources, "submission_store", store)
+    monkeypatch.setattr(resources, "cohort_analytics", CohortAnalytics(store, snapshot))
+
+    for i, (school, top) in enumerate([("A", ["R", "I", "C"]), ("A", ["I", "R", "C"]), ("B", ["R", "S", "E"])]):
+        record = _submission(f"HS {i}")
+        record["school"] = school
+        record["riasec"] = top
+        record["scores"] = {**record["scores"], "R": 20 + i * 5}
+        record["suggestedMajors"] = "Kỹ sư Cơ khí, Y đa khoa" if i < 2 else "Kỹ sư Cơ khí"
+        client.post("/api/submissions", json=record)
+
+    report = client.get("/api/analytics").json()
+    overall = report["overall"]
+    assert overall["count"] == 3 and overall["top1_distribution"]["R"] == 2
+    assert overall["scores"]["R"] == {"mean": 25.0, "p25": 20, "p50": 25, "p75": 30, "p90": 30}
+    assert overall["top_majors"][0] == {"name": "Kỹ sư Cơ khí", "count": 3}
+    assert report["schools"]["B"]["count"] == 1
+
+    report = client.get("/api/analytics", params={"school": "A", "class": "10A1"}).json()
+    assert report["overall"]["top3_distribution"]["C"] == 2
+    assert client.get("/api/analytics", params={"class": "10A1"}).status_code == 400
+
+    resources.cohort_analytics.close()
+    restarted = CohortAnalytics(store, snapshot)
+    assert restarted.offset == resources.cohort_analytics.offset and restarted.refresh() == 0
+    assert restarted.report()["overall"]["count"] == 3
+    print("✅ Cohort analytics test passed")
+
+def test_submissions_export_csv_and_xlsx(tmp_path, monkeypatch):
+    """Test CSV/XLSX export flattens answers and honours the list filters"""
+    import csv, io, zipfile
+    store = SubmissionStore(tmp_path / "submissions.jsonl")
+    monkeypatch.setattr(resources, "submission_store", store)
+    store.append({**_submission("=HS 1", answers=list(range(1, 51))), "combinations": "-2+3+cmd|' /C calc'!A0"})
+    other = _submission("HS 2")
+    other["school"] = "Khác"
+    other["riasec"] = ["R", '=HYPERLINK("http://x.test","I")', "C"]
+    store.append(other)
+
+    response = client.get("/api/submissions/export", params={"school": "School"})
+    assert response.status_code == 200
+    assert response.headers["content-disposition"] == 'attachment; filename="submissions.csv"'
+    rows = list(csv.reader(io.StringIO(response.content.decode("utf-8-sig"))))
+    assert len(rows) == 2
+    row = dict(zip(rows[0], rows[1]))
+    assert row["name"] == "'=HS 1" and row["class"] == "10A1" and row["top1"] == "R"
+    assert row["combinations"] == "'-2+3+cmd|' /C calc'!A0"
+    assert row["score_C"] == "25" and row["q1"] == "1" and row["q50"] == "50"
+
+    response = client.get("/api/submissions/export", params={"format": "xlsx"})
+    assert response.status_code == 200
+    with zipfile.ZipFile(io.BytesIO(response.content)) as zf:
+        sheet = zf.read("xl/worksheets/sheet1.xml").decode("utf-8")
+    assert sheet.count("<row>") == 3 and "Khác" in sheet
+    # Top-3 letters are client-supplied text too: no formula reaches either format
+    assert "'=HYPERLINK(" in sheet and "<f>" not in sheet
+    rows = list(csv.reader(io.StringIO(client.get("/api/submissions/export", params={"school": "Khác"}).content.decode("utf-8-sig"))))
+    assert dict(zip(rows[0], rows[1]))["top2"] == '\'=HYPERLINK("http://x.test","I")'
+    assert client.get("/api/submissions/export", params={"since": "hôm qua"}).status_code == 400
+    print("✅ Submissions export test passed")
+
+def test_bulk_submissions_ingest(tmp_path, monkeypatch):
+    """Test bulk ingest validates, re-scores, de-duplicates by clientKey and reports errors"""
+    store = SubmissionStore(tmp_path / "submissions.jsonl")
+    monkeypatch.setattr(resources, "submission_store", store)
+    monkeypatch.setattr(resources, "cohort_analytics", CohortAnalytics(store))
+
+    first = {**_submission("HS 1", answers=[5] * 24 + [1] * 26), "clientKey": "dev1-1"}
+    records = [
+        first,
+        {**_submission("HS 2"), "clientKey": "dev1-2"},
+        {"name": "Thiếu dữ liệu"},
+        {**_submission("HS 1 lặp"), "clientKey": "dev1-1"},
+        {**_submission("HS 3", answers=[3] * 10)},
+        {**_submission("HS 4", answers=[0] + [3] * 48 + [6])},
+    ]
+    response = client.post("/api/submissions/bulk", params={"rescore": "true"}, json=records)
+    assert response.status_code == 200
+    body = response.json()
+    assert body["received"] == 6 and body["accepted"] == 2 and body["duplicates"] == [3]
+    assert [e["index"] for e in body["errors"]] == [2, 4, 5]
+    assert body["errors"][1]["error"] == "khong_du_50_cau"
+    assert body["errors"][2]["error"] == "cau_tra_loi_ngoai_1_5"
+
+    stored = store.load_all()
+    expected = calculate_riasec(first["answers"])
+    assert stored[0]["scores"] == expected["full_scores"] and stored[0]["riasec"] == expected["top_3_list"]
+    assert stored[0]["suggestedMajors"] == main.recommend_jobs(expected["top_3_list"])
+
+    # Re-upload of the same device batch as NDJSON: nothing new is written
+    ndjson = "\n".join(json.dumps(r) for r in records[:2])
+    response = client.post(
+        "/api/submissions/bulk", content=ndjson, headers={"Content-Type": "application/x-ndjson"}
+    )
+    assert response.json()["accepted"] == 0 and response.json()["duplicates"] == [0, 1]
+    assert len(store.load_all()) == 2
+    assert client.post("/api/submissions/bulk", json={"name": "x"}).status_code == 400
+    print("✅ Bulk submissions ingest test passed")
+
+def test_sqlite_storage_backend(tmp_path, monkeypatch):
+    """Test the SQLite backend: one-shot JSON migration, indexed filters, dedup and shared VR catalog"""
+    log = tmp_path / "submissions.jsonl"
+    json_store = SubmissionStore(log)
+    old = _submission("Cũ")
+    old["time"] = "2024-12-31T23:00:00+07:00"
+    json_store.append(old)
+    json_store.close()
+    vr_file = tmp_path / "vr_jobs.json"
+    vr_file.write_text(json.dumps([{"id": "a", "title": "A", "videoId": "x"}]), encoding="utf-8")
+
+    db = SQLiteDatabase(tmp_path / "app.db")
+    counts = migrate_json_to_sqlite(db, log, tmp_path / "submissions.json", vr_file, [])
+    assert counts == {"submissions": 1, "vr_jobs": 1}
+    assert migrate_json_to_sqlite(db, log, tmp_path / "submissions.json", vr_file, []) is None
+
+    store = SQLiteSubmissionStore(db)
+    monkeypatch.setattr(resources, "submission_store", store)
+    client.post("/api/submissions", json={**_submission("Mới"), "school": "Khác"})
+    assert store.append_many([{**_submission("K"), "clientKey": "k1"}] * 2, "clientKey") == [True, False]
+
+    names = [r["name"] for r in client.get("/api/submissions").json()]
+    assert names == ["Cũ", "Mới", "K"]
+    assert [r["name"] for r in client.get("/api/submissions", params={"school": "Khác"}).json()] == ["Mới"]
+    # 23:00 +07:00 is 16:00 UTC, so it falls before this bound
+    response = client.get("/api/submissions", params={"until": "2024-12-31T17:00:00Z"})
+    assert [r["name"] for r in response.json()] == ["Cũ"]
+    page = client.get("/api/submissions", params={"limit": 2})
+    rest = client.get("/api/submissions", params={"limit": 2, "cursor": page.headers["X-Next-Cursor"]})
+    assert [r["name"] for r in rest.json()] == ["K"]
+    assert client.get("/api/submissions", params={"since": "xx"}).status_code == 400
+
+    # Two catalogs on one file (two workers): a write through one is seen by the other
+    first = SQLiteVRJobCatalog(db, [], check_interval=0)
+    second = SQLiteVRJobCatalog(SQLiteDatabase(tmp_path / "app.db"), [], check_interval=0)
+    assert [j["id"] for j in second.jobs()] == ["a"]
+    first.create({"id": "b", "title": "B", "videoId": "y"})
+    assert [j["id"] for j in second.jobs()] == ["a", "b"]
+    updated = second.update("a", {"title": "A2", "videoId": "x"}, expected_version=1)
+    assert updated["version"] == 2 and first.get("a")["title"] == "A2"
+    print("✅ SQLite storage backend test passed")
+
+def test_submission_client_key_dedup_on_both_backends(tmp_path, monkeypatch):
+    """Test a re-sent clientKey is answered the same way by the JSON and SQLite backends"""
+    first = {**_submission("Máy A"), "clientKey": "device-1"}
+    resent = {**first, "name": "Máy A (gửi lại)"}
+    stores = [SubmissionStore(tmp_path / "submissions.jsonl"), SQLiteSubmissionStore(SQLiteDatabase(tmp_path / "app.db"))]
+    answers = []
+    for store in stores:
+        monkeypatch.setattr(resources, "submission_store", store)
+        responses = [client.post("/api/submissions", json=body) for body in (first, resent, first)]
+        assert [r.status_code for r in responses] == [200, 200, 200]
+        assert [r["name"] for r in store.load_all()] == ["Máy A"]
+        answers.append([r.json() for r in responses])
+    assert answers[0] == answers[1]
+    assert answers[0][0] == {"status": "success"}
+    assert answers[0][1]["duplicate"] is True and answers[0][1]["submission"]["name"] == "Máy A"
+    stores[0].close()
+    print("✅ Submission clientKey dedup parity test passed")
+
+def test_metrics_endpoint(monkeypatch):
+    """Test /metrics exposes route histograms, Dify timings and scrape-time gauges"""
+    async def handler(request):
+        return httpx.Response(200, json={"answer": "ok", "conversation_id": "c1"})
+
+    monkeypatch.setattr(resources.settings, "dify_api_key", "test-key")
+    monkeypatch.setattr(resources, "dify_client", DifyClient("test-key", "https://dify.test/v1/chat-messages",
+                                                        transport=httpx.MockTransport(handler)))
+    monkeypatch.setattr(main, "send_log_to_sheet", lambda res, data: None)
+    client.get("/api/vr-jobs/does-not-exist")
+    client.get("/api/sheet-outbox/stats")
+    payload = {"name": "Test", "class": "10A1", "school": "School", "answer": [3] * 50}
+    assert client.post("/start-conversation", json=payload).status_code == 200
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    text = response.text
+    assert 'http_request_duration_seconds_count{method="GET",route="/api/vr-jobs/{job_id}",status="404"}' in text
+    assert 'http_requests_in_flight 1' in text  # the scrape itself
+    assert 'dify_request_duration_seconds_count{mode="blocking",status="200"}' in text
+    assert 'scoring_duration_seconds_bucket{op="calculate_riasec",le="+Inf"}' in text
+    assert "# TYPE sheet_outbox_depth gauge" in text
+    print("✅ Metrics endpoint test passed")
+
+def test_benchmark_profiles_against_fake_dify(tmp_path, monkeypatch):
+    """Test the benchmark runner drives /chat and /chat/stream against the fake Dify without errors"""
+    fake = create_fake_upstreams(latency=0, chunks=3)
+    monkeypatch.setattr(resources.settings, "dify_api_key", "bench")
+    monkeypatch.setattr(resources, "dify_client", DifyClient("bench", benchmark.FAKE_DIFY_URL,
+                                                        transport=httpx.ASGITransport(app=fake)))
+    monkeypatch.setattr(main, "send_log_to_sheet", lambda res, data: None)
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as bench_client:
+            return [await benchmark.run_profile(bench_client, p, 30, 5) for p in ("chat", "chat-stream")]
+
+    for result in asyncio.run(run()):
+        assert result["count"] == 30 and result["errors"] == 0
+        assert result["p50_ms"] <= result["p95_ms"] <= result["p99_ms"] <= result["max_ms"]
+    assert fake.state.stats["dify_streams"] == 30
+
+    regressions = benchmark.compare(
+        [{"name": "chat", "p95_ms": 30.0, "throughput_rps": 50.0, "errors": 0}],
+        [{"name": "chat", "p95_ms": 10.0, "throughput_rps": 100.0, "errors": 0}],
+        max_regression=0.2,
+    )
+    assert len(regressions) == 2
+    print("✅ Benchmark runner test passed")
+
+def test_static_assets_precompressed_and_fingerprinted():
+    """Test / is compressed and links hashed assets, which are immutable and revalidate with 304"""
+    response = client.get("/", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["cache-control"] == "no-cache"
+    hashed = resources.static_assets.manifest()["background.png"]
+    assert f"static/{hashed}" in response.text and "static/background.png" not in response.text
+
+    image = client.get(f"/static/{hashed}")
+    assert image.headers["cache-control"] == "public, max-age=31536000, immutable"
+    assert image.content == (main.STATIC_DIR / "background.png").read_bytes()
+    again = client.get(f"/static/{hashed}", headers={"If-None-Match": image.headers["etag"]})
+    assert again.status_code == 304
+
+    plain = client.get("/static/index.html", headers={"Accept-Encoding": "identity"})
+    assert plain.headers["cache-control"] == "no-cache" and "content-encoding" not in plain.headers
+    assert client.get("/static/missing.css").status_code == 404
+    print("✅ Static assets test passed")
+
+def test_fair_admission_round_robin_and_overload():
+    """Test Dify slots go round-robin across students, and a full or slow queue raises Overloaded"""
+    async def scenario():
+        admission = FairAdmission(max_concurrency=1, max_queue=3, max_wait=5)
+        held = await admission.acquire("a")
+        order = []
+
+        async def call(key, tag):
+            with await admission.acquire(key):
+                order.append(tag)
+                await asyncio.sleep(0)
+
+        tasks = [asyncio.create_task(call(key, tag)) for key, tag in (("b", "b1"), ("b", "b2"), ("c", "c1"))]
+        await asyncio.sleep(0)
+        assert admission.queued == 3
+        try:
+            await admission.acquire("d")
+            assert False, "expected Overloaded"
+        except Overloaded as e:
+            assert e.reason == "queue_full" and e.retry_after >= 1
+        held.release()
+        await asyncio.gather(*tasks)
+        assert order == ["b1", "c1", "b2"]
+        assert admission.active == 0 and admission.queued == 0
+
+        admission.max_wait = 0.01
+        held = await admission.acquire("a")
+        try:
+            await admission.acquire("b")
+            assert False, "expected Overloaded"
+        except Overloaded as e:
+            assert e.reason == "queue_timeout"
+        assert admission.queued == 0
+        held.release()
+        assert admission.active == 0
+
+    asyncio.run(scenario())
+
+    now = [0.0]
+    buckets = TokenBuckets(rate_per_minute=60, burst=2, clock=lambda: now[0])
+    assert buckets.take("s1") == 0 and buckets.take("s1") == 0
+    assert buckets.take("s1") == 1.0 and buckets.take("s2") == 0
+    now[0] = 1.0
+    assert buckets.take("s1") == 0
+    print("✅ Fair admission / token bucket test passed")
+
+def test_llm_routes_rate_limited_and_shed_with_retry_after(monkeypatch):
+    """Test 429 once a student runs out of tokens, and 503 + Retry-After when the queue is full or Dify stays at 429"""
+    monkeypatch.setattr(resources, "user_rate_limit", TokenBuckets(rate_per_minute=60, burst=1))
+    body = {"conversation_id": "missing", "message": "hi"}
+    assert client.post("/chat", json=body).status_code == 404
+    limited = client.post("/chat", json=body)
+    assert limited.status_code == 429 and int(limited.headers["retry-after"]) >= 1
+    assert client.post("/chat", json={**body, "conversation_id": "other"}).status_code == 404
+    monkeypatch.setattr(resources, "user_rate_limit", None)
+
+    monkeypatch.setattr(resources.settings, "dify_api_key", "key")
+    monkeypatch.setattr(main, "send_log_to_sheet", lambda res, data: None)
+    payload = {"name": "Test", "class": "10A1", "school": "School", "answer": [3] * 50}
+    monkeypatch.setattr(resources, "llm_admission", FairAdmission(max_concurrency=0, max_queue=0, max_wait=1))
+    busy = client.post("/start-conversation/stream", json=payload)
+    assert busy.status_code == 503 and int(busy.headers["retry-after"]) >= 1
+    assert busy.json()["detail"] == main.LLM_OVERLOADED
+
+    upstream_429 = httpx.MockTransport(lambda request: httpx.Response(429, text="raw upstream text"))
+    monkeypatch.setattr(resources, "llm_admission", FairAdmission(max_concurrency=2, max_queue=10, max_wait=1))
+    monkeypatch.setattr(resources, "dify_client", DifyClient("key", "http://dify.test/v1/chat-messages",
+                                                                  max_retries=0, transport=upstream_429))
+    response = client.post("/start-conversation", json=payload)
+    assert response.status_code == 503 and "retry-after" in response.headers
+    assert "raw upstream text" not in response.text
+    assert resources.llm_admission.stats()["active"] == 0
+    assert 'llm_admission_rejected_total{reason="queue_full"}' in client.get("/metrics").text
+    print("✅ LLM admission control test passed")
+
+def test_riasec_jobs_async_mode(tmp_path, monkeypatch):
+    """Test /run-riasec/jobs answers at once, long-polls to the stored result, dedupes resubmits and calls back"""
+    calls = []
+    callbacks = []
+
+    async def fake_dify(res, payload):
+        calls.append(payload)
+        await asyncio.sleep(0.05)
+        return {"answer": f"Phân tích cho {payload['inputs']['name']}"}
+
+    def callback_handler(request):
+        callbacks.append(request)
+        return httpx.Response(200)
+
+    monkeypatch.setattr(main, "call_dify_api", fake_dify)
+    jobs_app = main.create_app(Settings(
+        data_dir=tmp_path, dify_api_key="key", rate_limit_per_minute=0,
+        riasec_callback_hosts=["hooks.test"], riasec_callback_secret="secret",
+    ))
+    jobs_app.state.resources.analysis_jobs.transport = httpx.MockTransport(callback_handler)
+    jobs_app.state.resources.analysis_jobs.poll_interval = 0.05
+    payload = {"name": "Lan", "class": "11B", "school": "S", "answer": [3] * 50,
+               "callback_url": "https://hooks.test/done"}
+
+    with TestClient(jobs_app) as jobs_client:
+        submitted = jobs_client.post("/run-riasec/jobs", json=payload)
+        assert submitted.status_code == 202 and submitted.json()["status"] in ("queued", "running")
+        job_id = submitted.json()["job_id"]
+        assert submitted.headers["location"] == f"/run-riasec/jobs/{job_id}"
+
+        finished = jobs_client.get(f"/run-riasec/jobs/{job_id}", params={"wait": 5}).json()
+        assert finished["status"] == "done"
+        assert finished["result"]["text"] == "Phân tích cho Lan"
+        assert finished["result"]["top_3_types"] == calculate_riasec([3] * 50)["top_3_list"]
+
+        again = jobs_client.post("/run-riasec/jobs", json=payload)
+        assert again.status_code == 200 and again.json()["job_id"] == job_id and len(calls) == 1
+
+        deadline = time.time() + 5
+        while not callbacks and time.time() < deadline:
+            time.sleep(0.02)
+        body = callbacks[0].content
+        assert json.loads(body)["job_id"] == job_id
+        expected = hmac.new(b"secret", body, hashlib.sha256).hexdigest()
+        assert callbacks[0].headers["x-signature-256"] == f"sha256={expected}"
+
+        blocked = jobs_client.post("/run-riasec/jobs", json={**payload, "callback_url": "http://169.254.169.254/"})
+        assert blocked.status_code == 400
+        assert jobs_client.get("/run-riasec/jobs/missing").status_code == 404
+
+    # Stored: a restarted process still has the result
+    reopened = JobQueue(tmp_path / "analysis_jobs.db", main.run_analysis_job)
+    assert JobQueue.view(reopened.get(job_id))["result"]["text"] == "Phân tích cho Lan"
+
+    attempts = []
+
+    async def flaky(job_input):
+        attempts.append(job_input)
+        if len(attempts) == 1:
+            raise RetryLater(0, "Dify quá tải")
+        return {"ok": True}
+
+    async def retry_scenario():
+        queue = JobQueue(tmp_path / "retry.db", flaky)
+        job, created = queue.submit({"x": 1}, "k")
+        assert created and await queue.run_once()
+        assert queue.get(job["id"])["status"] == "queued"
+        assert await queue.run_once()
+        assert JobQueue.view(queue.get(job["id"]))["result"] == {"ok": True}
+
+    asyncio.run(retry_scenario())
+
+    # Only overload and connection/timeout errors are retried; other failures end the job
+    job_input = {"request": {**payload, "name": "Minh"}, "riasec": calculate_riasec([3] * 50)}
+    failures = {
+        "overloaded": main.HTTPException(status_code=503, detail=main.LLM_OVERLOADED, headers={"Retry-After": "7"}),
+        "timeout": main.HTTPException(status_code=500, detail="Lỗi kết nối Dify: timed out"),
+        "rejected": main.HTTPException(status_code=400, detail="Lỗi từ dịch vụ AI (Dify 400)"),
+        "internal": main.HTTPException(status_code=500, detail="Lỗi từ dịch vụ AI (Dify 500)"),
+    }
+    outcomes = {}
+    for name, error in failures.items():
+        async def failing_dify(res, payload, error=error, name=name):
+            if name == "timeout":
+                raise error from DifyConnectionError("timed out")
+            raise error
+        monkeypatch.setattr(main, "call_dify_api", failing_dify)
+        try:
+            asyncio.run(main.run_analysis_job(jobs_app.state.resources, job_input))
+        except (RetryLater, RuntimeError) as e:
+            outcomes[name] = type(e)
+    assert outcomes == {"overloaded": RetryLater, "timeout": RetryLater, "rejected": RuntimeError, "internal": RuntimeError}
+    print("✅ RIASEC async jobs test passed")
+
+def test_import_is_side_effect_free_and_app_factory_is_lazy(tmp_path, monkeypatch):
+    """Test importing main writes nothing, apps build resources on first use, and startup records the cold start"""
+    script = "import main; print(main.IMPORT_SECONDS)"
+    env = {"PYTHONPATH": str(Path(main.__file__).parent), "PATH": "", "DATA_DIR": "data"}
+    result = subprocess.run([sys.executable, "-c", script], cwd=tmp_path, env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert list(tmp_path.iterdir()) == []
+    # Generous bound: catches heavy work creeping back into import, not a timing gate
+    assert float(result.stdout) < 5
+
+    data_dir = tmp_path / "isolated"
+    isolated = main.create_app(Settings(data_dir=data_dir, dify_api_key="key"))
+    isolated_resources = isolated.state.resources
+    # Nothing built, and nothing shared with the test app
+    assert isolated_resources is not resources and not data_dir.exists()
+
+    with TestClient(isolated) as isolated_client:
+        assert (data_dir / "sheet_outbox.db").exists()
+        assert isolated_resources.built("submission_store") is None
+        assert isolated_client.get("/api/submissions").json() == []
+        assert isolated_resources.built("submission_store") is not None
+        assert resources.submission_store is not isolated_resources.submission_store
+        text = isolated_client.get("/metrics").text
+    assert 'app_cold_start_seconds{phase="import"}' in text and 'app_cold_start_seconds{phase="startup"}' in text
+    print("✅ Side-effect-free import / app factory test passed")
+
+def test_default_data_dir_keeps_legacy_deploy_layout(tmp_path):
+    """Test a deploy started from backend/ with the old default still sees its VR jobs and submissions"""
+    backend_dir = tmp_path / "backend"
+    assert default_data_dir(backend_dir) == backend_dir / "data"
+
+    # Old relative default resolved from backend/: files live in backend/backend/data
+    legacy = backend_dir / "backend" / "data"
+    shutil.copytree(Path(main.__file__).resolve().parent / "backend" / "data", legacy)
+    assert default_data_dir(backend_dir) == legacy
+    with TestClient(main.create_app(Settings(data_dir=default_data_dir(backend_dir)))) as legacy_client:
+        assert "job_1767977880096" in [j["id"] for j in legacy_client.get("/api/vr-jobs").json()]
+        assert "Dev Tester" in [r["name"] for r in legacy_client.get("/api/submissions").json()]
+
+    # Once backend/data exists (moved by the operator) it wins
+    (backend_dir / "data").mkdir()
+    assert default_data_dir(backend_dir) == backend_dir / "data"
+    print("✅ Legacy data directory test passed")
+
 if __name__ == "__main__":
+    import inspect
+    import pytest
+
+    def run(test):
+        """Call a test with the pytest fixtures it asks for (tmp_path, monkeypatch)"""
+        with tempfile.TemporaryDirectory() as tmp, pytest.MonkeyPatch.context() as monkeypatch:
+            fixtures = {"tmp_path": Path(tmp), "monkeypatch": monkeypatch}
+            test(**{name: fixtures[name] for name in inspect.signature(test).parameters})
+
     print("Running CareerVR API tests...\n")
     
     try:
-        test_health()
-        test_riasec_valid()
-        test_riasec_invalid_answers_count()
-        test_riasec_invalid_answer_value()
-        test_riasec_empty_name()
-        test_riasec_whitespace_name()
+        run(test_health)
+        run(test_riasec_valid)
+        run(test_riasec_invalid_answers_count)
+        run(test_riasec_invalid_answer_value)
+        run(test_riasec_empty_name)
+        run(test_riasec_whitespace_name)
+        run(test_submission_store_append_and_recover)
+        run(test_submission_store_imports_legacy)
+        run(test_submissions_roundtrip)
+        run(test_submissions_pagination_and_filters)
+        run(test_dify_client_retries_on_429)
+        run(test_chat_streaming)
+        run(test_memory_conversation_store_lru_and_ttl)
+        run(test_sqlite_conversation_store_shared)
+        run(test_chat_returns_bounded_history)
+        run(test_batch_scoring_matches_single)
+        run(test_question_mapping_compiles)
+        run(test_recommendation_index)
+        run(test_score_cache_memoizes_answer_vectors)
+        run(test_similarity_ranking)
+        run(test_sheet_outbox_batches_and_retries)
+        run(test_riasec_analysis_cache_single_flight)
+        run(test_analysis_cache_survives_cancelled_caller)
+        run(test_vr_jobs_etag)
+        run(test_vr_jobs_incremental_crud)
+        run(test_cohort_analytics_incremental)
+        run(test_submissions_export_csv_and_xlsx)
+        run(test_bulk_submissions_ingest)
+        run(test_sqlite_storage_backend)
+        run(test_submission_client_key_dedup_on_both_backends)
+        run(test_metrics_endpoint)
+        run(test_benchmark_profiles_against_fake_dify)
+        run(test_static_assets_precompressed_and_fingerprinted)
+        run(test_fair_admission_round_robin_and_overload)
+        run(test_llm_routes_rate_limited_and_shed_with_retry_after)
+        run(test_riasec_jobs_async_mode)
+        run(test_import_is_side_effect_free_and_app_factory_is_lazy)
+        run(test_default_data_dir_keeps_legacy_deploy_layout)
         
         print("\n✅ All tests passed!")
     except AssertionError as e:
@@ -0,0 +1,283 @@
+"""
+In-memory VR job catalog.
+
+The catalog is parsed and validated once, then served as pre-serialised bytes
+with a strong ETag. It is reloaded when the files change on disk (checked at
+most once per ``check_interval`` seconds), so a repeat visit with
+``If-None-Match`` costs no disk I/O or JSON work.
+
+Storage is ``vr_jobs.json`` (snapshot) plus ``vr_jobs.journal.jsonl``:
+- per-item create/update/delete appends one fsynced journal line, so write
+  cost scales with the change, not the catalog size;
+- every job carries a ``version``; updates/deletes with a stale version are rejected;
+- the journal is folded into the snapshot (temp file + rename) every
+  ``compact_every`` changes. Replaying an op twice gives the same state, so a
+  crash between the two renames is harmless.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from submission_store import atomic_write_text
+
+try:
+    import fcntl
+except ImportError:  # Windows: in-process locking only
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """RFC 7232 weak comparison of an If-None-Match header against our ETag"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+class VRJobNotFound(KeyError):
+    pass
+
+
+class VRJobConflict(Exception):
+    """The job already exists, or its version changed since the client read it."""
+
+    def __init__(self, message: str, current: Optional[Dict[str, Any]] = None):
+        super().__init__(message)
+        self.current = current
+
+
+class VRJobCatalog:
+    def __init__(
+        self,
+        path: Path,
+        default: List[Dict[str, Any]],
+        validate: Optional[Callable[[List[Any]], List[Dict[str, Any]]]] = None,
+        check_interval: float = 1.0,
+        compact_every: int = 200,
+    ):
+        self.path = Path(path)
+        self.journal_path = self.path.with_name(self.path.stem + ".journal.jsonl")
+        self.lock_path = self.path.with_name(self.path.name + ".lock")
+        self.default = default
+        self.validate = validate or (lambda jobs: jobs)
+        self.check_interval = check_interval
+        self.compact_every = compact_every
+
+        self._lock = threading.RLock()
+        self._jobs: Optional[Dict[str, Dict[str, Any]]] = None
+        self._published: Tuple[bytes, str] = (b"", "")
+        self._stamp: Optional[Tuple] = None
+        self._journal_len = 0
+        self._checked_at = 0.0
+        self.reloads = 0
+
+    # ----- loading -----
+    def _file_stamp(self) -> Tuple:
+        stamp = []
+        for p in (self.path, self.journal_path):
+            try:
+                st = os.stat(p)
+                stamp.append((st.st_ino, st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def _read_snapshot(self) -> List[Any]:
+        if not self.path.exists():
+            return self.default
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                jobs = json.load(f)
+            if not isinstance(jobs, list):
+                raise ValueError("expected a JSON array")
+            return jobs
+        except Exception as e:
+            logger.error(f"Error reading {self.path}: {e}")
+            return self.default
+
+    def _read_journal(self) -> List[Dict[str, Any]]:
+        try:
+            f = open(self.journal_path, "r", encoding="utf-8")
+        except FileNotFoundError:
+            return []
+        ops = []
+        with f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break  # torn last line from a crash
+                try:
+                    ops.append(json.loads(line))
+                except ValueError:
+                    logger.warning(f"Skipping corrupt line in {self.journal_path}")
+        return ops
+
+    @staticmethod
+    def _apply(jobs: Dict[str, Dict[str, Any]], op: Dict[str, Any]):
+        if op.get("op") == "upsert":
+            jobs[op["job"]["id"]] = op["job"]
+        elif op.get("op") == "delete":
+            jobs.pop(op["id"], None)
+
+    def _publish_locked(self):
+        body = json.dumps(list(self._jobs.values()), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        # One tuple so readers never see a body with another version's ETag
+        self._published = (body, '"' + hashlib.sha256(body).hexdigest()[:32] + '"')
+        self._checked_at = time.monotonic()
+
+    def _reload_locked(self):
+        stamp = self._file_stamp()
+        jobs = {job["id"]: job for job in self.validate(self._read_snapshot())}
+        ops = self._read_journal()
+        for op in ops:
+            self._apply(jobs, op)
+        self._jobs = jobs
+        self._journal_len = len(ops)
+        self._stamp = stamp
+        self._publish_locked()
+        self.reloads += 1
+
+    def _ensure_fresh(self):
+        now = time.monotonic()
+        if self._jobs is not None and now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            if self._jobs is None:
+                self._reload_locked()
+                return
+            if time.monotonic() - self._checked_at < self.check_interval:
+                return
+            self._checked_at = time.monotonic()
+            if self._file_stamp() != self._stamp:
+                logger.info(f"{self.path} changed on disk, reloading VR job catalog")
+                self._reload_locked()
+
+    # ----- reads -----
+    def snapshot(self) -> Tuple[bytes, str]:
+        """Serialised catalog and its ETag"""
+        self._ensure_fresh()
+        return self._published
+
+    def jobs(self) -> List[Dict[str, Any]]:
+        self._ensure_fresh()
+        return list(self._jobs.values())
+
+    def get(self, job_id: str) -> Dict[str, Any]:
+        self._ensure_fresh()
+        try:
+            return self._jobs[job_id]
+        except KeyError:
+            raise VRJobNotFound(job_id)
+
+    def invalidate(self):
+        with self._lock:
+            self._jobs = None
+
+    # ----- writes -----
+    @contextmanager
+    def _write_lock(self):
+        """Serialise writers across threads and worker processes, starting from the latest state"""
+        with self._lock:
+            if fcntl is None:
+                self._refresh_locked()
+                yield
+                return
+            self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.lock_path, "a") as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    self._refresh_locked()
+                    yield
+                finally:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _refresh_locked(self):
+        if self._jobs is None or self._file_stamp() != self._stamp:
+            self._reload_locked()
+
+    def _commit_locked(self, op: Dict[str, Any]):
+        line = (json.dumps(op, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        self.journal_path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(str(self.journal_path), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self._apply(self._jobs, op)
+        self._journal_len += 1
+        if self._journal_len >= self.compact_every:
+            self._compact_locked()
+        self._stamp = self._file_stamp()
+        self._publish_locked()
+
+    def _compact_locked(self):
+        text = json.dumps(list(self._jobs.values()), ensure_ascii=False, indent=2)
+        atomic_write_text(self.path, text)
+        atomic_write_text(self.journal_path, "")
+        self._journal_len = 0
+
+    @staticmethod
+    def _check_version(current: Dict[str, Any], expected_version: Optional[int]):
+        if expected_version is not None and current.get("version", 1) != expected_version:
+            raise VRJobConflict(
+                f"Phiên bản không khớp (hiện tại: {current.get('version', 1)})", current
+            )
+
+    def create(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        with self._write_lock():
+            if job["id"] in self._jobs:
+                raise VRJobConflict(f"Nghề {job['id']} đã tồn tại", self._jobs[job["id"]])
+            job = {**job, "version": 1}
+            self._commit_locked({"op": "upsert", "job": job})
+            return job
+
+    def update(self, job_id: str, job: Dict[str, Any], expected_version: Optional[int]) -> Dict[str, Any]:
+        with self._write_lock():
+            current = self._jobs.get(job_id)
+            if current is None:
+                raise VRJobNotFound(job_id)
+            self._check_version(current, expected_version)
+            job = {**job, "id": job_id, "version": current.get("version", 1) + 1}
+            self._commit_locked({"op": "upsert", "job": job})
+            return job
+
+    def delete(self, job_id: str, expected_version: Optional[int]):
+        with self._write_lock():
+            current = self._jobs.get(job_id)
+            if current is None:
+                raise VRJobNotFound(job_id)
+            self._check_version(current, expected_version)
+            self._commit_locked({"op": "delete", "id": job_id})
+
+    def replace_all(self, jobs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Whole-list replacement (legacy admin UI): one atomic snapshot write"""
+        with self._write_lock():
+            new_jobs = {}
+            for job in jobs:
+                current = self._jobs.get(job["id"])
+                version = current.get("version", 1) if current else 1
+                if current and {k: v for k, v in current.items() if k != "version"} != \
+                        {k: v for k, v in job.items() if k != "version"}:
+                    version += 1
+                new_jobs[job["id"]] = {**job, "version": version}
+            self._jobs = new_jobs
+            self._compact_locked()
+            self._stamp = self._file_stamp()
+            self._publish_locked()
+            return list(new_jobs.values())
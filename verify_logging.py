@@ -1,17 +1,19 @@
 
+import asyncio
 import json
 import os
 import sys
-from unittest.mock import MagicMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
 
 # Import backend modules
 sys.path.insert(0, os.path.join(os.getcwd(), "backend"))
 import main
 from main import start_conversation, StartConversationRequest, recommend_jobs
 
-# Mock dependencies
-main.requests = MagicMock()
-main.call_dify_api = MagicMock(return_value={"answer": "AI Response", "conversation_id": "123"})
+# Mock dependencies of the default app
+resources = main.app.state.resources
+resources.sheet_outbox = MagicMock()
+main.call_dify_api = AsyncMock(return_value={"answer": "AI Response", "conversation_id": "123"})
 
 # Mock BackgroundTasks since we are calling the function directly and not via FastAPI wrapper
 # In direct call, background_tasks arg is just an object with add_task method
@@ -46,19 +48,19 @@ def test_full_flow():
     # 2. Run
     bg_tasks = MockBackgroundTasks()
     try:
-        main.start_conversation(req, bg_tasks)
+        asyncio.run(main.start_conversation(req, bg_tasks, resources))
     except Exception as e:
         print(f"❌ Error: {e}")
         return
 
     # 3. Verify Google Sheet Request
-    # Check if requests.post was called with correct URL and Payload
-    args, kwargs = main.requests.post.call_args
-    url = args[0]
-    json_body = kwargs['json']
+    # Check the row queued in the outbox and the URL the worker will post to
+    args, kwargs = resources.sheet_outbox.enqueue.call_args
+    url = resources.settings.google_script_url
+    json_body = args[0]
     
-    print(f"\nURL Called: {url}")
-    print("Payload sent to Sheet:")
+    print(f"\nURL Configured: {url}")
+    print("Payload queued for Sheet:")
     print(json.dumps(json_body, indent=2, ensure_ascii=False))
     
     if "script.google.com" in url: